@@ -13,4 +13,23 @@ class OriginalImageTypeDoesNotExist(APIException):
     status_code = 500
     default_detail = 'There is no created type for original image  in DB.' \
                      'You should create this type via admin panel in Thumbnail types section'
-    default_code = 'thumbnail_type_does_not_exist'
\ No newline at end of file
+    default_code = 'thumbnail_type_does_not_exist'
+
+
+class ImageProcessingIsBusy(APIException):
+    """Message of exception if queue of image processing is full"""
+    status_code = 503
+    default_detail = 'Image processing is busy, try again later'
+    default_code = 'image_processing_is_busy'
+
+
+class ThumbnailBacklogIsFull(APIException):
+    """Message of exception if uploads are shed because too many images are waiting for thumbnails"""
+    status_code = 503
+    default_detail = 'Too many images are waiting for thumbnails, try again later'
+    default_code = 'thumbnail_backlog_is_full'
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        # Sent in Retry-After header by exception handler of DRF
+        self.wait = wait
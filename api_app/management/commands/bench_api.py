@@ -0,0 +1,78 @@
+import uuid
+
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from app_with_ui.benchmarks import run_benchmark, add_baseline_arguments, report_results, generate_image_content
+from app_with_ui.models import AccountTier, ThumbnailType, User, Blob
+from app_with_ui.serving import get_webp_variant_name
+from app_with_ui.type_registry import thumbnail_type_registry
+
+
+def check_status(response, expected_status):
+    if response.status_code != expected_status:
+        raise CommandError(f'Unexpected response {response.status_code}: {response.content[:200]}')
+
+
+class Command(BaseCommand):
+    help = 'Measuring speed of upload, image list and expiry link creation API endpoints through test client'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolution', default='1920x1080', help='WxH size of uploaded images')
+        add_baseline_arguments(parser)
+
+    def handle(self, *args, **options):
+        width, height = map(int, options['resolution'].split('x'))
+        image_content = generate_image_content(width, height, 'jpeg')
+        username = f'benchmark_{uuid.uuid4().hex[:8]}'
+        results = {}
+        created_files = []
+        last_blob_id = Blob.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        # Benchmark user and its images exist only inside of transaction, which is rolled back at the end,
+        # files of blobs created by benchmark are deleted after it
+        try:
+            with transaction.atomic():
+                if thumbnail_type_registry.get_original_type() is None:
+                    ThumbnailType.objects.create(title='Original image', is_original=True)
+                    # Signals invalidate registry only after commit, benchmark type is never committed
+                    thumbnail_type_registry.invalidate()
+                account_tier = AccountTier.objects.create(title='Benchmark', has_ability_create_expiry_link=True)
+                account_tier.allowed_image_types.set(ThumbnailType.objects.all())
+                user = User.objects.create(username=username, account_tier=account_tier)
+                client = APIClient()
+                client.force_authenticate(user=user)
+
+                upload_data = {}
+
+                def prepare_upload():
+                    upload_data['title'] = 'Benchmark image'
+                    upload_data['image'] = SimpleUploadedFile('benchmark.jpeg', image_content, 'image/jpeg')
+
+                def upload():
+                    response = client.post(reverse('upload'), upload_data, format='multipart')
+                    check_status(response, 201)
+                    upload_data['id'] = response.data['id']
+
+                def list_images():
+                    check_status(client.get(reverse('image_list')), 200)
+
+                def create_expiry_link():
+                    url = reverse('exp_link_create', args=[upload_data['id']])
+                    check_status(client.post(url, {'user_exp_time_seconds': 300}), 201)
+
+                results['CreateImage'] = run_benchmark(upload, options['repeat'], prepare_upload)
+                results['ImageListView'] = run_benchmark(list_images, options['repeat'])
+                results['ExpiredLinkCreateView'] = run_benchmark(create_expiry_link, options['repeat'])
+                created_files = list(Blob.objects.filter(id__gt=last_blob_id).values_list('file', flat=True))
+                transaction.set_rollback(True)
+        finally:
+            # Types loaded by registry inside of rolled back transaction must not be used later
+            thumbnail_type_registry.invalidate()
+            for name in created_files:
+                default_storage.delete(name)
+                default_storage.delete(get_webp_variant_name(name))
+        report_results(self, results, options)
@@ -1,5 +1,7 @@
 from rest_framework import permissions
 
+from app_with_ui.tier_cache import get_tier_policy
+
 
 class CreateExpiredLinkPermission(permissions.BasePermission):
     """Checking if user has ability to generate expiry link according to his account tier"""
@@ -7,9 +9,8 @@ class CreateExpiredLinkPermission(permissions.BasePermission):
     message = "User's account tier does not include ability to generate expiry link"
 
     def has_permission(self, request, view):
-        account_tier = request.user.account_tier
-        has_permission = account_tier.has_ability_create_expiry_link
-        return has_permission
+        tier_policy = get_tier_policy(request.user.account_tier_id)
+        return bool(tier_policy and tier_policy['has_ability_create_expiry_link'])
 
 
 class HasUserAccountTier(permissions.BasePermission):
@@ -18,4 +19,4 @@ class HasUserAccountTier(permissions.BasePermission):
     message = "User has not been assigned an any account tier"
 
     def has_permission(self, request, view):
-        return request.user.account_tier
\ No newline at end of file
+        return get_tier_policy(request.user.account_tier_id) is not None
\ No newline at end of file
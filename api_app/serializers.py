@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from app_with_ui.models import Image, ExpiredLink, ThumbnailType
 from rest_framework import serializers
 
@@ -16,6 +18,13 @@ class ImageSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'image']
 
 
+class ImageStatusSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Image
+        fields = ['id', 'processing_status']
+
+
 class ImageListSerializer(serializers.ModelSerializer):
     type = ThumbnailTypeSerializer()
 
@@ -24,6 +33,28 @@ class ImageListSerializer(serializers.ModelSerializer):
         fields = ['title', 'id', 'image', 'type']
 
 
+def serialize_image_list(images, request=None):
+    """
+    Fast path of ImageListSerializer(images, many=True).data for image list endpoint.
+    Gives the same data, but without DRF fields machinery. Images must be fetched with select_related('type')
+    """
+
+    build_url = request.build_absolute_uri if request is not None else str
+    data = []
+    for image in images:
+        image_type = image.type
+        data.append(OrderedDict((
+            ('title', image.title),
+            ('id', image.id),
+            ('image', build_url(image.image.url) if image.image else None),
+            ('type', OrderedDict((
+                ('title', image_type.title),
+                ('heigth_size_in_pixels', image_type.heigth_size_in_pixels),
+            )) if image_type is not None else None),
+        )))
+    return data
+
+
 class ExpiredLinkCreateSerializer(serializers.ModelSerializer):
     user_exp_time_seconds = serializers.IntegerField(required=True, min_value=300, max_value=30000)
     expiry_link = serializers.CharField(read_only=True)
@@ -0,0 +1,6 @@
+# Tests use local memory cache instead of Redis, so cached data never leaks between tests
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
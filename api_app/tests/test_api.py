@@ -1,29 +1,60 @@
+import base64
+import hashlib
 import json
 import os
 import sys
 from collections import OrderedDict
 from io import BytesIO
+from unittest import mock
 
 
+from asgiref.sync import async_to_sync
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.signals import request_started, request_finished
+from django.db import close_old_connections
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase, force_authenticate
 
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
 
 import shutil
+import tempfile
 
+from datetime import timedelta
+
+from django.test import override_settings
+from django.utils import timezone
+
+from api_app.tests import TEST_CACHES
 from api_app.permissions import CreateExpiredLinkPermission
 from api_app.serializers import ImageListSerializer, ExpiredLinkCreateSerializer
 
-from app_with_ui.models import User, AccountTier, Image, ThumbnailType, ExpiredLink
+from app_with_ui.asgi import StreamingASGIHandler
+from app_with_ui.instrumentation import Histograms
+from app_with_ui.models import User, AccountTier, Image, ThumbnailType, ExpiredLink, Blob, BlobDerivative
+from app_with_ui.rate_limit import acquire_slot, release_slot
+from app_with_ui.services import sign_expiry_link
+from app_with_ui.tier_cache import get_tier_policy, TIER_POLICY_KEY
+from app_with_ui.type_registry import thumbnail_type_registry
+from image_project.celery import app as celery_app
 from PIL import Image as Img
 
 
+@override_settings(CACHES=TEST_CACHES)
 class ImageApiTestCase(APITestCase):
 
     def setUp(self):
+        cache.clear()
+        thumbnail_type_registry.invalidate()
+        # Celery reads settings once, so eager mode is set on its config and restored after test
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+        # Uploads and blobs are stored in temporary directory instead of MEDIA_ROOT of project
+        self.media_root = tempfile.mkdtemp()
+        self.media_root_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.media_root_override.enable()
         self.thumbnail_type_original = ThumbnailType.objects.create(
             title='Original image',
             is_original=True
@@ -57,6 +88,10 @@ class ImageApiTestCase(APITestCase):
             content_type='image/jpeg'
         )
 
+    def tearDown(self):
+        self.media_root_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
     def generate_image_file(self):
         file = BytesIO()
         image = Img.new('RGBA', size=(100, 100), color=(155, 0, 0))
@@ -90,21 +125,22 @@ class ImageApiTestCase(APITestCase):
 
         basic_tier = AccountTier.objects.filter(title='Basic').first()
 
-        basic_tier.allowed_image_types.add(image_type_200)
+        with self.captureOnCommitCallbacks(execute=True):
+            basic_tier.allowed_image_types.add(image_type_200)
         response = self.client.get(url)
         self.assertEqual(status.HTTP_200_OK, response.status_code)
-        self.assertEqual(1, response.data['count'])
+        self.assertEqual(1, len(response.data['results']))
         self.assertEqual(200, response.data['results'][0]['type']['heigth_size_in_pixels'])
 
-        basic_tier.allowed_image_types.add(image_type_original)
+        with self.captureOnCommitCallbacks(execute=True):
+            basic_tier.allowed_image_types.add(image_type_original)
         response = self.client.get(url)
-        self.assertEqual(2, response.data['count'])
-        self.assertEqual(None, response.data['results'][0]['type']['heigth_size_in_pixels'])
-        self.assertEqual(200, response.data['results'][1]['type']['heigth_size_in_pixels'])
-
-        shutil.rmtree('media/user_basic', ignore_errors=True)
+        self.assertEqual(2, len(response.data['results']))
+        self.assertEqual(200, response.data['results'][0]['type']['heigth_size_in_pixels'])
+        self.assertEqual(None, response.data['results'][1]['type']['heigth_size_in_pixels'])
 
     def test_upload_image(self):
+        self.account_tier_enterprise.allowed_image_types.add(self.thumbnail_type_200px)
         url = reverse('upload')
         self.client.force_authenticate(user=self.user_enterprise)
 
@@ -119,12 +155,354 @@ class ImageApiTestCase(APITestCase):
         data = {"id": 2, "title": "Test_upload_image", "image": test_image}
         self.assertEqual(0, Image.objects.filter(user=self.user_enterprise).count())
         self.assertEqual(0, Image.objects.filter(type__is_original=False, user=self.user_enterprise).count())
-        response = self.client.post(url, data=data)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data=data)
         self.assertEqual(1, Image.objects.filter(type__is_original=False, user=self.user_enterprise).count())
         self.assertEqual(2, Image.objects.filter(user=self.user_enterprise).count())
         self.assertEqual(status.HTTP_201_CREATED, response.status_code)
 
-        shutil.rmtree('media/user_enterprise', ignore_errors=True)
+        url = reverse('image_status', args=[response.data['id']])
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(Image.ProcessingStatus.READY, response.data['processing_status'])
+
+    def test_upload_admission_control(self):
+        url = reverse('upload')
+        self.account_tier_enterprise.upload_rate = 2
+        self.account_tier_enterprise.save()
+        self.client.force_authenticate(user=self.user_enterprise)
+        for _ in range(2):
+            self.new_file.seek(0)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+            self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+
+        self.new_file.seek(0)
+        response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+        self.assertEqual('30', response['Retry-After'])
+
+        self.account_tier_enterprise.upload_rate = 1
+        self.account_tier_enterprise.max_concurrent_uploads = 1
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account_tier_enterprise.save()
+        cache.clear()
+        acquire_slot('upload', self.user_enterprise.id, 1)
+        self.new_file.seek(0)
+        response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+        self.assertEqual('1', response['Retry-After'])
+        release_slot('upload', self.user_enterprise.id)
+        # Request rejected for concurrency did not take the only token
+        self.new_file.seek(0)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertTrue(acquire_slot('upload', self.user_enterprise.id, 1))
+
+        self.account_tier_enterprise.upload_rate = None
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account_tier_enterprise.save()
+
+        Image.objects.update(processing_status=Image.ProcessingStatus.PENDING)
+        with override_settings(THUMBNAIL_BACKLOG_SHED_THRESHOLD=1):
+            self.new_file.seek(0)
+            response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+            self.assertEqual(status.HTTP_503_SERVICE_UNAVAILABLE, response.status_code)
+            self.assertEqual('30', response['Retry-After'])
+
+            self.account_tier_enterprise.bypass_load_shedding = True
+            self.account_tier_enterprise.max_concurrent_uploads = None
+            with self.captureOnCommitCallbacks(execute=True):
+                self.account_tier_enterprise.save()
+            self.new_file.seek(0)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+            self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+
+    def test_ui_admission_control(self):
+        url = reverse('upload_image')
+        self.account_tier_enterprise.upload_rate = 2
+        self.account_tier_enterprise.max_concurrent_uploads = 1
+        self.account_tier_enterprise.save()
+        self.client.force_login(self.user_enterprise)
+        acquire_slot('upload', self.user_enterprise.id, 1)
+        response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+        self.assertEqual('1', response['Retry-After'])
+        release_slot('upload', self.user_enterprise.id)
+
+        self.new_file.seek(0)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_302_FOUND, response.status_code)
+        self.assertTrue(acquire_slot('upload', self.user_enterprise.id, 1))
+        release_slot('upload', self.user_enterprise.id)
+
+        # Request rejected for concurrency did not take a token
+        self.new_file.seek(0)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_302_FOUND, response.status_code)
+
+        self.new_file.seek(0)
+        response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+        self.assertEqual('30', response['Retry-After'])
+
+        Image.objects.update(processing_status=Image.ProcessingStatus.PENDING)
+        with override_settings(THUMBNAIL_BACKLOG_SHED_THRESHOLD=0):
+            response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+            self.assertEqual(status.HTTP_503_SERVICE_UNAVAILABLE, response.status_code)
+            self.assertEqual('30', response['Retry-After'])
+
+        self.account_tier_enterprise.link_rate = 1
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account_tier_enterprise.save()
+        image = Image.objects.filter(user=self.user_enterprise).first()
+        url = reverse('create_expiry_link', args=[image.id])
+        response = self.client.post(url, data={'user_exp_time_seconds': 300})
+        self.assertEqual(status.HTTP_302_FOUND, response.status_code)
+        response = self.client.post(url, data={'user_exp_time_seconds': 300})
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+        self.assertEqual('60', response['Retry-After'])
+
+    def test_upload_deduplication(self):
+        self.account_tier_basic.allowed_image_types.add(self.thumbnail_type_200px)
+        self.account_tier_enterprise.allowed_image_types.add(self.thumbnail_type_200px)
+        url = reverse('upload')
+        for user in [self.user_basic, self.user_enterprise, self.user_enterprise]:
+            self.client.force_authenticate(user=user)
+            self.new_file.seek(0)
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(url, data={'title': 'Book', 'image': self.new_file})
+            self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+
+        self.assertEqual(6, Image.objects.count())
+        self.assertEqual(1, Image.objects.values('image').filter(type__is_original=True).distinct().count())
+        self.assertEqual(2, Blob.objects.count())
+        self.assertEqual(1, BlobDerivative.objects.count())
+        self.assertEqual([3, 3], list(Blob.objects.values_list('ref_count', flat=True)))
+        original_blob = Blob.objects.get(derivatives__isnull=False)
+        self.assertEqual(hashlib.sha256(open('api_app/tests/book.jpeg', 'rb').read()).hexdigest(), original_blob.sha256)
+        self.assertEqual((286, 176), (original_blob.width, original_blob.height))
+
+        Image.objects.filter(user=self.user_enterprise).delete()
+        self.assertEqual([1, 1], list(Blob.objects.values_list('ref_count', flat=True)))
+
+    def test_derivatives_of_changed_thumbnail_type(self):
+        self.account_tier_basic.allowed_image_types.add(self.thumbnail_type_200px)
+        self.client.force_authenticate(user=self.user_basic)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload'), data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(1, BlobDerivative.objects.filter(heigth=200).count())
+
+        self.thumbnail_type_200px.title = 'Medium'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thumbnail_type_200px.save()
+        self.assertEqual(1, BlobDerivative.objects.filter(heigth=200).count())
+
+        # Another type with the same height keeps derivatives after height of this one is changed
+        thumbnail_type_200px_copy = ThumbnailType.objects.create(
+            title='200px copy',
+            heigth_size_in_pixels=200,
+            is_original=False
+        )
+        self.thumbnail_type_200px.heigth_size_in_pixels = 150
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thumbnail_type_200px.save()
+        self.assertEqual(1, BlobDerivative.objects.filter(heigth=200).count())
+
+        thumbnail_type_200px_copy.quality = 50
+        with self.captureOnCommitCallbacks(execute=True):
+            thumbnail_type_200px_copy.save()
+        self.assertEqual(0, BlobDerivative.objects.count())
+
+    def test_thumbnails_of_account_tier(self):
+        self.account_tier_enterprise.allowed_image_types.add(self.thumbnail_type_original, self.thumbnail_type_200px)
+        self.client.force_authenticate(user=self.user_basic)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('upload'), data={'title': 'Book', 'image': self.new_file})
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual(0, Image.objects.filter(type=self.thumbnail_type_200px).count())
+
+        self.client.force_login(self.user_basic)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('profile'), data={
+                'account_tier': self.account_tier_enterprise.id,
+                'first_name': 'First',
+                'last_name': 'Last'
+            })
+        self.assertEqual(status.HTTP_302_FOUND, response.status_code)
+        original_image = Image.objects.get(type__is_original=True)
+        thumbnail = Image.objects.get(type=self.thumbnail_type_200px)
+        self.assertEqual(original_image.id, thumbnail.original_id)
+        self.assertEqual('Book(200px thumbnail)', thumbnail.title)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.client.post(reverse('profile'), data={
+                'account_tier': self.account_tier_basic.id,
+                'first_name': 'First',
+                'last_name': 'Last'
+            })
+        self.assertEqual(0, len(callbacks))
+        self.assertTrue(original_image.thumbnails.exists())
+
+    def test_thumbnails_of_account_tier_for_legacy_images(self):
+        self.account_tier_enterprise.allowed_image_types.add(self.thumbnail_type_original, self.thumbnail_type_200px)
+        # Images uploaded before thumbnails were linked to originals
+        original_image = Image.objects.create(
+            user=self.user_basic,
+            title='Book(original image)',
+            type=self.thumbnail_type_original,
+            image=self.new_file
+        )
+        thumbnail = Image.objects.create(
+            user=self.user_basic,
+            title='Book(200px thumbnail)',
+            type=self.thumbnail_type_200px,
+            image=self.new_file
+        )
+
+        self.client.force_login(self.user_basic)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('profile'), data={
+                'account_tier': self.account_tier_enterprise.id,
+                'first_name': 'First',
+                'last_name': 'Last'
+            })
+        self.assertEqual([thumbnail.id], list(Image.objects.filter(type=self.thumbnail_type_200px).values_list(
+            'id', flat=True
+        )))
+        self.assertEqual([thumbnail], list(original_image.thumbnails.all()))
+
+    def test_batch_upload(self):
+        self.account_tier_enterprise.allowed_image_types.add(self.thumbnail_type_200px)
+        url = reverse('upload_batch')
+        self.client.force_authenticate(user=self.user_enterprise)
+        files = [
+            SimpleUploadedFile(f'book_{number}.jpeg', open('api_app/tests/book.jpeg', 'rb').read(), 'image/jpeg')
+            for number in range(3)
+        ]
+        files.append(SimpleUploadedFile('broken.jpeg', b'not an image', 'image/jpeg'))
+        files.append(SimpleUploadedFile('document.txt', b'text', 'text/plain'))
+
+        response = self.client.post(url, data={'images': files}, format='multipart')
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual(
+            ['created', 'created', 'created', 'error', 'error'],
+            [result['status'] for result in response.data['results']]
+        )
+        self.assertEqual('book_1', response.data['results'][1]['title'])
+        self.assertEqual(
+            set(Image.objects.filter(type__is_original=True, user=self.user_enterprise).values_list('id', flat=True)),
+            {result['id'] for result in response.data['results'][:3]}
+        )
+        self.assertEqual(3, Image.objects.filter(
+            type=self.thumbnail_type_200px,
+            user=self.user_enterprise,
+            original__isnull=False
+        ).count())
+        for image in Image.objects.filter(user=self.user_enterprise):
+            self.assertTrue(os.path.exists(image.image.path))
+
+        response = self.client.post(url, data={'images': [files[3]]}, format='multipart')
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+        self.assertEqual(2, Blob.objects.count())
+
+        for file in files[:2]:
+            file.seek(0)
+        response = self.client.post(url, data={'images': files[:2]}, format='multipart')
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual([5, 5], list(Blob.objects.values_list('ref_count', flat=True)))
+        self.assertEqual(10, Image.objects.filter(user=self.user_enterprise).count())
+
+    def test_batch_upload_larger_than_burst(self):
+        url = reverse('upload_batch')
+        self.account_tier_enterprise.upload_rate = 5
+        self.account_tier_enterprise.upload_burst = 2
+        self.account_tier_enterprise.save()
+        self.client.force_authenticate(user=self.user_enterprise)
+        files = [
+            SimpleUploadedFile(f'book_{number}.jpeg', open('api_app/tests/book.jpeg', 'rb').read(), 'image/jpeg')
+            for number in range(3)
+        ]
+
+        response = self.client.post(url, data={'images': files}, format='multipart')
+        self.assertEqual(status.HTTP_429_TOO_MANY_REQUESTS, response.status_code)
+        self.assertNotIn('Retry-After', response)
+        self.assertEqual(0, Image.objects.count())
+
+        for file in files[:2]:
+            file.seek(0)
+        response = self.client.post(url, data={'images': files[:2]}, format='multipart')
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+
+    def test_image_status(self):
+        pending_image = Image.objects.create(
+                user=self.user_basic,
+                title='Test_pending_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file,
+                processing_status=Image.ProcessingStatus.PENDING
+            )
+        url = reverse('image_status', args=[pending_image.id])
+
+        self.client.force_authenticate(user=self.user_enterprise)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+        self.client.force_authenticate(user=self.user_basic)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual({'id': pending_image.id, 'processing_status': 'pending'}, response.data)
+
+    def test_render_image(self):
+        original_image = Image.objects.create(
+                user=self.user_basic,
+                title='Test_original_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        thumbnail_type_100px = ThumbnailType.objects.create(
+            title='100px',
+            heigth_size_in_pixels=100,
+            is_original=False
+        )
+        self.account_tier_basic.allowed_image_types.add(thumbnail_type_100px)
+        url = reverse('image_render', args=[original_image.id])
+        self.client.force_authenticate(user=self.user_basic)
+        render_cache_dir = tempfile.mkdtemp()
+
+        with override_settings(RENDER_CACHE_DIR=render_cache_dir):
+            response = self.client.get(url, {'h': 200})
+            self.assertEqual(status.HTTP_403_FORBIDDEN, response.status_code)
+
+            response = self.client.get(url, {'h': 100})
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            rendered_image = Img.open(BytesIO(response.content))
+            self.assertEqual(100, rendered_image.size[1])
+            cached_renders = [files for _, _, files in os.walk(render_cache_dir) if files]
+            self.assertEqual(1, len(cached_renders))
+
+            response = self.client.get(url, {'h': 100})
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            cached_image = Img.open(BytesIO(b''.join(response.streaming_content)))
+            self.assertEqual(rendered_image.tobytes(), cached_image.tobytes())
+
+            response = self.client.get(url, {'h': 100}, HTTP_ACCEPT='image/webp,*/*')
+            self.assertEqual('image/webp', response['Content-Type'])
+            self.assertEqual('Accept', response['Vary'])
+            self.assertEqual('WEBP', Img.open(BytesIO(response.content)).format)
+
+        shutil.rmtree(render_cache_dir, ignore_errors=True)
+        with override_settings(RENDER_CACHE_DIR=render_cache_dir, RENDER_CACHE_MAX_SIZE=0):
+            response = self.client.get(url, {'h': 100})
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual([], [files for _, _, files in os.walk(render_cache_dir) if files])
+
+        shutil.rmtree(render_cache_dir, ignore_errors=True)
 
     def test_create_exp_link_get(self):
 
@@ -135,10 +513,405 @@ class ImageApiTestCase(APITestCase):
         self.assertEqual(CreateExpiredLinkPermission.message, response.data['detail'])
 
         self.account_tier_basic.has_ability_create_expiry_link = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account_tier_basic.save()
         response = self.client.get(url)
         self.assertEqual(status.HTTP_405_METHOD_NOT_ALLOWED, response.status_code)
 
+    @override_settings(EXPIRY_LINKS_SIGNED=True, EXPIRY_LINKS_RECORD_SIGNED=False)
+    def test_signed_exp_link(self):
+        original_image = Image.objects.create(
+                user=self.user_enterprise,
+                title='Test_original_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        url = reverse('exp_link_create', args=[original_image.id])
+        self.client.force_authenticate(user=self.user_enterprise)
+
+        response = self.client.post(url, data={'user_exp_time_seconds': 300})
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual(0, ExpiredLink.objects.count())
+
+        link_path = response.data['expiry_link'].split('127.0.0.1:8000')[1]
+        with self.assertNumQueries(0):
+            response = self.client.get(link_path)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(self.new_file.open().read(), b''.join(response.streaming_content))
 
+        response = self.client.get(link_path.replace('/signed/', '/signed/x'))
+        self.assertEqual(b'Your link is incorrect :(', response.content)
 
+        token = sign_expiry_link(original_image, timezone.now() - timedelta(seconds=1))
+        response = self.client.get(reverse('show_image_by_signed_link', args=[token]))
+        self.assertEqual(b'Your link is expired :(', response.content)
 
+    def test_exp_link_streaming(self):
+        original_image = Image.objects.create(
+                user=self.user_enterprise,
+                title='Test_original_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        image_content = self.new_file.open().read()
+        url = reverse('exp_link_create', args=[original_image.id])
+        self.client.force_authenticate(user=self.user_enterprise)
+        response = self.client.post(url, data={'user_exp_time_seconds': 300})
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        link_path = response.data['expiry_link'].split('127.0.0.1:8000')[1]
+
+        response = self.client.get(link_path)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('image/jpeg', response['Content-Type'])
+        self.assertEqual(image_content, b''.join(response.streaming_content))
+        etag = response['ETag']
+
+        response = self.client.get(link_path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        response = self.client.get(link_path, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(status.HTTP_206_PARTIAL_CONTENT, response.status_code)
+        self.assertEqual(f'bytes 10-19/{len(image_content)}', response['Content-Range'])
+        self.assertEqual(image_content[10:20], b''.join(response.streaming_content))
+
+        response = self.client.get(link_path, HTTP_RANGE='bytes=-5')
+        self.assertEqual(image_content[-5:], b''.join(response.streaming_content))
+
+        response = self.client.get(link_path, HTTP_RANGE=f'bytes={len(image_content)}-')
+        self.assertEqual(status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE, response.status_code)
+
+        ExpiredLink.objects.update(expiry_date_time=timezone.now() - timedelta(seconds=1))
+        response = self.client.get(link_path)
+        self.assertEqual(b'Your link is expired :(', response.content)
+        self.assertEqual(0, ExpiredLink.objects.count())
+
+    def asgi_get(self, path, headers=()):
+        """Sending GET request through StreamingASGIHandler, returns (status, headers, body chunks)"""
+
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': path,
+            'query_string': b'',
+            'headers': [(name.encode(), value.encode()) for name, value in headers],
+            'server': ('testserver', 80),
+        }
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        try:
+            async_to_sync(StreamingASGIHandler())(scope, receive, send)
+        finally:
+            request_started.connect(close_old_connections)
+            request_finished.connect(close_old_connections)
+        return (
+            messages[0]['status'],
+            dict((name.decode(), value.decode()) for name, value in messages[0]['headers']),
+            [message.get('body', b'') for message in messages[1:]]
+        )
+
+    @mock.patch('app_with_ui.serving.CHUNK_SIZE', 1024)
+    def test_async_exp_link_streaming(self):
+        original_image = Image.objects.create(
+                user=self.user_enterprise,
+                title='Test_original_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        image_content = self.new_file.open().read()
+        url = reverse('exp_link_create', args=[original_image.id])
+        self.client.force_authenticate(user=self.user_enterprise)
+        response = self.client.post(url, data={'user_exp_time_seconds': 300})
+        link_path = response.data['expiry_link'].split('127.0.0.1:8000')[1]
+
+        status_code, headers, chunks = self.asgi_get(link_path)
+        self.assertEqual(status.HTTP_200_OK, status_code)
+        self.assertEqual('image/jpeg', headers['Content-Type'])
+        self.assertEqual(str(len(image_content)), headers['Content-Length'])
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(image_content, b''.join(chunks))
+
+        status_code, headers, chunks = self.asgi_get(link_path, [('range', 'bytes=10-19')])
+        self.assertEqual(status.HTTP_206_PARTIAL_CONTENT, status_code)
+        self.assertEqual(image_content[10:20], b''.join(chunks))
+
+        status_code, _, _ = self.asgi_get(link_path, [('if-none-match', headers['ETag'])])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, status_code)
+
+        with override_settings(MEDIA_OWNER_ONLY=True):
+            status_code, headers, _ = self.asgi_get(f'/media/{original_image.image.name}')
+        self.assertEqual(status.HTTP_302_FOUND, status_code)
+        self.assertTrue(headers['Location'].startswith('/login/'))
+
+        ExpiredLink.objects.update(expiry_date_time=timezone.now() - timedelta(seconds=1))
+        _, _, chunks = self.asgi_get(link_path)
+        self.assertEqual(b'Your link is expired :(', b''.join(chunks))
+        self.assertEqual(0, ExpiredLink.objects.count())
+
+    def test_webp_variant_negotiation(self):
+        self.thumbnail_type_200px.generate_webp = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thumbnail_type_200px.save()
+        self.account_tier_enterprise.allowed_image_types.add(self.thumbnail_type_200px)
+        self.client.force_authenticate(user=self.user_enterprise)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload'), data={'title': 'Book', 'image': self.new_file})
+        thumbnail = Image.objects.get(user=self.user_enterprise, type=self.thumbnail_type_200px)
+        url = reverse('exp_link_create', args=[thumbnail.id])
+        response = self.client.post(url, data={'user_exp_time_seconds': 300})
+        link_path = response.data['expiry_link'].split('127.0.0.1:8000')[1]
+
+        for accept, content_type in [
+            ('text/html,image/webp,*/*;q=0.8', 'image/webp'),
+            ('image/webp;q=0', 'image/jpeg'),
+            ('*/*', 'image/jpeg'),
+        ]:
+            response = self.client.get(link_path, HTTP_ACCEPT=accept)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertEqual(content_type, response['Content-Type'])
+            self.assertEqual('Accept', response['Vary'])
+            served_image = Img.open(BytesIO(b''.join(response.streaming_content)))
+            self.assertEqual(content_type.split('/')[1].upper(), served_image.format)
+
+        self.client.force_login(self.user_enterprise)
+        response = self.client.get(f'{thumbnail.image.url}?format=original', HTTP_ACCEPT='image/webp')
+        self.assertEqual('image/jpeg', response['Content-Type'])
+        self.assertEqual('private, max-age=31536000, immutable', response['Cache-Control'])
+
+    def test_media_offload(self):
+        original_image = Image.objects.create(
+                user=self.user_basic,
+                title='Test_original_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        url = original_image.image.url
+
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(self.new_file.open().read(), b''.join(response.streaming_content))
+
+        with override_settings(MEDIA_OWNER_ONLY=True):
+            response = self.client.get(url)
+            self.assertEqual(status.HTTP_302_FOUND, response.status_code)
+
+            self.client.force_login(self.user_enterprise)
+            response = self.client.get(url)
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+            self.client.logout()
+
+            self.user_basic.set_password('test')
+            self.user_basic.save()
+            credentials = base64.b64encode(b'user_basic:test').decode()
+            response = self.client.get(url, HTTP_AUTHORIZATION=f'Basic {credentials}')
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            response.close()
+            response = self.client.get(url, HTTP_AUTHORIZATION='Basic incorrect')
+            self.assertEqual(status.HTTP_401_UNAUTHORIZED, response.status_code)
+
+            self.client.force_login(self.user_basic)
+            response = self.client.get(url)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            response.close()
+
+        with override_settings(MEDIA_OFFLOAD='x-accel-redirect'):
+            response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(f'/protected-media/{original_image.image.name}', response['X-Accel-Redirect'])
+        self.assertEqual(b'', response.content)
+
+        with override_settings(MEDIA_OFFLOAD='x-sendfile'):
+            response = self.client.get(url)
+        self.assertEqual(original_image.image.path, response['X-Sendfile'])
+
+    def test_tier_policy_cache(self):
+        Image.objects.create(
+                user=self.user_basic,
+                title='Test_200px_image',
+                type=self.thumbnail_type_200px,
+                image=self.new_file
+            )
+        url = reverse('image_list')
+        self.client.force_authenticate(user=self.user_basic)
+
+        response = self.client.get(url)
+        self.assertEqual(0, len(response.data['results']))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account_tier_basic.allowed_image_types.add(self.thumbnail_type_200px)
+        response = self.client.get(url)
+        self.assertEqual(1, len(response.data['results']))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(1, len(response.json()['results']))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thumbnail_type_200px.delete()
+        response = self.client.get(url)
+        self.assertEqual(0, len(response.data['results']))
+
+        # Policy cached by concurrent request before commit of change is dropped after commit
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account_tier_basic.has_ability_create_expiry_link = True
+            self.account_tier_basic.save()
+            get_tier_policy(self.account_tier_basic.id)
+        self.assertIsNone(cache.get(TIER_POLICY_KEY.format(self.account_tier_basic.id)))
+
+    def test_image_list_conditional_get(self):
+        self.account_tier_basic.allowed_image_types.add(self.thumbnail_type_original)
+        url = reverse('image_list')
+        self.client.force_authenticate(user=self.user_basic)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('no-cache', response['Cache-Control'])
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image = Image.objects.create(
+                user=self.user_basic,
+                title='Test_original_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(1, len(response.data['results']))
+        etag = response['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.account_tier_basic.allowed_image_types.remove(self.thumbnail_type_original)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(0, len(response.data['results']))
+
+        self.client.force_login(self.user_basic)
+        response = self.client.get(reverse('all_images'))
+        response = self.client.get(reverse('all_images'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        response = self.client.get(image.image.url)
+        self.assertEqual('private, no-cache', response['Cache-Control'])
+
+    def test_image_list_cursor_pagination(self):
+        self.account_tier_basic.allowed_image_types.add(self.thumbnail_type_original)
+        upload_date = timezone.now()
+        for number in range(7):
+            image = Image.objects.create(
+                user=self.user_basic,
+                title=f'Test_image_{number}',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+            Image.objects.filter(id=image.id).update(upload_date=upload_date - timedelta(days=number // 2))
+
+        url = reverse('image_list')
+        self.client.force_authenticate(user=self.user_basic)
+        titles = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertLessEqual(len(response.data['results']), 3)
+            titles += [image['title'] for image in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(['Test_image_1', 'Test_image_0', 'Test_image_3', 'Test_image_2',
+                          'Test_image_5', 'Test_image_4', 'Test_image_6'], titles)
+
+        response = self.client.get(reverse('image_list'), {'cursor': 'incorrect'})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+        self.client.force_login(self.user_basic)
+        response = self.client.get(reverse('all_images'))
+        self.assertEqual(6, len(response.context['images']))
+        response = self.client.get(reverse('all_images'), {'cursor': response.context['next_cursor']})
+        self.assertEqual(['Test_image_6'], [image.title for image in response.context['images']])
+        self.assertIsNone(response.context['next_cursor'])
+
+    def test_image_list_page_cache(self):
+        self.account_tier_basic.allowed_image_types.add(self.thumbnail_type_original)
+        url = reverse('image_list')
+        self.client.force_authenticate(user=self.user_basic)
+        with self.captureOnCommitCallbacks(execute=True):
+            Image.objects.create(
+                user=self.user_basic,
+                title='Test_original_image',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        response = self.client.get(url)
+        self.assertEqual(1, len(response.data['results']))
+
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(url)
+        self.assertEqual(response.content, cached_response.content)
+        self.assertEqual('application/json', cached_response['Content-Type'])
+        self.assertEqual(response['ETag'], cached_response['ETag'])
+
+        response = self.client.get(url, HTTP_ACCEPT='text/html')
+        self.assertIn('text/html', response['Content-Type'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Image.objects.create(
+                user=self.user_basic,
+                title='Test_original_image_2',
+                type=self.thumbnail_type_original,
+                image=self.new_file
+            )
+        response = self.client.get(url)
+        self.assertEqual(2, len(response.data['results']))
+
+        self.client.force_login(self.user_basic)
+        self.client.get(reverse('all_images'))
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('all_images'))
+        self.assertEqual(2, len(response.context['images']))
+
+    def test_instrumentation(self):
+        self.account_tier_basic.allowed_image_types.add(self.thumbnail_type_original)
+        url = reverse('image_list')
+        self.client.force_authenticate(user=self.user_basic)
+
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        cache.clear()
+        with override_settings(INSTRUMENTATION_ENABLED=True):
+            response = self.client.get(url)
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            phases = [timing.split(';')[0] for timing in response['Server-Timing'].split(', ')]
+            self.assertEqual(['db', 'total'], phases)
+
+            response = self.client.get(reverse('metrics'))
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            self.assertIn(
+                'image_project_request_phase_duration_seconds_count{view="image_list",phase="db"}',
+                response.content.decode()
+            )
 
+            response = self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.1')
+            self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+    def test_histograms_are_shared_by_processes(self):
+        # Every process has its own Histograms, only the cache is shared
+        Histograms().observe('image_list', {'db': 0.003, 'total': 0.02})
+        Histograms().observe('image_list', {'db': 0.2, 'total': 20})
+
+        metrics = Histograms().render()
+        self.assertIn('_bucket{view="image_list",phase="db",le="0.005"} 1\n', metrics)
+        self.assertIn('_bucket{view="image_list",phase="db",le="0.25"} 2\n', metrics)
+        self.assertIn('_bucket{view="image_list",phase="total",le="10"} 1\n', metrics)
+        self.assertIn('_bucket{view="image_list",phase="total",le="+Inf"} 2\n', metrics)
+        self.assertIn('_sum{view="image_list",phase="total"} 20.020000\n', metrics)
+        self.assertIn('_count{view="image_list",phase="db"} 2\n', metrics)
@@ -0,0 +1,201 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+
+from django.apps import apps
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from api_app.tests import TEST_CACHES
+from app_with_ui.management.commands.backfill_thumbnails import BACKFILL_CHECKPOINT_KEY
+from app_with_ui.models import ThumbnailType, Image, User, Blob, AccountTier
+from app_with_ui.services import attach_blob, get_or_create_original_blob, create_thumbnails
+from app_with_ui.type_registry import thumbnail_type_registry
+from image_project.celery import app as celery_app
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BenchmarkCommandsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        thumbnail_type_registry.invalidate()
+        self.media_root = tempfile.mkdtemp()
+        media_root_override = override_settings(MEDIA_ROOT=self.media_root)
+        media_root_override.enable()
+        self.addCleanup(media_root_override.disable)
+        self.thumbnail_type_200px = ThumbnailType.objects.create(
+            title='200px',
+            heigth_size_in_pixels=200,
+            is_original=False
+        )
+
+    def test_bench_thumbnails(self):
+        out = StringIO()
+        call_command('bench_thumbnails', resolutions='64x48', formats='jpeg,png', types='1,2', repeat=2, stdout=out)
+        results = json.loads(out.getvalue())['benchmarks']
+
+        self.assertEqual(6, len(results))
+        self.assertEqual(2, results['resize_image[png 64x48, 2 types]']['runs'])
+        self.assertEqual(
+            {'runs', 'throughput_per_second', 'p50_ms', 'p95_ms', 'p99_ms', 'queries'},
+            set(results['get_original_image_size[jpeg 64x48]'])
+        )
+        self.assertEqual(200, ThumbnailType.objects.get(id=self.thumbnail_type_200px.id).heigth_size_in_pixels)
+
+    def test_bench_api(self):
+        baseline_path = os.path.join(tempfile.mkdtemp(), 'baseline.json')
+        call_command('bench_api', resolution='64x48', repeat=2, save_baseline=baseline_path, stdout=StringIO())
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        self.assertEqual({'CreateImage', 'ImageListView', 'ExpiredLinkCreateView'}, set(baseline['benchmarks']))
+        self.assertEqual(0, User.objects.count())
+        self.assertEqual(0, Image.objects.count())
+
+        baseline['benchmarks']['ImageListView']['queries'] = 0
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(baseline, baseline_file)
+        with self.assertRaises(CommandError):
+            call_command('bench_api', resolution='64x48', repeat=2, baseline=baseline_path, stdout=StringIO())
+        shutil.rmtree(os.path.dirname(baseline_path), ignore_errors=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RelocateMediaCommandTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.user = User.objects.create(username='user_basic', password='test')
+        self.image_content = open('api_app/tests/book.jpeg', 'rb').read()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_relocate_media(self):
+        old_path = os.path.join(self.media_root, 'user_basic', 'Original image', 'book.jpeg')
+        os.makedirs(os.path.dirname(old_path))
+        with open(old_path, 'wb') as old_file:
+            old_file.write(self.image_content)
+        image = Image.objects.create(user=self.user, title='Book', image='user_basic/Original image/book.jpeg')
+        missing_image = Image.objects.create(user=self.user, title='Missing', image='user_basic/Original image/x.jpeg')
+
+        with override_settings(MEDIA_ROOT=self.media_root):
+            out = StringIO()
+            call_command('relocate_media', batch_size=1, stdout=out, stderr=StringIO())
+            self.assertIn('Relocated files of 1 images, files of 1 images are missing', out.getvalue())
+
+            image.refresh_from_db()
+            self.assertTrue(image.image.name.startswith('blobs/'))
+            self.assertEqual(self.image_content, image.image.read())
+            self.assertEqual(1, Blob.objects.get(id=image.blob_id).ref_count)
+            self.assertEqual((286, 176), (image.blob.width, image.blob.height))
+            self.assertFalse(os.path.exists(old_path))
+            self.assertIsNone(Image.objects.get(id=missing_image.id).blob)
+
+            out = StringIO()
+            call_command('relocate_media', stdout=out, stderr=StringIO())
+            self.assertIn('Relocated files of 0 images', out.getvalue())
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BackfillThumbnailsCommandTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        thumbnail_type_registry.invalidate()
+        self.media_root = tempfile.mkdtemp()
+        self.user = User.objects.create(username='user_basic', password='test')
+        self.thumbnail_type_original = ThumbnailType.objects.create(title='Original image', is_original=True)
+        self.thumbnail_type_50px = ThumbnailType.objects.create(
+            title='50px',
+            heigth_size_in_pixels=50,
+            is_original=False
+        )
+        self.account_tier = AccountTier.objects.create(title='Basic')
+        self.account_tier.allowed_image_types.add(self.thumbnail_type_50px)
+        self.user.account_tier = self.account_tier
+        self.user.save()
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def create_original_image(self, title):
+        new_file = SimpleUploadedFile('book.jpeg', open('api_app/tests/book.jpeg', 'rb').read(), 'image/jpeg')
+        original_image = Image(user=self.user, title=title, type=self.thumbnail_type_original)
+        attach_blob(original_image, get_or_create_original_blob(new_file))
+        original_image.save()
+        create_thumbnails(original_image, title)
+        return original_image
+
+    def test_backfill_thumbnails(self):
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+        with override_settings(MEDIA_ROOT=self.media_root):
+            original_images = [self.create_original_image(f'Book_{index}') for index in range(3)]
+            thumbnail_type_100px = ThumbnailType.objects.create(
+                title='100px',
+                heigth_size_in_pixels=100,
+                is_original=False,
+                generate_webp=True
+            )
+            self.account_tier.allowed_image_types.add(thumbnail_type_100px)
+            cache.set(BACKFILL_CHECKPOINT_KEY.format(thumbnail_type_100px.id), original_images[0].id)
+
+            out = StringIO()
+            call_command('backfill_thumbnails', type=thumbnail_type_100px.id, chunk_size=1, stdout=out)
+            self.assertIn('Created 2 thumbnails', out.getvalue())
+            self.assertEqual(
+                [original_images[1].id, original_images[2].id],
+                list(Image.objects.filter(type=thumbnail_type_100px).order_by('id').values_list('original', flat=True))
+            )
+            self.assertIsNone(cache.get(BACKFILL_CHECKPOINT_KEY.format(thumbnail_type_100px.id)))
+            thumbnail = Image.objects.filter(type=thumbnail_type_100px).first()
+            self.assertEqual(100, thumbnail.height)
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, f'{thumbnail.image.name}.webp')))
+
+            out = StringIO()
+            call_command('backfill_thumbnails', type=thumbnail_type_100px.id, celery=True, parallel=2, stdout=out)
+            self.assertIn('Created 1 thumbnails', out.getvalue())
+            self.assertEqual(3, Image.objects.filter(type=thumbnail_type_100px).count())
+            self.assertEqual(3, Image.objects.filter(type=self.thumbnail_type_50px).count())
+            # Thumbnail of the same content was made once
+            self.assertEqual(3, Blob.objects.count())
+
+            with self.assertRaises(CommandError):
+                call_command('backfill_thumbnails', type=self.thumbnail_type_original.id, stdout=StringIO())
+
+    def test_link_legacy_thumbnails(self):
+        upload_date = timezone.now()
+        images = []
+        for index, (title, image_type) in enumerate([
+            ('Book(original image)', self.thumbnail_type_original),
+            ('Book(50px thumbnail)', self.thumbnail_type_50px),
+            ('Book', self.thumbnail_type_original),
+            ('Book(50px thumbnail)', self.thumbnail_type_50px),
+            ('Other(50px thumbnail)', self.thumbnail_type_50px),
+        ]):
+            image = Image.objects.create(user=self.user, title=title, type=image_type, image=f'user_basic/{index}.jpeg')
+            Image.objects.filter(id=image.id).update(upload_date=upload_date + timedelta(seconds=index))
+            images.append(image)
+
+        import_module('app_with_ui.migrations.0014_link_legacy_thumbnails').link_legacy_thumbnails(apps, None)
+        self.assertEqual(
+            [None, images[0].id, None, images[2].id, None],
+            [Image.objects.get(id=image.id).original_id for image in images]
+        )
+
+        out = StringIO()
+        call_command('backfill_thumbnails', type=self.thumbnail_type_50px.id, stdout=out)
+        self.assertIn('Created 0 thumbnails', out.getvalue())
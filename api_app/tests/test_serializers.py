@@ -1,16 +1,24 @@
 import shutil
 from collections import OrderedDict
 
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
 
-from api_app.serializers import ImageSerializer, ImageListSerializer
+from api_app.tests import TEST_CACHES
+from api_app.serializers import ImageSerializer, ImageListSerializer, serialize_image_list
 from app_with_ui.models import ThumbnailType, AccountTier, User, Image
+from app_with_ui.type_registry import thumbnail_type_registry
 
 
+@override_settings(CACHES=TEST_CACHES)
 class ImageSerializerTestCase(TestCase):
 
     def setUp(self):
+        cache.clear()
+        thumbnail_type_registry.invalidate()
         self.thumbnail_type_original = ThumbnailType.objects.create(
             title='Original image',
             is_original=True
@@ -57,11 +65,11 @@ class ImageSerializerTestCase(TestCase):
         expected_data = {
             'id': 1,
             'title': 'Test_original_image',
-            'image': '/media/user_basic/Original%20image/test_image.jpg'
+            'image': f'/media/{original_image.image.name}'
         }
         self.assertEqual(data, expected_data)
 
-        shutil.rmtree('media/user_basic', ignore_errors=True)
+        shutil.rmtree('media/uploads', ignore_errors=True)
 
     def test_image_list_serializer(self):
 
@@ -77,8 +85,30 @@ class ImageSerializerTestCase(TestCase):
         expected_data = {
             'title': 'Test_original_image',
             'id': 1,
-            'image': '/media/user_enterprise/Original%20image/test_image.jpg',
+            'image': f'/media/{original_image.image.name}',
             'type': OrderedDict([('title', 'Original image'), ('heigth_size_in_pixels', None)])
         }
         self.assertEqual(data, expected_data)
-        shutil.rmtree('media/user_enterprise', ignore_errors=True)
+        shutil.rmtree('media/uploads', ignore_errors=True)
+
+    def test_serialize_image_list(self):
+        for thumbnail_type in [self.thumbnail_type_original, self.thumbnail_type_200px]:
+            Image.objects.create(
+                user=self.user_basic,
+                title=f'Test_{thumbnail_type.title}_image',
+                type=thumbnail_type,
+                image=self.new_file
+            )
+        Image.objects.filter(type=self.thumbnail_type_200px).update(type=None)
+        images = Image.objects.select_related('type').order_by('id')
+        request = APIRequestFactory().get('/api/v1/images/')
+
+        self.assertEqual(
+            JSONRenderer().render(ImageListSerializer(images, many=True, context={'request': request}).data),
+            JSONRenderer().render(serialize_image_list(images, request))
+        )
+        self.assertEqual(
+            JSONRenderer().render(ImageListSerializer(images, many=True).data),
+            JSONRenderer().render(serialize_image_list(images))
+        )
+        shutil.rmtree('media/uploads', ignore_errors=True)
@@ -0,0 +1,267 @@
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image as Img
+
+from api_app.tests import TEST_CACHES
+from app_with_ui.image_pool import ImagePool, ImagePoolBusy
+from app_with_ui.models import ThumbnailType, User, Image, ExpiredLink, Blob, AccountTier
+from app_with_ui.render_cache import store_render, get_cached_render
+from app_with_ui.services import resize_image, attach_blob, get_or_create_original_blob, create_thumbnails, \
+    encode_image_content, split_into_chains
+from app_with_ui.tasks import delete_expired_images
+from app_with_ui.type_registry import thumbnail_type_registry, THUMBNAIL_TYPES_VERSION_KEY
+from image_project.celery import app as celery_app
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ResizeImageTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        thumbnail_type_registry.invalidate()
+        # Derivatives of changed thumbnail types are deleted by task
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', celery_app.conf.task_always_eager)
+        celery_app.conf.task_always_eager = True
+        self.thumbnail_type_original = ThumbnailType.objects.create(
+            title='Original image',
+            is_original=True
+        )
+        self.thumbnail_type_50px = ThumbnailType.objects.create(
+            title='50px',
+            heigth_size_in_pixels=50,
+            is_original=False
+        )
+        self.thumbnail_type_100px = ThumbnailType.objects.create(
+            title='100px',
+            heigth_size_in_pixels=100,
+            is_original=False
+        )
+
+        self.new_file = SimpleUploadedFile(
+            name='test_image.jpg',
+            content=open('api_app/tests/book.jpeg', 'rb').read(),
+            content_type='image/jpeg'
+        )
+
+    def test_resize_image(self):
+        thumbnails = resize_image(self.new_file)
+
+        self.assertEqual(2, len(thumbnails))
+        self.assertEqual(
+            [self.thumbnail_type_100px, self.thumbnail_type_50px],
+            [thumbnail_type for _, thumbnail_type, _, _ in thumbnails]
+        )
+        for thumbnail_image, thumbnail_type, width, height in thumbnails:
+            work_image = Img.open(thumbnail_image)
+            self.assertEqual('JPEG', work_image.format)
+            self.assertEqual(thumbnail_type.heigth_size_in_pixels, work_image.size[1])
+            self.assertEqual((int(height * (286 / 176)), height), (width, height))
+
+    def test_resize_image_uses_thumbnail_type_registry(self):
+        resize_image(self.new_file)
+        self.new_file.seek(0)
+        with self.assertNumQueries(0):
+            resize_image(self.new_file)
+
+        ThumbnailType.objects.filter(id=self.thumbnail_type_50px.id).update(heigth_size_in_pixels=40)
+        cache.set(THUMBNAIL_TYPES_VERSION_KEY, 'changed_by_another_process')
+        self.new_file.seek(0)
+        thumbnails = resize_image(self.new_file)
+        self.assertEqual([100, 40], [height for _, _, _, height in thumbnails])
+
+    def test_resize_image_in_image_pool(self):
+        with override_settings(IMAGE_POOL_WORKERS=0):
+            serial_thumbnails = resize_image(self.new_file)
+        self.new_file.seek(0)
+        with override_settings(IMAGE_POOL_WORKERS=2):
+            thumbnails = resize_image(self.new_file)
+
+        self.assertEqual(
+            [(thumbnail_type, width, height) for _, thumbnail_type, width, height in serial_thumbnails],
+            [(thumbnail_type, width, height) for _, thumbnail_type, width, height in thumbnails]
+        )
+        for thumbnail_image, thumbnail_type, _, _ in thumbnails:
+            self.assertEqual(thumbnail_type.heigth_size_in_pixels, Img.open(thumbnail_image).size[1])
+
+    def test_split_into_chains(self):
+        self.assertEqual([[400, 350, 300], [250, 200]], split_into_chains([400, 350, 300, 250, 200], 2))
+        self.assertEqual([[400], [350]], split_into_chains([400, 350], 8))
+
+    @override_settings(IMAGE_POOL_WORKERS=1, IMAGE_POOL_MAX_PENDING=1, IMAGE_POOL_SUBMIT_TIMEOUT=0)
+    def test_image_pool_backpressure(self):
+        pool = ImagePool()
+        future = pool.submit(time.sleep, 0.5)
+        with self.assertRaises(ImagePoolBusy):
+            pool.submit(time.sleep, 0)
+        future.result()
+        self.assertEqual([None], pool.map(time.sleep, [(0,)]))
+
+    def test_resize_image_with_encoding_profile(self):
+        default_size = len(resize_image(self.new_file)[0][0].read())
+        self.thumbnail_type_100px.progressive = True
+        self.thumbnail_type_100px.strip_metadata = True
+        self.thumbnail_type_100px.max_bytes = default_size // 2
+        with self.captureOnCommitCallbacks(execute=True):
+            self.thumbnail_type_100px.save()
+
+        self.new_file.seek(0)
+        thumbnail_image = resize_image(self.new_file)[0][0]
+        content = thumbnail_image.read()
+        self.assertLessEqual(len(content), default_size // 2)
+        work_image = Img.open(BytesIO(content))
+        self.assertTrue(work_image.info.get('progressive'))
+        self.assertNotIn('exif', work_image.info)
+
+    def test_encode_image_content_max_bytes(self):
+        work_image = Img.effect_noise((200, 200), 100).convert('RGB')
+        profile = ThumbnailType(max_bytes=8000).get_encoding_profile()
+
+        content = encode_image_content(work_image, 'jpeg', profile)
+        self.assertLessEqual(len(content), 8000)
+        self.assertGreater(len(content), 4000)
+
+        profile['max_bytes'] = 10
+        self.assertEqual(
+            len(encode_image_content(work_image, 'jpeg', dict(profile, quality=1, max_bytes=None))),
+            len(encode_image_content(work_image, 'jpeg', profile))
+        )
+
+    def test_resize_image_without_thumbnail_types(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ThumbnailType.objects.filter(is_original=False).delete()
+
+        self.assertEqual([], resize_image(self.new_file))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class DeleteExpiredImagesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        thumbnail_type_registry.invalidate()
+        self.media_root = tempfile.mkdtemp()
+        self.user = User.objects.create(username='user_basic', password='test')
+        self.image = Image.objects.create(user=self.user, title='Test_image', image='user_basic/test_image.jpg')
+        self.active_link = ExpiredLink.objects.create(
+            user=self.user,
+            image=self.image,
+            title='Active link',
+            user_exp_time_seconds=300,
+            expiry_date_time=timezone.now() + timedelta(seconds=300)
+        )
+        for _ in range(3):
+            ExpiredLink.objects.create(
+                user=self.user,
+                image=self.image,
+                title='Expired link',
+                user_exp_time_seconds=300,
+                expiry_date_time=timezone.now() - timedelta(seconds=300)
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_delete_expired_images(self):
+        user_temp_dir = os.path.join(self.media_root, 'temp', 'user_basic')
+        for link_dir in [str(self.active_link.uuid_link), 'orphan_1', 'orphan_2']:
+            os.makedirs(os.path.join(user_temp_dir, link_dir))
+
+        with override_settings(MEDIA_ROOT=self.media_root):
+            result = delete_expired_images(batch_size=2)
+            self.assertEqual({'deleted_links': 3, 'removed_dirs': 1, 'deleted_blobs': 0}, result)
+            self.assertEqual([self.active_link], list(ExpiredLink.objects.all()))
+
+            result = delete_expired_images(batch_size=2)
+            self.assertEqual({'deleted_links': 0, 'removed_dirs': 1, 'deleted_blobs': 0}, result)
+            self.assertEqual([str(self.active_link.uuid_link)], os.listdir(user_temp_dir))
+
+            result = delete_expired_images(batch_size=2, time_budget_seconds=0)
+            self.assertEqual({'deleted_links': 0, 'removed_dirs': 0, 'deleted_blobs': 0}, result)
+
+    def test_delete_unreferenced_blobs(self):
+        thumbnail_type = ThumbnailType.objects.create(title='50px', heigth_size_in_pixels=50, is_original=False)
+        self.user.account_tier = AccountTier.objects.create(title='Basic')
+        self.user.account_tier.allowed_image_types.add(thumbnail_type)
+        self.user.save()
+        new_file = SimpleUploadedFile('book.jpeg', open('api_app/tests/book.jpeg', 'rb').read(), 'image/jpeg')
+        with override_settings(MEDIA_ROOT=self.media_root):
+            original_image = Image(user=self.user, title='Book')
+            attach_blob(original_image, get_or_create_original_blob(new_file))
+            original_image.save()
+            create_thumbnails(original_image, 'Book')
+            blob_files = [os.path.join(self.media_root, name) for name in Blob.objects.values_list('file', flat=True)]
+            self.assertEqual(2, len(blob_files))
+
+            with override_settings(BLOB_GRACE_SECONDS=0):
+                self.assertEqual(0, delete_expired_images()['deleted_blobs'])
+                Image.objects.filter(type=thumbnail_type).delete()
+                self.assertEqual(0, delete_expired_images()['deleted_blobs'])
+                original_image.delete()
+                self.assertEqual(2, delete_expired_images()['deleted_blobs'])
+            self.assertFalse(any(os.path.exists(blob_file) for blob_file in blob_files))
+
+    def test_found_blob_is_kept_from_cleanup(self):
+        new_file = SimpleUploadedFile('book.jpeg', open('api_app/tests/book.jpeg', 'rb').read(), 'image/jpeg')
+        with override_settings(MEDIA_ROOT=self.media_root, BLOB_GRACE_SECONDS=60):
+            blob = get_or_create_original_blob(new_file)
+            Blob.objects.filter(id=blob.id).update(unreferenced_at=timezone.now() - timedelta(hours=1))
+
+            new_file.seek(0)
+            self.assertEqual(blob, get_or_create_original_blob(new_file))
+            self.assertEqual(0, delete_expired_images()['deleted_blobs'])
+
+            Blob.objects.filter(id=blob.id).update(unreferenced_at=timezone.now() - timedelta(hours=1))
+            self.assertEqual(1, delete_expired_images()['deleted_blobs'])
+            new_file.seek(0)
+            self.assertNotEqual(blob.id, get_or_create_original_blob(new_file).id)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RenderCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.render_cache_dir = tempfile.mkdtemp()
+        user = User.objects.create(username='user', password='test')
+        image_type = ThumbnailType.objects.create(title='Original image', is_original=True)
+        self.images = [
+            Image.objects.create(user=user, title=f'Image {number}', type=image_type, image=f'uploads/{number}.jpg')
+            for number in range(5)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.render_cache_dir, ignore_errors=True)
+
+    def test_eviction_down_to_low_water_size(self):
+        with override_settings(
+            RENDER_CACHE_DIR=self.render_cache_dir,
+            RENDER_CACHE_MAX_SIZE=400,
+            RENDER_CACHE_LOW_WATER_SIZE=200
+        ):
+            with mock.patch('app_with_ui.render_cache.evict_renders') as evict_renders:
+                for image in self.images[:4]:
+                    store_render(image, 100, 'jpeg', b'x' * 100)
+                store_render(self.images[0], 100, 'jpeg', b'x' * 100)
+            # Cache is not scanned while total is under max size, replaced render is not counted twice
+            evict_renders.assert_not_called()
+
+            for number, image in enumerate(self.images[:4]):
+                with get_cached_render(image, 100, 'jpeg') as render_file:
+                    os.utime(render_file.name, (number, number))
+            store_render(self.images[4], 100, 'jpeg', b'x' * 100)
+            self.assertEqual(
+                [None, None, None],
+                [get_cached_render(image, 100, 'jpeg') for image in self.images[:3]]
+            )
+            for image in self.images[3:]:
+                get_cached_render(image, 100, 'jpeg').close()
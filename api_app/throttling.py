@@ -0,0 +1,48 @@
+from contextlib import ExitStack
+
+from rest_framework.exceptions import Throttled
+
+from api_app.exceptions import ThumbnailBacklogIsFull
+from app_with_ui.rate_limit import admit_request, RequestIsNotAdmitted
+
+
+class APIAdmissionControlMixin:
+    """
+    Admission control of POST requests of API views by admit_request, like AdmissionControlMixin of UI views:
+    rejected request gets 429 (limits of account tier) or 503 (load shedding) response with Retry-After.
+    It is checked after permissions, like throttles, and taken slot of concurrent requests is released after response
+    """
+
+    admission_scope = None
+    limit_concurrency = False
+    shed_load = False
+
+    def get_admission_cost(self, request):
+        return 1
+
+    def check_throttles(self, request):
+        super().check_throttles(request)
+        if request.method != 'POST':
+            return
+        admission = ExitStack()
+        try:
+            admission.enter_context(admit_request(
+                request.user,
+                self.admission_scope,
+                cost=self.get_admission_cost(request),
+                limit_concurrency=self.limit_concurrency,
+                shed_load=self.shed_load
+            ))
+        except RequestIsNotAdmitted as exc:
+            if exc.status_code == 503:
+                raise ThumbnailBacklogIsFull(wait=exc.wait)
+            # Message is sent only when waiting does not help, otherwise DRF tells when to retry
+            raise Throttled(wait=exc.wait, detail=exc.message if exc.wait is None else None)
+        request.admission = admission
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        admission = getattr(request, 'admission', None)
+        if admission is not None:
+            admission.close()
+            request.admission = None
+        return super().finalize_response(request, response, *args, **kwargs)
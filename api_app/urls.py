@@ -1,10 +1,14 @@
 from django.urls import path
 
-from api_app.views import CreateImage, ImageListView, ExpiredLinkCreateView
+from api_app.views import CreateImage, ImageListView, ExpiredLinkCreateView, ImageStatusView, \
+    ImageRenderView, BatchUploadView
 
 urlpatterns = [
     path('upload/', CreateImage.as_view(), name='upload'),
+    path('upload/batch/', BatchUploadView.as_view(), name='upload_batch'),
     path('images/', ImageListView.as_view(), name='image_list'),
+    path('images/<int:pk>/status/', ImageStatusView.as_view(), name='image_status'),
+    path('images/<int:pk>/render', ImageRenderView.as_view(), name='image_render'),
     path('exp_link_create/<int:pk>/', ExpiredLinkCreateView.as_view(), name='exp_link_create'),
 
 ]
\ No newline at end of file
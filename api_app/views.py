@@ -1,50 +1,133 @@
-from rest_framework import generics
+import uuid
+from collections import OrderedDict
+
+from rest_framework import generics, status
 from rest_framework.generics import CreateAPIView
 from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-from rest_framework.pagination import PageNumberPagination
-
-from api_app.exceptions import ImageDoesNotExist, OriginalImageTypeDoesNotExist
-from app_with_ui.models import Image, ThumbnailType
+from django.db import transaction
+from django.http import FileResponse, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers, get_conditional_response
+from rest_framework.exceptions import PermissionDenied, ValidationError, NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.views import APIView
+
+from api_app.exceptions import ImageDoesNotExist, OriginalImageTypeDoesNotExist, ImageProcessingIsBusy
+from app_with_ui.models import Image, ExpiredLink
 from api_app.permissions import CreateExpiredLinkPermission, HasUserAccountTier
-from api_app.serializers import ImageListSerializer, ExpiredLinkCreateSerializer, ImageSerializer
-from app_with_ui.services import resize_image, set_link_expiring_datetime, get_base64_encode_image, \
-    get_original_image_size
-from image_project.settings import domain_and_port_for_link
+from api_app.serializers import ImageListSerializer, ExpiredLinkCreateSerializer, ImageSerializer, \
+    ImageStatusSerializer, serialize_image_list
+from api_app.throttling import APIAdmissionControlMixin
+from app_with_ui.image_pool import ImagePoolBusy
+from app_with_ui.list_cache import get_image_list_version, get_image_list_etag, get_cached_page, store_cached_page, \
+    patch_image_list_response
+from app_with_ui.pagination import get_keyset_page
+from app_with_ui.render_cache import get_cached_render, store_render
+from app_with_ui.serving import accepts_webp
+from app_with_ui.services import set_link_expiring_datetime, get_or_create_original_blob, get_image_format, \
+    render_thumbnail, get_expiry_link, is_expiry_link_recorded, create_images_batch
+from app_with_ui.tasks import generate_thumbnails
+from app_with_ui.tier_cache import get_tier_policy
+from app_with_ui.type_registry import thumbnail_type_registry
+
+
+class ImageListPagination(BasePagination):
+    """Keyset pagination by (upload_date, id), see app_with_ui.pagination.get_keyset_page"""
 
+    page_size = 3
+    cursor_query_param = 'cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        try:
+            images, self.next_cursor = get_keyset_page(
+                queryset, request.query_params.get(self.cursor_query_param), self.page_size
+            )
+        except ValueError:
+            raise NotFound('Invalid cursor')
+        return images
 
-class ImageListPagination(PageNumberPagination):
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
 
-    page_size = 3
-    page_query_param = 'page'
-    max_page_size = 10
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
 
 
-class CreateImage(CreateAPIView):
+class CreateImage(APIAdmissionControlMixin, CreateAPIView):
     """Allows to upload image by POST request to 'upload/' """
 
     serializer_class = ImageSerializer
     permission_classes = [IsAuthenticated]
+    admission_scope = 'upload'
+    limit_concurrency = True
+    shed_load = True
 
     def perform_create(self, serializer):
-        try:
-            image_type = ThumbnailType.objects.get(is_original=True)
-        except ObjectDoesNotExist:
+        image_type = thumbnail_type_registry.get_original_type()
+        if image_type is None:
             raise OriginalImageTypeDoesNotExist
-        _serializer = serializer.save(user=self.request.user, type=image_type)
-        _serializer.width, _serializer.height = get_original_image_size(_serializer.image)
-        _serializer.save()
-        thumbnails_height_sizes_and_types = resize_image(_serializer.image)
-        for size_and_type in thumbnails_height_sizes_and_types:
-            new_thumbnail_image, new_thumbnail_type, width, height = size_and_type
-            Image.objects.create(
-                image=new_thumbnail_image,
-                type=new_thumbnail_type,
-                user=self.request.user,
-                title=f'{_serializer.title}({height}px thumbnail)',
-                width=width,
-                height=height
-            )
+        blob = get_or_create_original_blob(serializer.validated_data['image'])
+        _serializer = serializer.save(
+            user=self.request.user,
+            type=image_type,
+            processing_status=Image.ProcessingStatus.PENDING,
+            blob=blob,
+            image=blob.file.name,
+            width=blob.width,
+            height=blob.height
+        )
+        transaction.on_commit(lambda: generate_thumbnails.delay(_serializer.id, _serializer.title))
+
+
+class BatchUploadView(APIAdmissionControlMixin, APIView):
+    """
+    Allows to upload many images in one multipart POST request to 'upload/batch/' (files are sent in 'images' field).
+    Thumbnails are made at once and all rows are inserted in one transaction. Response contains result for every file
+    """
+
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser]
+    admission_scope = 'upload'
+    limit_concurrency = True
+    shed_load = True
+
+    def get_admission_cost(self, request):
+        # Every file of batch takes a token, so batch with more files than burst is never allowed
+        return max(len(request.FILES.getlist('images')), 1)
+
+    def post(self, request, *args, **kwargs):
+        uploaded_files = request.FILES.getlist('images')
+        if not uploaded_files:
+            raise ValidationError({'images': 'No files were sent'})
+        if len(uploaded_files) > settings.BATCH_UPLOAD_MAX_FILES:
+            raise ValidationError({'images': f'Max number of files in one request is {settings.BATCH_UPLOAD_MAX_FILES}'})
+        image_type = thumbnail_type_registry.get_original_type()
+        if image_type is None:
+            raise OriginalImageTypeDoesNotExist
+
+        results = []
+        for uploaded_file, image, error in create_images_batch(request.user, image_type, uploaded_files):
+            if error is not None:
+                results.append({'file': uploaded_file.name, 'status': 'error', 'error': error})
+            else:
+                results.append({'file': uploaded_file.name, 'status': 'created', 'id': image.id, 'title': image.title})
+        created = any(result['status'] == 'created' for result in results)
+        return Response(
+            {'results': results},
+            status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST
+        )
 
 
 class ImageListView(generics.ListAPIView):
@@ -56,17 +139,95 @@ class ImageListView(generics.ListAPIView):
 
     def get_queryset(self):
 
+        tier_policy = get_tier_policy(self.request.user.account_tier_id)
         return Image.objects.filter(
             user=self.request.user,
-            type__in=self.request.user.account_tier.allowed_image_types.all()
+            type__in=tier_policy['allowed_image_type_ids']
+        ).select_related('type').only(
+            'id', 'title', 'image', 'upload_date', 'type__title', 'type__heigth_size_in_pixels'
         )
 
+    def list(self, request, *args, **kwargs):
+        """
+        Query is not run at all if client has current version of page (ETag from generation of user's images).
+        JSON pages are cached as rendered bytes by version of page
+        """
+
+        version = get_image_list_version(request, get_tier_policy(request.user.account_tier_id))
+        etag = get_image_list_etag(version)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = self.get_page_response(version)
+        patch_image_list_response(response, etag)
+        return response
+
+    def get_page_response(self, version):
+        """Cached JSON page is sent as is, otherwise page is rendered and stored after rendering"""
+
+        is_json = isinstance(self.request.accepted_renderer, JSONRenderer)
+        content = get_cached_page(version) if is_json else None
+        if content is not None:
+            return HttpResponse(content, content_type=self.request.accepted_renderer.media_type)
+
+        images = self.paginate_queryset(self.get_queryset())
+        response = self.get_paginated_response(serialize_image_list(images, self.request))
+        if is_json:
+            response.add_post_render_callback(lambda rendered: store_cached_page(version, rendered.content))
+        return response
 
-class ExpiredLinkCreateView(CreateAPIView):
+
+class ImageStatusView(generics.RetrieveAPIView):
+    """Allows to poll thumbnails processing status of uploaded image by GET request to 'images/<image_id>/status/' """
+
+    permission_classes = [IsAuthenticated]
+    serializer_class = ImageStatusSerializer
+
+    def get_queryset(self):
+        return Image.objects.filter(user=self.request.user)
+
+
+class ImageRenderView(APIView):
+    """
+    Allows to get thumbnail of original image rendered on demand by GET request to 'images/<image_id>/render?h=<height>'.
+    Height must be allowed by user's account tier. Thumbnail is encoded with profile of thumbnail type of this height.
+    Rendered thumbnails are stored in disk cache.
+    Thumbnail is rendered in WebP if client accepts it
+    """
+
+    permission_classes = [IsAuthenticated, HasUserAccountTier]
+
+    def get(self, request, *args, **kwargs):
+        try:
+            heigth = int(request.query_params['h'])
+        except (KeyError, ValueError):
+            raise ValidationError({'h': 'Height of thumbnail must be passed as integer'})
+        if heigth not in get_tier_policy(request.user.account_tier_id)['allowed_heights']:
+            raise PermissionDenied("User's account tier does not include thumbnails of this height")
+
+        image = get_object_or_404(Image, id=self.kwargs['pk'], user=request.user, type__is_original=True)
+        image_format = 'webp' if accepts_webp(request) else get_image_format(image.image)
+        content_type = f'image/{image_format}'
+        profile = thumbnail_type_registry.get_encoding_profile(heigth)
+        render_file = get_cached_render(image, heigth, image_format, profile)
+        if render_file is not None:
+            response = FileResponse(render_file, content_type=content_type)
+        else:
+            try:
+                content = render_thumbnail(image.image, heigth, image_format, profile)
+            except ImagePoolBusy:
+                raise ImageProcessingIsBusy
+            store_render(image, heigth, image_format, content, profile)
+            response = HttpResponse(content, content_type=content_type)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+
+class ExpiredLinkCreateView(APIAdmissionControlMixin, CreateAPIView):
     """Allows to generate expiry link by POST request to 'exp_link_create/<image_id>/' """
 
     serializer_class = ExpiredLinkCreateSerializer
     permission_classes = [IsAuthenticated, CreateExpiredLinkPermission]
+    admission_scope = 'link'
 
     def perform_create(self, serializer):
         try:
@@ -77,14 +238,17 @@ class ExpiredLinkCreateView(CreateAPIView):
         user_exp_time_seconds = serializer.validated_data['user_exp_time_seconds']
         link_exp_datetime = set_link_expiring_datetime(user_exp_time_seconds)
         title = f'{image.title}_{image.type.title}_expiry'
-        image_base_64 = get_base64_encode_image(image.image.url)
-        _serializer = serializer.save(
-            user=self.request.user,
-            expiry_date_time=link_exp_datetime,
-            image=image,
-            user_exp_time_seconds=user_exp_time_seconds,
-            title=title,
-            image_base_64=image_base_64
-        )
-        _serializer.expiry_link = f'{domain_and_port_for_link}/temp/{_serializer.uuid_link}'
-        _serializer.save()
\ No newline at end of file
+        uuid_link = uuid.uuid4()
+        link_data = {
+            'user': self.request.user,
+            'expiry_date_time': link_exp_datetime,
+            'image': image,
+            'user_exp_time_seconds': user_exp_time_seconds,
+            'title': title,
+            'uuid_link': uuid_link,
+            'expiry_link': get_expiry_link(image, link_exp_datetime, uuid_link),
+        }
+        if not is_expiry_link_recorded():
+            serializer.instance = ExpiredLink(**link_data)
+            return
+        serializer.save(**link_data)
@@ -6,5 +6,6 @@ admin.site.register(User)
 admin.site.register(AccountTier)
 admin.site.register(ThumbnailType)
 admin.site.register(Image)
+admin.site.register(Blob)
 admin.site.register(ExpiredLink)
 
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AppWithUiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app_with_ui'
+
+    def ready(self):
+        from app_with_ui import signals  # noqa: F401
@@ -0,0 +1,48 @@
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
+
+
+class StreamingASGIRequest(ASGIRequest):
+    """
+    Request of StreamingASGIHandler. It is resolved by ASGI_URLCONF, where async views replace sync ones,
+    and marks that AsyncStreamingHttpResponse can be sent
+    """
+
+    async_streaming = True
+
+    def __init__(self, scope, body_file):
+        super().__init__(scope, body_file)
+        self.urlconf = settings.ASGI_URLCONF
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """ASGI handler which also sends responses with async iterator of content (AsyncStreamingHttpResponse)"""
+
+    request_class = StreamingASGIRequest
+
+    async def send_response(self, response, send):
+        if not getattr(response, 'is_async', False):
+            return await super().send_response(response, send)
+
+        headers = []
+        for header, value in response.items():
+            headers.append((header.encode('ascii'), value.encode('latin1')))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+        iterator = response.streaming_content
+        try:
+            # Every send waits for ASGI server, so slow client only holds this coroutine
+            async for chunk in iterator:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            await iterator.aclose()
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return StreamingASGIHandler()
@@ -0,0 +1,96 @@
+import json
+import math
+import os
+import time
+from io import BytesIO
+
+from django.core.management import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from PIL import Image as img
+
+
+def generate_image_content(width, height, image_format):
+    """Generating image filled with noise, so it is encoded like a photo and not compressed to nothing"""
+
+    work_image = img.frombytes('RGB', (width, height), os.urandom(width * height * 3))
+    image_file = BytesIO()
+    work_image.save(image_file, image_format.upper(), quality=90)
+    return image_file.getvalue()
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of sorted values"""
+
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def run_benchmark(function, repeat, setup=None):
+    """Running function repeat times and collecting its timings (in seconds) and number of DB queries of every run"""
+
+    timings = []
+    queries = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with CaptureQueriesContext(connection) as captured_queries:
+            started_at = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started_at)
+        queries.append(len(captured_queries))
+    return summarize(timings, queries)
+
+
+def summarize(timings, queries):
+    sorted_timings = sorted(timings)
+    return {
+        'runs': len(timings),
+        'throughput_per_second': round(len(timings) / sum(timings), 2) if sum(timings) else None,
+        'p50_ms': round(percentile(sorted_timings, 50) * 1000, 3),
+        'p95_ms': round(percentile(sorted_timings, 95) * 1000, 3),
+        'p99_ms': round(percentile(sorted_timings, 99) * 1000, 3),
+        'queries': max(queries),
+    }
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    """
+    Comparing results with baseline file. Benchmark is regressed if its p95 latency is bigger than
+    baseline one by more than tolerance (0.1 is 10%) or if it makes more DB queries
+    """
+
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)['benchmarks']
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result['p95_ms'] > baseline[name]['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms, baseline {baseline[name]['p95_ms']}ms")
+        if result['queries'] > baseline[name]['queries']:
+            regressions.append(f"{name}: {result['queries']} queries, baseline {baseline[name]['queries']}")
+    return regressions
+
+
+def add_baseline_arguments(parser):
+    parser.add_argument('--repeat', type=int, default=20, help='Number of runs of every benchmark')
+    parser.add_argument('--baseline', help='Path to baseline JSON file to compare results with')
+    parser.add_argument('--save-baseline', help='Path to file where results are saved as new baseline')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1, help='Allowed slowdown of p95 latency compared with baseline'
+    )
+
+
+def report_results(command, results, options):
+    """Writing results as JSON, saving them as baseline and failing the command if there are regressions"""
+
+    report = {'benchmarks': results}
+    if options['baseline']:
+        report['regressions'] = compare_with_baseline(results, options['baseline'], options['tolerance'])
+    command.stdout.write(json.dumps(report, indent=2))
+    if options['save_baseline']:
+        with open(options['save_baseline'], 'w') as baseline_file:
+            json.dump({'benchmarks': results}, baseline_file, indent=2)
+    if report.get('regressions'):
+        raise CommandError(f"{len(report['regressions'])} benchmarks regressed compared with baseline")
@@ -0,0 +1,115 @@
+import hashlib
+import os
+from collections import Counter
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from app_with_ui.models import Blob, BlobDerivative
+from app_with_ui.serving import get_webp_variant_name
+
+BLOB_DIR = 'blobs'
+
+
+def get_file_sha256(file):
+    """Getting SHA-256 of file content. Uploaded files are hashed while they are received (see upload_handlers)"""
+
+    sha256 = getattr(file, 'sha256', None)
+    if sha256 is None:
+        hasher = hashlib.sha256()
+        for chunk in file.chunks():
+            hasher.update(chunk)
+        file.seek(0)
+        sha256 = hasher.hexdigest()
+    return sha256
+
+
+def get_blob_name(sha256, file_name):
+    extension = os.path.splitext(file_name)[1].lower()
+    return f'{BLOB_DIR}/{sha256[:2]}/{sha256[2:4]}/{sha256}{extension}'
+
+
+def store_blob_file(file, sha256):
+    """Writing file to blob store if it is not there yet. Returns name of file in storage. Does not touch DB"""
+
+    name = get_blob_name(sha256, file.name)
+    if not default_storage.exists(name):
+        saved_name = default_storage.save(name, file)
+        if saved_name != name:
+            # File with the same content was written by concurrent upload
+            default_storage.delete(saved_name)
+    return name
+
+
+def store_webp_variant(name, content):
+    """Writing WebP variant of blob file next to it, variant is chosen by content negotiation when file is served"""
+
+    variant_name = get_webp_variant_name(name)
+    if not default_storage.exists(variant_name):
+        saved_name = default_storage.save(variant_name, ContentFile(content))
+        if saved_name != variant_name:
+            default_storage.delete(saved_name)
+
+
+def get_or_create_blob(sha256, name, size, width, height):
+    blob, created = Blob.objects.get_or_create(sha256=sha256, defaults={
+        'file': name,
+        'size': size,
+        'width': width,
+        'height': height,
+        'unreferenced_at': timezone.now(),
+    })
+    if not created and blob.file.name != name:
+        # Blob was created by concurrent upload of file with another extension
+        default_storage.delete(name)
+    return blob
+
+
+def get_derivative_blobs(source_blob):
+    """Getting blobs of thumbnails made from source blob as dict {heigth: blob}. Found blobs are kept from cleanup"""
+
+    blobs = {derivative.heigth: derivative.blob for derivative in source_blob.derivatives.select_related('blob')}
+    kept_blob_ids = keep_found_blobs([blob.id for blob in blobs.values()])
+    return {heigth: blob for heigth, blob in blobs.items() if blob.id in kept_blob_ids}
+
+
+def keep_found_blobs(blob_ids):
+    """
+    Restarting grace period of found blobs which are not referenced, so cleanup task does not delete them
+    before images which reference them are inserted. Update waits for lock of blobs which cleanup is deleting
+    right now, so ids of blobs which still exist are returned
+    """
+
+    if not blob_ids:
+        return set()
+    Blob.objects.filter(id__in=blob_ids, ref_count=0).update(unreferenced_at=timezone.now())
+    return set(Blob.objects.filter(id__in=blob_ids).values_list('id', flat=True))
+
+
+def add_derivative_blob(source_blob, heigth, blob):
+    derivative, _ = BlobDerivative.objects.get_or_create(source=source_blob, heigth=heigth, defaults={'blob': blob})
+    return derivative.blob
+
+
+def change_blob_references(blob_id, delta):
+    """Changing reference counter of blob. Time of losing the last reference is recorded for cleanup task"""
+
+    if delta > 0:
+        Blob.objects.filter(id=blob_id).update(ref_count=F('ref_count') + delta, unreferenced_at=None)
+    else:
+        Blob.objects.filter(id=blob_id).update(
+            ref_count=F('ref_count') + delta,
+            unreferenced_at=Case(
+                When(ref_count__lte=-delta, then=Value(timezone.now())),
+                default=F('unreferenced_at')
+            )
+        )
+
+
+def add_image_blob_references(images):
+    """Adding references of images created by bulk_create, which does not send post_save signal"""
+
+    for blob_id, count in Counter(image.blob_id for image in images if image.blob_id is not None).items():
+        change_blob_references(blob_id, count)
@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+
+# Processes are not forked from web server or Celery worker, which may have threads, locks and DB connections.
+# Forkserver is not available on all platforms
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class ImagePoolBusy(Exception):
+    """Raised if image work can not be queued because queue of pending work is full for too long"""
+
+
+class ImagePool:
+    """
+    Process pool for CPU-bound Pillow work. Every task is taken by the first free process,
+    so thumbnails of one upload are made by many cores at once.
+    Number of queued and running tasks is limited by IMAGE_POOL_MAX_PENDING, callers wait for free place (backpressure).
+    Work is done in calling process if IMAGE_POOL_WORKERS is 0 or calling process is daemonic
+    (processes of prefork Celery pool can not have child processes, so Celery worker uses threads pool).
+    Processes are started by forkserver (or spawn) with Django set up, so pool can be made from any thread
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending_slots = None
+        self._pid = None
+
+    def get_workers_count(self):
+        workers_count = settings.IMAGE_POOL_WORKERS
+        if workers_count is None:
+            return os.cpu_count() or 1
+        return workers_count
+
+    def is_enabled(self):
+        return self.get_workers_count() > 0 and not multiprocessing.current_process().daemon
+
+    def _get_executor(self):
+        with self._lock:
+            # Pool is made once per process, pool made before fork of web server workers can not be used there
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.get_workers_count(),
+                    mp_context=multiprocessing.get_context(START_METHOD),
+                    initializer=django.setup
+                )
+                self._pending_slots = threading.BoundedSemaphore(settings.IMAGE_POOL_MAX_PENDING)
+                self._pid = os.getpid()
+            return self._executor, self._pending_slots
+
+    def _reset_executor(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+
+    def submit(self, function, *args):
+        """Queueing function call in pool. Function and arguments must be picklable"""
+
+        executor, pending_slots = self._get_executor()
+        if not pending_slots.acquire(timeout=settings.IMAGE_POOL_SUBMIT_TIMEOUT):
+            raise ImagePoolBusy('Queue of image work is full')
+        try:
+            future = executor.submit(function, *args)
+        except BrokenProcessPool:
+            pending_slots.release()
+            self._reset_executor(executor)
+            raise
+        future.add_done_callback(lambda _: pending_slots.release())
+        return future
+
+    def map(self, function, args_list):
+        """Calling function with every arguments tuple in pool and returning results in the same order"""
+
+        if not self.is_enabled():
+            return [function(*args) for args in args_list]
+        futures = [self.submit(function, *args) for args in args_list]
+        try:
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            self._reset_executor(self._executor)
+            raise
+
+    def run(self, function, *args):
+        return self.map(function, [args])[0]
+
+
+image_pool = ImagePool()
@@ -0,0 +1,188 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db import connections
+from django.http import HttpResponse, Http404
+
+# Timings of phases of current request in seconds. None if instrumentation is disabled, so hooks cost one lookup
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_SERIES_KEY = 'metrics:series'
+METRICS_BUCKET_KEY = 'metrics:{}:{}:bucket:{}'
+METRICS_SUM_KEY = 'metrics:{}:{}:sum'
+SERIES_REGISTER_ATTEMPTS = 3
+
+
+def add_timing(name, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + seconds
+
+
+def timed(name):
+    """Decorator which adds duration of function to timings of current request under given name"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if request_timings.get() is None:
+                return function(*args, **kwargs)
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_timing(name, time.perf_counter() - started_at)
+        return wrapper
+    return decorator
+
+
+def time_query(execute, sql, params, many, context):
+    started_at = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        add_timing('db', time.perf_counter() - started_at)
+
+
+class TimedFileSystemStorage(FileSystemStorage):
+    """File system storage which adds time of file writes to timings of current request"""
+
+    @timed('storage')
+    def _save(self, name, content):
+        return super()._save(name, content)
+
+
+class Histograms:
+    """
+    Histograms of durations of request phases per view. Counters are kept in cache, so histograms are shared
+    by all processes and threads of all servers, and /metrics shows the same totals whichever process answers it.
+    Only the bucket of duration and the sum are incremented per phase, cumulative counts are made on render
+    """
+
+    def observe(self, view_name, timings):
+        self.register_series({(view_name, phase) for phase in timings})
+        for phase, seconds in timings.items():
+            index = bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)
+            increment_counter(METRICS_BUCKET_KEY.format(view_name, phase, index), 1)
+            # Counters are integers, so sum is kept in microseconds
+            increment_counter(METRICS_SUM_KEY.format(view_name, phase), round(seconds * 1000000))
+
+    def register_series(self, series):
+        # Other process may write registry at the same time, so it is read again until all series are in it
+        for _ in range(SERIES_REGISTER_ATTEMPTS):
+            registered_series = cache.get(METRICS_SERIES_KEY, set())
+            if series <= registered_series:
+                return
+            cache.set(METRICS_SERIES_KEY, registered_series | series, None)
+
+    def render(self):
+        """Rendering histograms in Prometheus text format"""
+
+        metric = 'image_project_request_phase_duration_seconds'
+        lines = [
+            f'# HELP {metric} Duration of request phases (db, image processing, storage, total) per view.',
+            f'# TYPE {metric} histogram',
+        ]
+        series = sorted(cache.get(METRICS_SERIES_KEY, set()))
+        keys = [
+            METRICS_BUCKET_KEY.format(view_name, phase, index)
+            for view_name, phase in series for index in range(len(HISTOGRAM_BUCKETS) + 1)
+        ] + [METRICS_SUM_KEY.format(view_name, phase) for view_name, phase in series]
+        counters = cache.get_many(keys)
+        for view_name, phase in series:
+            labels = f'view="{view_name}",phase="{phase}"'
+            count = 0
+            for index, bucket in enumerate(HISTOGRAM_BUCKETS):
+                count += counters.get(METRICS_BUCKET_KEY.format(view_name, phase, index), 0)
+                lines.append(f'{metric}_bucket{{{labels},le="{bucket}"}} {count}')
+            count += counters.get(METRICS_BUCKET_KEY.format(view_name, phase, len(HISTOGRAM_BUCKETS)), 0)
+            lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{metric}_sum{{{labels}}} {counters.get(METRICS_SUM_KEY.format(view_name, phase), 0) / 1000000:.6f}')
+            lines.append(f'{metric}_count{{{labels}}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def increment_counter(key, delta):
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # Counter has just been evicted
+        cache.add(key, delta, None)
+
+
+histograms = Histograms()
+
+
+class InstrumentationMiddleware:
+    """
+    Measuring time spent in DB, image processing and storage writes for every request if INSTRUMENTATION_ENABLED.
+    Timings are sent in Server-Timing header and aggregated in histograms per view.
+    Middleware is async capable, so async views under ASGI are not switched to threads
+    (their queries run in threads of sync_to_async and only total time is measured for them)
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # Marking instance as coroutine function for Django, like MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not settings.INSTRUMENTATION_ENABLED:
+            return self.get_response(request)
+
+        timings = {}
+        token = request_timings.set(timings)
+        started_at = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(time_query))
+                response = self.get_response(request)
+        finally:
+            request_timings.reset(token)
+        return self.process_timings(request, response, timings, started_at)
+
+    async def __acall__(self, request):
+        if not settings.INSTRUMENTATION_ENABLED:
+            return await self.get_response(request)
+
+        timings = {}
+        token = request_timings.set(timings)
+        started_at = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_timings.reset(token)
+        return self.process_timings(request, response, timings, started_at)
+
+    def process_timings(self, request, response, timings, started_at):
+        timings['total'] = time.perf_counter() - started_at
+        response['Server-Timing'] = ', '.join(
+            f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in timings.items()
+        )
+        view_name = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        histograms.observe(view_name, timings)
+        return response
+
+
+def metrics_view(request):
+    """Histograms in Prometheus text format, available for INTERNAL_IPS and staff"""
+
+    if request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS and not request.user.is_staff:
+        raise Http404
+    return HttpResponse(histograms.render(), content_type='text/plain; version=0.0.4')
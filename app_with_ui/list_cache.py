@@ -0,0 +1,85 @@
+import hashlib
+import uuid
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import patch_cache_control
+
+from app_with_ui.type_registry import THUMBNAIL_TYPES_VERSION_KEY
+
+IMAGES_GENERATION_KEY = 'app_with_ui.images_generation.{}'
+IMAGE_LIST_PAGE_KEY = 'app_with_ui.image_list_page.{}'
+IMAGE_LIST_PAGE_TIMEOUT = 10 * 60
+
+
+def get_images_generation(user_id):
+    """
+    Getting generation of user's images, which is changed every time user's images are created, deleted or moved.
+    Generation is random token, so generation lost by cache is never repeated. Returns None if cache is unavailable
+    """
+
+    key = IMAGES_GENERATION_KEY.format(user_id)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        generation = cache.get(key)
+    return generation
+
+
+def bump_images_generations(user_ids):
+    """Changing generations of users' images after commit, so new generation is never seen together with old data"""
+
+    generations = {IMAGES_GENERATION_KEY.format(user_id): uuid.uuid4().hex for user_id in set(user_ids)}
+    transaction.on_commit(lambda: cache.set_many(generations, None))
+
+
+def get_image_list_version(request, tier_policy):
+    """
+    Building version of user's image list page without DB queries: from generation of user's images,
+    account tier policy, version of thumbnail types and requested URL (page cursor, format).
+    Returns None if cache is unavailable
+    """
+
+    generation = get_images_generation(request.user.id)
+    if generation is None:
+        return None
+    key = ':'.join(str(part) for part in [
+        request.user.id,
+        generation,
+        request.user.get_username(),
+        request.user.account_tier_id,
+        sorted(tier_policy.items()) if tier_policy else None,
+        cache.get(THUMBNAIL_TYPES_VERSION_KEY),
+        request.get_host(),
+        request.get_full_path(),
+        request.headers.get('Accept', ''),
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_image_list_etag(version):
+    return f'"{version}"' if version is not None else None
+
+
+def get_cached_page(version):
+    if version is None:
+        return None
+    return cache.get(IMAGE_LIST_PAGE_KEY.format(version))
+
+
+def store_cached_page(version, page):
+    """
+    Storing image list page (rendered JSON or page data) by its version. Version is changed with any change
+    of user's images, so stored page is never stale and it is just left to expire
+    """
+
+    if version is not None:
+        cache.set(IMAGE_LIST_PAGE_KEY.format(version), page, IMAGE_LIST_PAGE_TIMEOUT)
+
+
+def patch_image_list_response(response, etag):
+    """Setting ETag of image list page, clients must revalidate page before using it"""
+
+    if etag is not None:
+        response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
@@ -0,0 +1,117 @@
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import django
+from django.core.cache import cache
+from django.core.management import BaseCommand, CommandError
+
+from app_with_ui.models import ThumbnailType
+from app_with_ui.rate_limit import get_thumbnail_backlog
+from app_with_ui.services import get_originals_missing_type, backfill_thumbnails
+from app_with_ui.tasks import backfill_thumbnails_chunk
+from image_project.celery import app as celery_app
+
+BACKFILL_CHECKPOINT_KEY = 'app_with_ui.backfill_checkpoint.{}'
+BACKLOG_POLL_SECONDS = 5
+
+
+class Command(BaseCommand):
+    help = (
+        'Creating thumbnails of given type for original images which do not have them (e.g. type was added later). '
+        'Progress is checkpointed, so interrupted command continues from the last finished chunk'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', type=int, required=True, help='Id of thumbnail type')
+        parser.add_argument('--chunk-size', type=int, default=100, help='Number of original images in one chunk')
+        parser.add_argument('--parallel', type=int, default=1, help='Number of chunks processed at once')
+        parser.add_argument(
+            '--celery',
+            action='store_true',
+            help='Process chunks by Celery workers instead of local processes (needs result backend)'
+        )
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to wait after every chunk')
+        parser.add_argument(
+            '--max-backlog',
+            type=int,
+            default=None,
+            help='Wait while more uploaded images than this are waiting for thumbnails, so uploads go first'
+        )
+        parser.add_argument('--restart', action='store_true', help='Start from the first image, ignore checkpoint')
+
+    def handle(self, *args, **options):
+        thumbnail_type = ThumbnailType.objects.filter(
+            id=options['type'],
+            is_original=False,
+            heigth_size_in_pixels__isnull=False
+        ).first()
+        if thumbnail_type is None:
+            raise CommandError(f'Thumbnail type {options["type"]} does not exist or has no height')
+        if options['celery'] and not celery_app.conf.task_always_eager and not celery_app.conf.result_backend:
+            raise CommandError('Processing by Celery needs CELERY_RESULT_BACKEND to wait for chunks')
+
+        checkpoint_key = BACKFILL_CHECKPOINT_KEY.format(thumbnail_type.id)
+        last_id = 0 if options['restart'] else cache.get(checkpoint_key, 0)
+        if last_id:
+            self.stdout.write(f'Continuing after image {last_id}')
+        self.executor = None
+        submit_chunk = self.get_chunk_submitter(options)
+        try:
+            self.backfill(thumbnail_type, last_id, submit_chunk, options)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def backfill(self, thumbnail_type, last_id, submit_chunk, options):
+        checkpoint_key = BACKFILL_CHECKPOINT_KEY.format(thumbnail_type.id)
+        missing_originals = get_originals_missing_type(thumbnail_type).order_by('id').values_list('id', flat=True)
+        self.created = 0
+        # Chunks are finished in order of submitting, so checkpoint is moved only after all previous chunks
+        pending = deque()
+        while True:
+            self.wait_for_backlog(options['max_backlog'])
+            original_ids = list(missing_originals.filter(id__gt=last_id)[:options['chunk_size']])
+            if not original_ids:
+                break
+            last_id = original_ids[-1]
+            pending.append((last_id, submit_chunk(original_ids, thumbnail_type.id)))
+            if len(pending) >= options['parallel']:
+                self.finish_chunk(pending, checkpoint_key)
+            time.sleep(options['pause'])
+        while pending:
+            self.finish_chunk(pending, checkpoint_key)
+        cache.delete(checkpoint_key)
+        self.stdout.write(f'Created {self.created} thumbnails of type {thumbnail_type}')
+
+    def get_chunk_submitter(self, options):
+        """Getting function which starts processing of chunk and returns object with its result"""
+
+        if options['celery']:
+            return lambda original_ids, type_id: backfill_thumbnails_chunk.delay(original_ids, type_id)
+        if options['parallel'] > 1:
+            # Spawned processes open their own DB connections, forked ones would share connection of this process
+            self.executor = ProcessPoolExecutor(
+                max_workers=options['parallel'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup
+            )
+            return lambda original_ids, type_id: self.executor.submit(backfill_thumbnails, original_ids, type_id)
+
+        def run_chunk(original_ids, type_id):
+            future = Future()
+            future.set_result(backfill_thumbnails(original_ids, type_id))
+            return future
+        return run_chunk
+
+    def finish_chunk(self, pending, checkpoint_key):
+        last_id, chunk_result = pending.popleft()
+        created = chunk_result.result() if isinstance(chunk_result, Future) else chunk_result.get()
+        self.created += created
+        cache.set(checkpoint_key, last_id, None)
+        self.stdout.write(f'Images up to {last_id} are done, created {created} thumbnails')
+
+    def wait_for_backlog(self, max_backlog):
+        while max_backlog is not None and get_thumbnail_backlog() > max_backlog:
+            time.sleep(BACKLOG_POLL_SECONDS)
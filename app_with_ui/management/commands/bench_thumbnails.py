@@ -0,0 +1,57 @@
+from io import BytesIO
+
+from django.core.files import File
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from app_with_ui.benchmarks import run_benchmark, add_baseline_arguments, report_results, generate_image_content
+from app_with_ui.models import ThumbnailType
+from app_with_ui.services import get_original_image_size, resize_image
+from app_with_ui.type_registry import thumbnail_type_registry
+
+
+class Command(BaseCommand):
+    help = 'Measuring speed of thumbnails generation for synthetic images of different sizes and formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', default='640x480,1920x1080,4000x3000', help='Comma separated WxH sizes')
+        parser.add_argument('--formats', default='jpeg,png', help='Comma separated formats of images')
+        parser.add_argument('--types', default='1,3,6', help='Comma separated numbers of thumbnail types')
+        add_baseline_arguments(parser)
+
+    def handle(self, *args, **options):
+        images = {}
+        for resolution in options['resolutions'].split(','):
+            width, height = map(int, resolution.split('x'))
+            for image_format in options['formats'].split(','):
+                images[f'{image_format} {width}x{height}'] = File(
+                    BytesIO(generate_image_content(width, height, image_format)), name=f'benchmark.{image_format}'
+                )
+
+        results = {}
+        for name, image_file in images.items():
+            results[f'get_original_image_size[{name}]'] = run_benchmark(
+                lambda: get_original_image_size(image_file), options['repeat'], lambda: image_file.seek(0)
+            )
+        # Heights of existing thumbnail types are hidden and benchmark types are created only inside of transaction,
+        # which is rolled back at the end
+        try:
+            with transaction.atomic():
+                for types_count in map(int, options['types'].split(',')):
+                    ThumbnailType.objects.filter(heigth_size_in_pixels__isnull=False).update(heigth_size_in_pixels=None)
+                    for number in range(types_count):
+                        heigth = 400 - number * 50
+                        ThumbnailType.objects.create(
+                            title=f'{heigth}px', heigth_size_in_pixels=heigth, is_original=False
+                        )
+                    # Signals invalidate registry only after commit, benchmark types are never committed
+                    thumbnail_type_registry.invalidate()
+                    for name, image_file in images.items():
+                        results[f'resize_image[{name}, {types_count} types]'] = run_benchmark(
+                            lambda: resize_image(image_file), options['repeat'], lambda: image_file.seek(0)
+                        )
+                transaction.set_rollback(True)
+        finally:
+            # Types loaded by registry inside of rolled back transaction must not be used later
+            thumbnail_type_registry.invalidate()
+        report_results(self, results, options)
@@ -0,0 +1,36 @@
+from django.core.management import BaseCommand
+
+from app_with_ui.models import Image
+from app_with_ui.services import relocate_image_file
+
+
+class Command(BaseCommand):
+    help = 'Moving files of images stored by old flat layout (<username>/<type>/<filename>) to sharded blob store'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of images loaded from DB at once')
+        parser.add_argument(
+            '--keep-old-files',
+            action='store_true',
+            help='Do not delete old files (signed expiry links created before relocation point to them)'
+        )
+
+    def handle(self, *args, **options):
+        relocated = 0
+        missing = 0
+        last_id = 0
+        # Relocated images get blob, so interrupted command continues with the rest of images when it is run again
+        while True:
+            images = list(
+                Image.objects.filter(blob__isnull=True, id__gt=last_id).order_by('id')[:options['batch_size']]
+            )
+            if not images:
+                break
+            for image in images:
+                if relocate_image_file(image, delete_old_file=not options['keep_old_files']):
+                    relocated += 1
+                else:
+                    missing += 1
+                    self.stderr.write(f'File of image {image.id} does not exist: {image.image.name}')
+            last_id = images[-1].id
+        self.stdout.write(f'Relocated files of {relocated} images, files of {missing} images are missing')
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0004_alter_image_upload_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='processing_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ready', 'Ready'), ('failed', 'Failed')], default='ready', max_length=10, verbose_name='Thumbnails processing status'),
+        ),
+    ]
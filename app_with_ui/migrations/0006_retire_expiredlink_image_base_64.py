@@ -0,0 +1,37 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:02
+
+import base64
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import migrations
+
+
+def restore_missing_images_from_base_64(apps, schema_editor):
+    """
+    Expiry links are served from image file in storage now. If file of linked image was lost,
+    it is restored from base64 copy stored in link before this copy is dropped
+    """
+
+    ExpiredLink = apps.get_model('app_with_ui', 'ExpiredLink')
+    links = ExpiredLink.objects.select_related('image').only('image_base_64', 'image__image').iterator()
+    for link in links:
+        image_name = link.image.image.name
+        if not link.image_base_64 or default_storage.exists(image_name):
+            continue
+        default_storage.save(image_name, ContentFile(base64.b64decode(bytes(link.image_base_64))))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0005_image_processing_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(restore_missing_images_from_base_64, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='expiredlink',
+            name='image_base_64',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0006_retire_expiredlink_image_base_64'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='expiredlink',
+            name='expiry_date_time',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Expiry date and time'),
+        ),
+    ]
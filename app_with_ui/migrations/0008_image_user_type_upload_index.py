@@ -0,0 +1,17 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0007_expiredlink_expiry_date_time_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['user', 'type', 'upload_date', 'id'], name='image_user_type_upload_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0008_image_user_type_upload_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True, verbose_name='SHA-256 of content')),
+                ('file', models.FileField(upload_to='', verbose_name='File in blob store')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Size in bytes')),
+                ('width', models.PositiveIntegerField(blank=True, null=True, verbose_name='Width')),
+                ('height', models.PositiveIntegerField(blank=True, null=True, verbose_name='Height')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='Number of images referencing blob')),
+                ('unreferenced_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='Date and time when blob lost its last reference')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BlobDerivative',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('heigth', models.PositiveSmallIntegerField(verbose_name='Height of thumbnail')),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='app_with_ui.blob', verbose_name='Thumbnail blob')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='derivatives', to='app_with_ui.blob', verbose_name='Source blob')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='images', to='app_with_ui.blob', verbose_name='Blob with content of image'),
+        ),
+        migrations.AddConstraint(
+            model_name='blobderivative',
+            constraint=models.UniqueConstraint(fields=('source', 'heigth'), name='blob_derivative_source_heigth_unique'),
+        ),
+    ]
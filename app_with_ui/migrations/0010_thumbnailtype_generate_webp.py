@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0009_blob_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnailtype',
+            name='generate_webp',
+            field=models.BooleanField(default=False, verbose_name='Generate WebP variant of thumbnails'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.3 on 2026-10-18 16:57
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0010_thumbnailtype_generate_webp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnailtype',
+            name='chroma_subsampling',
+            field=models.CharField(blank=True, choices=[('', 'Encoder default'), ('4:4:4', '4:4:4'), ('4:2:2', '4:2:2'), ('4:2:0', '4:2:0')], default='', max_length=5, verbose_name='Chroma subsampling (JPEG)'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailtype',
+            name='max_bytes',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='Max size of thumbnail in bytes (quality is lowered to fit)'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailtype',
+            name='optimize',
+            field=models.BooleanField(default=False, verbose_name='Optimize encoding (slower, smaller files)'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailtype',
+            name='progressive',
+            field=models.BooleanField(default=False, verbose_name='Progressive encoding (JPEG)'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailtype',
+            name='quality',
+            field=models.PositiveSmallIntegerField(default=90, validators=[django.core.validators.MinValueValidator(1, message='Value must be between 1 and 95'), django.core.validators.MaxValueValidator(95, message='Value must be between 1 and 95')], verbose_name='Encoding quality (JPEG, WebP)'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailtype',
+            name='strip_metadata',
+            field=models.BooleanField(default=False, verbose_name='Strip EXIF and ICC profile (colors are converted to sRGB)'),
+        ),
+    ]
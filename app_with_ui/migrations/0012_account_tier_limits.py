@@ -0,0 +1,48 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:06
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0011_thumbnailtype_encoding_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accounttier',
+            name='bypass_load_shedding',
+            field=models.BooleanField(default=False, verbose_name='Uploads are accepted when thumbnail backlog is full'),
+        ),
+        migrations.AddField(
+            model_name='accounttier',
+            name='link_burst',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Expiry links in burst (empty - same as links per minute)'),
+        ),
+        migrations.AddField(
+            model_name='accounttier',
+            name='link_rate',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Expiry links per minute (empty - no limit)'),
+        ),
+        migrations.AddField(
+            model_name='accounttier',
+            name='max_concurrent_uploads',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Concurrent uploads (empty - no limit)'),
+        ),
+        migrations.AddField(
+            model_name='accounttier',
+            name='upload_burst',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Uploads in burst (empty - same as uploads per minute)'),
+        ),
+        migrations.AddField(
+            model_name='accounttier',
+            name='upload_rate',
+            field=models.PositiveIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='Uploads per minute (empty - no limit)'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(condition=models.Q(('processing_status', 'pending')), fields=['processing_status'], name='image_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:09
+
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_thumbnails_to_originals(apps, schema_editor):
+    """
+    Thumbnails were not linked to their originals. They are found by derivatives of blob of original:
+    thumbnails of every type with derivative blob are linked to originals of the same user with source blob
+    in order of ids
+    """
+
+    Image = apps.get_model('app_with_ui', 'Image')
+    BlobDerivative = apps.get_model('app_with_ui', 'BlobDerivative')
+    for derivative in BlobDerivative.objects.iterator():
+        originals = defaultdict(list)
+        for original_id, user_id in Image.objects.filter(
+            blob_id=derivative.source_id,
+            type__is_original=True
+        ).order_by('id').values_list('id', 'user_id'):
+            originals[user_id].append(original_id)
+        thumbnails = defaultdict(list)
+        for thumbnail_id, user_id, type_id in Image.objects.filter(
+            blob_id=derivative.blob_id,
+            type__is_original=False,
+            type__heigth_size_in_pixels=derivative.heigth,
+            original__isnull=True
+        ).order_by('id').values_list('id', 'user_id', 'type_id'):
+            thumbnails[(user_id, type_id)].append(thumbnail_id)
+        for (user_id, _), thumbnail_ids in thumbnails.items():
+            for thumbnail_id, original_id in zip(thumbnail_ids, originals[user_id]):
+                Image.objects.filter(id=thumbnail_id).update(original_id=original_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0012_account_tier_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='original',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thumbnails', to='app_with_ui.image', verbose_name='Original image of thumbnail'),
+        ),
+        migrations.RunPython(link_thumbnails_to_originals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+import re
+from collections import defaultdict
+
+from django.db import migrations
+
+THUMBNAIL_TITLE_RE = re.compile(r'^(.*)\(\d+px thumbnail\)$')
+ORIGINAL_TITLE_SUFFIX = '(original image)'
+
+
+def get_base_title(title):
+    if title.endswith(ORIGINAL_TITLE_SUFFIX):
+        return title[:-len(ORIGINAL_TITLE_SUFFIX)]
+    return title
+
+
+def link_legacy_thumbnails(apps, schema_editor):
+    """
+    Thumbnails which could not be linked by blob derivatives (made before blob store or derivatives were dropped
+    on change of thumbnail type) are linked by title: thumbnail '<title>(<h>px thumbnail)' belongs to original
+    '<title>' or '<title>(original image)' of the same user. If there are several such originals, thumbnail is linked
+    to the last one uploaded before it which has no thumbnail of this type yet
+    """
+
+    Image = apps.get_model('app_with_ui', 'Image')
+    user_ids = set(Image.objects.filter(
+        original__isnull=True,
+        type__is_original=False
+    ).values_list('user_id', flat=True))
+    for user_id in user_ids:
+        originals = defaultdict(list)
+        for original_id, title, upload_date in Image.objects.filter(
+            user_id=user_id,
+            type__is_original=True
+        ).order_by('upload_date', 'id').values_list('id', 'title', 'upload_date'):
+            originals[get_base_title(title)].append((original_id, upload_date))
+        linked = set(Image.objects.filter(
+            user_id=user_id,
+            original__isnull=False
+        ).values_list('original_id', 'type_id'))
+
+        for thumbnail_id, title, type_id, upload_date in Image.objects.filter(
+            user_id=user_id,
+            original__isnull=True,
+            type__is_original=False
+        ).order_by('upload_date', 'id').values_list('id', 'title', 'type_id', 'upload_date'):
+            match = THUMBNAIL_TITLE_RE.match(title)
+            if match is None:
+                continue
+            candidates = [
+                (original_id, original_upload_date)
+                for original_id, original_upload_date in originals.get(match.group(1), [])
+                if (original_id, type_id) not in linked
+            ]
+            if not candidates:
+                continue
+            uploaded_before = [
+                original_id for original_id, original_upload_date in candidates
+                if upload_date is None or original_upload_date is None or original_upload_date <= upload_date
+            ]
+            original_id = uploaded_before[-1] if uploaded_before else candidates[0][0]
+            linked.add((original_id, type_id))
+            Image.objects.filter(id=thumbnail_id).update(original_id=original_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0013_image_original'),
+    ]
+
+    operations = [
+        migrations.RunPython(link_legacy_thumbnails, migrations.RunPython.noop),
+    ]
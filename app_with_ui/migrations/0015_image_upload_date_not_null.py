@@ -0,0 +1,30 @@
+from django.db import migrations, models
+from django.db.models import Min
+from django.utils import timezone
+
+
+def fill_missing_upload_dates(apps, schema_editor):
+    """
+    Images without upload date were uploaded before the field was added, so they get the earliest
+    upload date and are still the oldest ones in lists (ties are ordered by id)
+    """
+
+    Image = apps.get_model('app_with_ui', 'Image')
+    earliest_upload_date = Image.objects.aggregate(earliest=Min('upload_date'))['earliest'] or timezone.now()
+    Image.objects.filter(upload_date__isnull=True).update(upload_date=earliest_upload_date)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_with_ui', '0014_link_legacy_thumbnails'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_missing_upload_dates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='image',
+            name='upload_date',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import FileExtensionValidator, MaxValueValidator, MinValueValidator
 from django.db import models
+import hashlib
 import uuid
 
 
@@ -17,25 +18,153 @@ class AccountTier(models.Model):
     title = models.CharField(max_length=30, verbose_name='Name of account tier')
     allowed_image_types = models.ManyToManyField('ThumbnailType', verbose_name='Allowed types of images')
     has_ability_create_expiry_link = models.BooleanField(default=False)
+    upload_rate = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1)],
+        verbose_name='Uploads per minute (empty - no limit)'
+    )
+    upload_burst = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1)],
+        verbose_name='Uploads in burst (empty - same as uploads per minute)'
+    )
+    max_concurrent_uploads = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1)],
+        verbose_name='Concurrent uploads (empty - no limit)'
+    )
+    link_rate = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1)],
+        verbose_name='Expiry links per minute (empty - no limit)'
+    )
+    link_burst = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        validators=[MinValueValidator(1)],
+        verbose_name='Expiry links in burst (empty - same as links per minute)'
+    )
+    bypass_load_shedding = models.BooleanField(
+        default=False,
+        verbose_name='Uploads are accepted when thumbnail backlog is full'
+    )
 
     def __str__(self):
         return self.title
 
 
 class ThumbnailType(models.Model):
+
+    class ChromaSubsampling(models.TextChoices):
+        DEFAULT = '', 'Encoder default'
+        SUBSAMPLING_444 = '4:4:4', '4:4:4'
+        SUBSAMPLING_422 = '4:2:2', '4:2:2'
+        SUBSAMPLING_420 = '4:2:0', '4:2:0'
+
     title = models.CharField(max_length=50, verbose_name='Name of thumbnail')
     heigth_size_in_pixels = models.PositiveSmallIntegerField(blank=True, null=True)
     is_original = models.BooleanField(default=True, verbose_name='Image has original size')
+    generate_webp = models.BooleanField(default=False, verbose_name='Generate WebP variant of thumbnails')
+    quality = models.PositiveSmallIntegerField(
+        default=90,
+        validators=[
+            MinValueValidator(1, message='Value must be between 1 and 95'),
+            MaxValueValidator(95, message='Value must be between 1 and 95'),
+        ],
+        verbose_name='Encoding quality (JPEG, WebP)'
+    )
+    chroma_subsampling = models.CharField(
+        max_length=5,
+        choices=ChromaSubsampling.choices,
+        default=ChromaSubsampling.DEFAULT,
+        blank=True,
+        verbose_name='Chroma subsampling (JPEG)'
+    )
+    progressive = models.BooleanField(default=False, verbose_name='Progressive encoding (JPEG)')
+    optimize = models.BooleanField(default=False, verbose_name='Optimize encoding (slower, smaller files)')
+    strip_metadata = models.BooleanField(
+        default=False,
+        verbose_name='Strip EXIF and ICC profile (colors are converted to sRGB)'
+    )
+    max_bytes = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        verbose_name='Max size of thumbnail in bytes (quality is lowered to fit)'
+    )
 
     def __str__(self):
         return self.title
 
+    def get_encoding_profile(self):
+        """Getting encoding options of thumbnails as plain dict, so it can be sent to image pool processes"""
+
+        return {
+            'quality': self.quality,
+            'chroma_subsampling': self.chroma_subsampling,
+            'progressive': self.progressive,
+            'optimize': self.optimize,
+            'strip_metadata': self.strip_metadata,
+            'max_bytes': self.max_bytes,
+        }
+
+
+class Blob(models.Model):
+    """
+    Content-addressed file shared by all images with the same content.
+    Blobs which are not referenced by images for a while are deleted by cleanup task
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True, verbose_name='SHA-256 of content')
+    file = models.FileField(verbose_name='File in blob store')
+    size = models.PositiveBigIntegerField(verbose_name='Size in bytes')
+    width = models.PositiveIntegerField(blank=True, null=True, verbose_name='Width')
+    height = models.PositiveIntegerField(blank=True, null=True, verbose_name='Height')
+    ref_count = models.PositiveIntegerField(default=0, verbose_name='Number of images referencing blob')
+    unreferenced_at = models.DateTimeField(
+        blank=True,
+        null=True,
+        db_index=True,
+        verbose_name='Date and time when blob lost its last reference'
+    )
+
+    def __str__(self):
+        return self.sha256
+
+
+class BlobDerivative(models.Model):
+    """Thumbnail of given height made from source blob, so thumbnails of the same content are made only once"""
+
+    source = models.ForeignKey(Blob, on_delete=models.CASCADE, related_name='derivatives', verbose_name='Source blob')
+    heigth = models.PositiveSmallIntegerField(verbose_name='Height of thumbnail')
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, related_name='+', verbose_name='Thumbnail blob')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'heigth'], name='blob_derivative_source_heigth_unique'),
+        ]
+
 
 def upload_image(instance, filename):
-    return '/'.join([instance.user.username, instance.type.title, filename])
+    """
+    Path of uploaded file which is not stored in blob store, sharded by hash of user, type and file name
+    (uploads/ab/cd/<hash>_<filename>), so no directory holds too many files
+    """
+
+    key = hashlib.sha1('/'.join([instance.user.username, instance.type.title, filename]).encode()).hexdigest()
+    return '/'.join(['uploads', key[:2], key[2:4], f'{key}_{filename}'])
 
 
 class Image(models.Model):
+
+    class ProcessingStatus(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        READY = 'ready', 'Ready'
+        FAILED = 'failed', 'Failed'
+
     user = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -53,10 +182,42 @@ class Image(models.Model):
         null=True
     )
     title = models.CharField(max_length=50, verbose_name='Image title')
+    original = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        related_name='thumbnails',
+        verbose_name='Original image of thumbnail',
+        blank=True,
+        null=True
+    )
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        related_name='images',
+        verbose_name='Blob with content of image',
+        blank=True,
+        null=True
+    )
     image = models.ImageField(upload_to=upload_image, validators=[FileExtensionValidator(['png', 'jpeg', 'jpg'])])
     width = models.PositiveIntegerField(blank=True, null=True, verbose_name='Width')
     height = models.PositiveIntegerField(blank=True, null=True, verbose_name='Height')
-    upload_date = models.DateTimeField(auto_now_add=True, blank=True, null=True)
+    upload_date = models.DateTimeField(auto_now_add=True, blank=True)
+    processing_status = models.CharField(
+        max_length=10,
+        choices=ProcessingStatus.choices,
+        default=ProcessingStatus.READY,
+        verbose_name='Thumbnails processing status'
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'type', 'upload_date', 'id'], name='image_user_type_upload_idx'),
+            models.Index(
+                fields=['processing_status'],
+                name='image_pending_idx',
+                condition=models.Q(processing_status='pending')
+            ),
+        ]
 
     def __str__(self):
         return f'{self.title}'
@@ -84,8 +245,7 @@ class ExpiredLink(models.Model):
             MaxValueValidator(30000, message='Value must be between 300 and 30000 seconds'),
         ]
     )
-    expiry_date_time = models.DateTimeField(blank=True, null=True, verbose_name='Expiry date and time')
-    image_base_64 = models.BinaryField(verbose_name='Image in base64 format')
+    expiry_date_time = models.DateTimeField(blank=True, null=True, db_index=True, verbose_name='Expiry date and time')
 
     def __str__(self):
         return self.title
@@ -0,0 +1,36 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import force_str
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
+
+
+def encode_cursor(image):
+    """Encoding position of image in list (upload date and id) into cursor for URL"""
+
+    return urlsafe_base64_encode(f'{image.upload_date.isoformat()}|{image.id}'.encode())
+
+
+def decode_cursor(cursor):
+    """Decoding upload date and id from cursor. Raises ValueError if cursor is incorrect"""
+
+    upload_date, image_id = force_str(urlsafe_base64_decode(cursor)).split('|')
+    upload_date = parse_datetime(upload_date)
+    if upload_date is None:
+        raise ValueError('Incorrect upload date in cursor')
+    return upload_date, int(image_id)
+
+
+def get_keyset_page(queryset, cursor, page_size):
+    """
+    Getting page of images ordered from newest to oldest by (upload_date, id) which starts after cursor.
+    Instead of OFFSET and COUNT(*) rows are filtered by position of last image on previous page,
+    so every page is read from index equally fast. Returns images and cursor of next page (None for last page)
+    """
+
+    queryset = queryset.order_by('-upload_date', '-id')
+    if cursor:
+        upload_date, image_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(upload_date__lt=upload_date) | Q(upload_date=upload_date, id__lt=image_id))
+    images = list(queryset[:page_size + 1])
+    next_cursor = encode_cursor(images[page_size - 1]) if len(images) > page_size else None
+    return images[:page_size], next_cursor
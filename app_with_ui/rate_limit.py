@@ -0,0 +1,192 @@
+import math
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from app_with_ui.models import Image
+from app_with_ui.tier_cache import get_tier_policy
+
+TOKEN_BUCKET_KEY = 'app_with_ui.token_bucket.{}.{}'
+CONCURRENCY_KEY = 'app_with_ui.concurrency.{}.{}'
+# Slots of requests killed before release are freed with expiry of counter
+CONCURRENCY_TIMEOUT = 10 * 60
+THUMBNAIL_BACKLOG_KEY = 'app_with_ui.thumbnail_backlog'
+THUMBNAIL_BACKLOG_TIMEOUT = 5
+
+# Refilling bucket by time of Redis server and taking tokens in one step, so limit is shared by all app servers.
+# Returns wait in seconds as string (Lua numbers are truncated to integers in replies)
+TOKEN_BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+'''
+
+
+def get_redis_client():
+    """Getting raw Redis client of default cache, None if cache is not Redis (tests, local development)"""
+
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        return None
+
+
+def take_tokens(scope, user_id, rate_per_minute, burst, cost=1):
+    """
+    Taking tokens from token bucket of user for scope (uploads, links). Bucket holds up to burst tokens
+    and is refilled with rate_per_minute. Returns 0 if tokens were taken, otherwise seconds to wait for them.
+    Cost bigger than burst can never be taken (e.g. batch with more files than burst), None is returned for it.
+    If Redis is unavailable request is allowed
+    """
+
+    if cost > burst:
+        return None
+    key = TOKEN_BUCKET_KEY.format(scope, user_id)
+    rate = rate_per_minute / 60
+    client = get_redis_client()
+    if client is None:
+        return take_cached_tokens(key, burst, rate, cost)
+    try:
+        return float(client.eval(TOKEN_BUCKET_SCRIPT, 1, cache.make_key(key), burst, rate, cost))
+    except RedisError:
+        return 0
+
+
+def take_cached_tokens(key, capacity, rate, cost):
+    """Token bucket on Django cache API for caches without Lua scripts. It is not atomic, so it is not for production"""
+
+    now = time.time()
+    tokens, updated_at = cache.get(key, (capacity, now))
+    tokens = min(capacity, tokens + max(0, now - updated_at) * rate)
+    wait = 0
+    if tokens >= cost:
+        tokens -= cost
+    else:
+        wait = (cost - tokens) / rate
+    cache.set(key, (tokens, now), math.ceil(capacity / rate) + 1)
+    return wait
+
+
+def acquire_slot(scope, user_id, limit):
+    """Taking one of limit slots of concurrent requests of user. Returns False if all slots are taken"""
+
+    key = CONCURRENCY_KEY.format(scope, user_id)
+    cache.add(key, 0, CONCURRENCY_TIMEOUT)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        # Counter has just expired
+        cache.add(key, 1, CONCURRENCY_TIMEOUT)
+        return True
+    if count is not None and count > limit:
+        release_slot(scope, user_id)
+        return False
+    return True
+
+
+def release_slot(scope, user_id):
+    try:
+        cache.decr(CONCURRENCY_KEY.format(scope, user_id))
+    except ValueError:
+        pass
+
+
+def get_thumbnail_backlog():
+    """Getting number of images waiting for thumbnails. Value is cached for a few seconds, so uploads do not count it"""
+
+    backlog = cache.get(THUMBNAIL_BACKLOG_KEY)
+    if backlog is None:
+        backlog = Image.objects.filter(processing_status=Image.ProcessingStatus.PENDING).count()
+        cache.set(THUMBNAIL_BACKLOG_KEY, backlog, THUMBNAIL_BACKLOG_TIMEOUT)
+    return backlog
+
+
+def get_rate_limit_wait(user, scope, cost=1):
+    """
+    Taking tokens of scope with rate and burst of user's account tier. Returns 0, seconds to wait for them
+    or None if cost is bigger than burst
+    """
+
+    tier_policy = get_tier_policy(user.account_tier_id)
+    if not tier_policy:
+        return 0
+    rate, burst = tier_policy['rate_limits'][scope]
+    if rate is None:
+        return 0
+    return take_tokens(scope, user.id, rate, burst, cost)
+
+
+def get_concurrency_limit(user):
+    """Getting max number of concurrent uploads by user's account tier, None - no limit"""
+
+    tier_policy = get_tier_policy(user.account_tier_id)
+    return tier_policy['max_concurrent_uploads'] if tier_policy else None
+
+
+def is_load_shed(user):
+    threshold = settings.THUMBNAIL_BACKLOG_SHED_THRESHOLD
+    if threshold is None:
+        return False
+    tier_policy = get_tier_policy(user.account_tier_id)
+    if tier_policy and tier_policy['bypass_load_shedding']:
+        return False
+    return get_thumbnail_backlog() > threshold
+
+
+class RequestIsNotAdmitted(Exception):
+    """Request is rejected by admit_request. Status code is 429 (limits of account tier) or 503 (load shedding)"""
+
+    def __init__(self, status_code, wait, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.wait = wait
+        self.message = message
+
+
+@contextmanager
+def admit_request(user, scope, cost=1, limit_concurrency=False, shed_load=False):
+    """
+    Admission control of request of user for API and UI views: load shedding, concurrent requests by account tier
+    and token bucket of scope. Raises RequestIsNotAdmitted with seconds for Retry-After (None if waiting
+    does not help), taken slot of concurrent requests is released on exit.
+    Slot is taken before tokens, so request rejected for concurrency does not use up rate of user
+    """
+
+    if shed_load and is_load_shed(user):
+        raise RequestIsNotAdmitted(
+            503,
+            settings.LOAD_SHEDDING_RETRY_AFTER,
+            'Too many images are waiting for thumbnails, try again later'
+        )
+    limit = get_concurrency_limit(user) if limit_concurrency else None
+    if limit is not None and not acquire_slot(scope, user.id, limit):
+        raise RequestIsNotAdmitted(429, settings.CONCURRENT_UPLOADS_RETRY_AFTER, 'Too many concurrent uploads')
+    try:
+        wait = get_rate_limit_wait(user, scope, cost)
+        if wait is None:
+            raise RequestIsNotAdmitted(429, None, 'Request is larger than burst of account tier')
+        if wait:
+            raise RequestIsNotAdmitted(429, math.ceil(wait), 'Request was throttled, try again later')
+        yield
+    finally:
+        if limit is not None:
+            release_slot(scope, user.id)
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+RENDER_CACHE_SIZE_KEY = 'app_with_ui.render_cache_size.{}'
+RENDER_CACHE_EVICTION_KEY = 'app_with_ui.render_cache_eviction.{}'
+# Lock of eviction of process killed during it expires
+RENDER_CACHE_EVICTION_TIMEOUT = 60
+
+
+def get_render_path(image, heigth, image_format, profile=None):
+    """
+    Getting path of rendered thumbnail in cache directory.
+    Key includes file name and encoding profile, so replaced file or changed profile is rendered again
+    """
+
+    profile_key = sorted(profile.items()) if profile else ''
+    key = hashlib.sha1(f'{image.id}:{image.image.name}:{heigth}:{image_format}:{profile_key}'.encode()).hexdigest()
+    return os.path.join(settings.RENDER_CACHE_DIR, key[:2], f'{key}.{image_format}')
+
+
+def get_cached_render(image, heigth, image_format, profile=None):
+    """Opening cached render or returning None. Hit updates modification time which is used for LRU eviction"""
+
+    path = get_render_path(image, heigth, image_format, profile)
+    try:
+        render_file = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    os.utime(render_file.fileno())
+    return render_file
+
+
+def store_render(image, heigth, image_format, content, profile=None):
+    """
+    Storing rendered thumbnail in cache directory. Size of cache is a running total, so directory is scanned
+    for eviction only when it exceeds RENDER_CACHE_MAX_SIZE
+    """
+
+    path = get_render_path(image, heigth, image_format, profile)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        replaced_size = os.path.getsize(path)
+    except FileNotFoundError:
+        replaced_size = 0
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'wb') as render_file:
+        render_file.write(content)
+    os.replace(temp_path, path)
+    if add_to_cache_size(len(content) - replaced_size) > settings.RENDER_CACHE_MAX_SIZE:
+        evict_renders()
+
+
+def get_cache_key(key_template):
+    # Cache directory is in key, so every directory (e.g. of tests) has its own total
+    return key_template.format(hashlib.sha1(settings.RENDER_CACHE_DIR.encode()).hexdigest())
+
+
+def add_to_cache_size(size):
+    """Adding size to running total of cache size. Total which is not in cache yet is counted by scan of directory"""
+
+    key = get_cache_key(RENDER_CACHE_SIZE_KEY)
+    try:
+        return cache.incr(key, size)
+    except ValueError:
+        cache_size = sum(render_size for _, render_size, _ in scan_renders())
+        cache.add(key, cache_size, None)
+        return cache_size
+
+
+def scan_renders():
+    """Getting (access time, size, path) of all renders in cache directory"""
+
+    if not os.path.isdir(settings.RENDER_CACHE_DIR):
+        return []
+    renders = []
+    for shard in os.scandir(settings.RENDER_CACHE_DIR):
+        if not shard.is_dir():
+            continue
+        for render in os.scandir(shard.path):
+            if render.name.endswith('.tmp'):
+                continue
+            try:
+                render_stat = render.stat()
+            except FileNotFoundError:
+                continue
+            renders.append((render_stat.st_mtime, render_stat.st_size, render.path))
+    return renders
+
+
+def evict_renders():
+    """
+    Deleting least recently used renders in one batch down to RENDER_CACHE_LOW_WATER_SIZE, so next eviction
+    is not needed soon. Only one process evicts at once, total is set to size which was left
+    """
+
+    lock_key = get_cache_key(RENDER_CACHE_EVICTION_KEY)
+    if not cache.add(lock_key, True, RENDER_CACHE_EVICTION_TIMEOUT):
+        return
+    try:
+        renders = scan_renders()
+        cache_size = sum(render_size for _, render_size, _ in renders)
+        low_water_size = min(settings.RENDER_CACHE_LOW_WATER_SIZE, settings.RENDER_CACHE_MAX_SIZE)
+        renders.sort()
+        for _, render_size, render_path in renders:
+            if cache_size <= low_water_size:
+                break
+            try:
+                os.remove(render_path)
+            except FileNotFoundError:
+                pass
+            cache_size -= render_size
+        cache.set(get_cache_key(RENDER_CACHE_SIZE_KEY), cache_size, None)
+    finally:
+        cache.delete(lock_key)
@@ -1,59 +1,597 @@
-import os.path
-import shutil
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
 from django.http import HttpResponse
 from django.utils import timezone
 
-import base64
-import sys
 from PIL import Image as img
+try:
+    from PIL import ImageCms
+except ImportError:  # Pillow is built without LittleCMS
+    ImageCms = None
 from io import BytesIO
 from datetime import timedelta
 
-from app_with_ui.models import ThumbnailType, ExpiredLink
+from app_with_ui.blobs import get_file_sha256, store_blob_file, get_or_create_blob, get_derivative_blobs, \
+    add_derivative_blob, add_image_blob_references, store_webp_variant, change_blob_references, keep_found_blobs
+from app_with_ui.image_pool import image_pool, ImagePoolBusy
+from app_with_ui.instrumentation import timed
+from app_with_ui.list_cache import bump_images_generations
+from app_with_ui.models import ExpiredLink, Image, Blob, BlobDerivative, ThumbnailType
+from app_with_ui.serving import serve_file, aserve_file, get_webp_variant_name
+from app_with_ui.tier_cache import get_tier_policy
+from app_with_ui.type_registry import thumbnail_type_registry
+from image_project.settings import domain_and_port_for_link
 
+SIGNED_LINK_SALT = 'app_with_ui.signed_expiry_link'
+DEFAULT_ENCODING_PROFILE = {
+    'quality': 90,
+    'chroma_subsampling': '',
+    'progressive': False,
+    'optimize': False,
+    'strip_metadata': False,
+    'max_bytes': None,
+}
+TEMP_SWEEP_CHECKPOINT_KEY = 'app_with_ui.temp_sweep_checkpoint'
+TEMP_DIR = 'temp'
+ORIGINAL_TITLE_SUFFIX = '(original image)'
+THUMBNAIL_TITLE_RE = re.compile(r'^(.*)\(\d+px thumbnail\)$')
 
+
+@timed('image_probe')
 def get_original_image_size(image):
     original_image = img.open(image)
     width, height = original_image.size
     return width, height
 
 
-def resize_image(image) -> list:
-    """Resizing ogirinal image to thumbnails according thumbnail types defined via admin panel"""
+def get_image_format(image):
+    """Getting Pillow format name from image file extension"""
 
-    image_format = str(image).split('.')[-1]
-    file_name = str(image).split('/')[-1]
+    image_format = str(image).split('.')[-1].lower()
     if image_format == 'jpg':
         image_format = 'jpeg'
-    heigth_sizes = []
+    return image_format
+
+
+def open_image_for_heigth(image, heigth):
+    """
+    Opening image for decoding into thumbnail of given height.
+    JPEG images are decoded with draft mode, so decoder scales image down by DCT
+    and full size pixels of big originals are never loaded into memory
+    """
+
+    work_image = img.open(image)
+    width, original_heigth = work_image.size
+    if work_image.format == 'JPEG' and heigth < original_heigth:
+        work_image.draft(work_image.mode, (int(heigth * (width / original_heigth)), heigth))
+    work_image.load()
+    return work_image, width, original_heigth
+
+
+def encode_image(work_image, image_format, file_name, profile=None):
+    """Saving Pillow image into in-memory file which can be assigned to ImageField"""
+
+    content = encode_image_content(work_image, image_format, profile)
+    return get_in_memory_file(BytesIO(content), image_format, file_name)
+
+
+def get_save_options(image_format, profile, quality):
+    """Getting Pillow save options of encoding profile (see ThumbnailType.get_encoding_profile)"""
+
+    if image_format == 'jpeg':
+        options = {'quality': quality, 'progressive': profile['progressive'], 'optimize': profile['optimize']}
+        if profile['chroma_subsampling']:
+            options['subsampling'] = profile['chroma_subsampling']
+    elif image_format == 'webp':
+        options = {'quality': quality, 'method': 6 if profile['optimize'] else 4}
+    else:
+        options = {'quality': quality, 'optimize': profile['optimize']}
+    if profile['strip_metadata']:
+        options.update(exif=b'', icc_profile=None)
+    return options
+
+
+def convert_to_srgb(work_image):
+    """Converting image with embedded ICC profile to sRGB, so colors are kept when profile is stripped"""
+
+    icc_profile = work_image.info.get('icc_profile')
+    if ImageCms is None or not icc_profile or work_image.mode not in ('RGB', 'RGBA'):
+        return work_image
+    try:
+        return ImageCms.profileToProfile(
+            work_image,
+            ImageCms.ImageCmsProfile(BytesIO(icc_profile)),
+            ImageCms.createProfile('sRGB'),
+            outputMode=work_image.mode
+        )
+    except (ImageCms.PyCMSError, OSError):
+        return work_image
+
+
+def save_image_content(work_image, image_format, options):
+    filestream = BytesIO()
+    work_image.save(filestream, f'{image_format.upper()}', **options)
+    return filestream.getvalue()
+
+
+def encode_image_content(work_image, image_format, profile=None):
+    """
+    Encoding image according to encoding profile. If profile has max_bytes, quality is lowered by binary search
+    to the highest one which fits (the smallest result is returned if none fits). PNG has no quality to lower
+    """
+
+    profile = profile or DEFAULT_ENCODING_PROFILE
+    if profile['strip_metadata']:
+        work_image = convert_to_srgb(work_image)
+    content = save_image_content(work_image, image_format, get_save_options(image_format, profile, profile['quality']))
+    max_bytes = profile['max_bytes']
+    if not max_bytes or len(content) <= max_bytes or image_format not in ('jpeg', 'webp'):
+        return content
+
+    best_content = content
+    lowest_quality, highest_quality = 1, profile['quality'] - 1
+    while lowest_quality <= highest_quality:
+        quality = (lowest_quality + highest_quality) // 2
+        content = save_image_content(work_image, image_format, get_save_options(image_format, profile, quality))
+        if len(content) <= max_bytes:
+            best_content = content
+            lowest_quality = quality + 1
+        else:
+            best_content = min(best_content, content, key=len)
+            highest_quality = quality - 1
+    return best_content
+
+
+def get_in_memory_file(filestream, image_format, file_name):
+    return InMemoryUploadedFile(
+        filestream, 'ImageField', file_name, f'image/{image_format}', filestream.getbuffer().nbytes, None
+    )
+
+
+def read_image_content(image):
+    image.seek(0)
+    return image.read()
+
+
+def render_thumbnail_chain(content, sizes, image_format):
+    """
+    Rendering chain of thumbnails of sizes [(heigth, webp, profile)] sorted from the biggest height from encoded image.
+    Image is decoded only once and every next thumbnail is made from the previous one. Returns list of
+    (content, width, content of WebP variant or None). Runs in image pool
+    """
+
+    work_image, width, original_heigth = open_image_for_heigth(BytesIO(content), sizes[0][0])
+    renders = []
+    for heigth, webp, profile in sizes:
+        new_width = int(heigth * (width / original_heigth))
+        work_image.thumbnail((new_width, heigth))
+        webp_content = encode_image_content(work_image, 'webp', profile) if webp else None
+        renders.append((encode_image_content(work_image, image_format, profile), new_width, webp_content))
+    return renders
+
+
+def split_into_chains(sizes, chains_count):
+    """Splitting sizes sorted by height into contiguous chains of (almost) equal length"""
+
+    chains_count = min(chains_count, len(sizes))
+    chain_length, longer_chains = divmod(len(sizes), chains_count)
+    chains = []
+    start = 0
+    for number in range(chains_count):
+        end = start + chain_length + (1 if number < longer_chains else 0)
+        chains.append(sizes[start:end])
+        start = end
+    return chains
+
+
+@timed('image_resize')
+def resize_image(image, types=None) -> list:
+    """
+    Resizing ogirinal image to thumbnails according thumbnail types defined via admin panel
+    (or given types sorted by height in descending order).
+    Original image is decoded only once, thumbnails are built from the biggest to the smallest one and every next
+    thumbnail is made from the previous (bigger) one. If image pool is enabled, sizes are split into such chains
+    which are rendered by parallel processes. Thumbnails are encoded with encoding profiles of their types.
+    Content of WebP variant is set to webp_content attribute of thumbnail file for types with generate_webp
+    """
+
+    image_format = get_image_format(image)
+    file_name = str(image).split('/')[-1]
     heigth_sizes_and_types = []
-    types = ThumbnailType.objects.all()
+    if types is None:
+        types = thumbnail_type_registry.get_sized_types()
+    if not types:
+        return heigth_sizes_and_types
 
-    for thumbnail_type in types:
-        if thumbnail_type.heigth_size_in_pixels:
-            heigth_sizes.append(thumbnail_type.heigth_size_in_pixels)
+    if image_pool.is_enabled() and len(types) > 1:
+        # Sizes are split into chains for processes of image pool, every chain decodes original only once
+        # (smaller chains decode it in smaller draft size)
+        content = read_image_content(image)
+        sizes = [
+            (thumbnail_type.heigth_size_in_pixels, thumbnail_type.generate_webp, thumbnail_type.get_encoding_profile())
+            for thumbnail_type in types
+        ]
+        chains = split_into_chains(sizes, image_pool.get_workers_count())
+        renders = [
+            render
+            for chain_renders in image_pool.map(
+                render_thumbnail_chain, [(content, chain, image_format) for chain in chains]
+            )
+            for render in chain_renders
+        ]
+        for thumbnail_type, (thumbnail_content, new_width, webp_content) in zip(types, renders):
+            thumbnail_image = get_in_memory_file(BytesIO(thumbnail_content), image_format, file_name)
+            thumbnail_image.webp_content = webp_content
+            new_heigth = thumbnail_type.heigth_size_in_pixels
+            heigth_sizes_and_types.append((thumbnail_image, thumbnail_type, new_width, new_heigth))
+        return heigth_sizes_and_types
 
-    for new_heigth in heigth_sizes:
-        work_image = img.open(image)
-        width, heigth = work_image.size
+    work_image, width, heigth = open_image_for_heigth(image, types[0].heigth_size_in_pixels)
+    for thumbnail_type in types:
+        new_heigth = thumbnail_type.heigth_size_in_pixels
         new_width = int(new_heigth * (width / heigth))
-        new_size = (new_width, new_heigth)
-        work_image.thumbnail(new_size)
-        filestream = BytesIO()
-        work_image.save(filestream, f'{image_format.upper()}', quality=90)
-        filestream.seek(0)
-        thumbnail_type = ThumbnailType.objects.get(heigth_size_in_pixels=new_heigth)
-        thumbnail_image = InMemoryUploadedFile(
-                filestream, 'ImageField', file_name, 'jpeg/image', sys.getsizeof(filestream), None
-            )
+        work_image.thumbnail((new_width, new_heigth))
+        profile = thumbnail_type.get_encoding_profile()
+        thumbnail_image = encode_image(work_image, image_format, file_name, profile)
+        thumbnail_image.webp_content = None
+        if thumbnail_type.generate_webp:
+            thumbnail_image.webp_content = encode_image_content(work_image, 'webp', profile)
         image_and_type = (thumbnail_image, thumbnail_type, new_width, new_heigth)
         heigth_sizes_and_types.append(image_and_type)
     return heigth_sizes_and_types
 
 
+@timed('image_render')
+def render_thumbnail(image, heigth, image_format, profile=None):
+    """Rendering single thumbnail of given height from image in image pool and returning its encoded content"""
+
+    return image_pool.run(
+        render_thumbnail_chain, read_image_content(image), [(heigth, False, profile)], image_format
+    )[0][0]
+
+
+def get_or_create_original_blob(uploaded_file):
+    """
+    Finding blob with the same content as uploaded file or storing file in blob store.
+    Size of image is probed only for new content
+    """
+
+    sha256 = get_file_sha256(uploaded_file)
+    blob = Blob.objects.filter(sha256=sha256).first()
+    if blob is not None and not keep_found_blobs([blob.id]):
+        blob = None
+    if blob is None:
+        width, height = get_original_image_size(uploaded_file)
+        blob = get_or_create_blob(sha256, store_blob_file(uploaded_file, sha256), uploaded_file.size, width, height)
+    return blob
+
+
+def attach_blob(image, blob):
+    image.blob = blob
+    image.image = blob.file.name
+    image.width, image.height = blob.width, blob.height
+
+
+def store_thumbnail_files(image, types):
+    """
+    Rendering thumbnails of given types and writing them (and their WebP variants) to blob store.
+    Does not touch DB, so can be run in thread. Returns list of (sha256, file name, size, width, height)
+    """
+
+    thumbnails = []
+    for thumbnail_file, thumbnail_type, width, height in resize_image(image, types):
+        sha256 = get_file_sha256(thumbnail_file)
+        name = store_blob_file(thumbnail_file, sha256)
+        if thumbnail_file.webp_content is not None:
+            store_webp_variant(name, thumbnail_file.webp_content)
+        thumbnails.append((sha256, name, thumbnail_file.size, width, height))
+    return thumbnails
+
+
+def save_thumbnail_blobs(source_blob, thumbnails):
+    """Creating blobs of stored thumbnails and linking them to source blob. Returns dict {heigth: blob}"""
+
+    blobs = {}
+    for sha256, name, size, width, height in thumbnails:
+        blob = get_or_create_blob(sha256, name, size, width, height)
+        if source_blob is not None:
+            blob = add_derivative_blob(source_blob, height, blob)
+        blobs[height] = blob
+    return blobs
+
+
+def build_thumbnail_images(original_image, title, types, blobs):
+    thumbnail_images = []
+    for thumbnail_type in types:
+        blob = blobs.get(thumbnail_type.heigth_size_in_pixels)
+        if blob is None:
+            continue
+        thumbnail_image = Image(
+            type=thumbnail_type,
+            user=original_image.user,
+            title=f'{title}({blob.height}px thumbnail)',
+            original=original_image if original_image.pk is not None else None
+        )
+        attach_blob(thumbnail_image, blob)
+        thumbnail_images.append(thumbnail_image)
+    return thumbnail_images
+
+
+def get_allowed_sized_types(user, type_ids=None):
+    """
+    Getting thumbnail types with height which account tier of user allows (only given ones if type_ids are passed),
+    from the biggest to the smallest one
+    """
+
+    tier_policy = get_tier_policy(user.account_tier_id)
+    if not tier_policy:
+        return []
+    allowed_type_ids = set(tier_policy['allowed_image_type_ids'])
+    if type_ids is not None:
+        allowed_type_ids &= set(type_ids)
+    return [
+        thumbnail_type for thumbnail_type in thumbnail_type_registry.get_sized_types()
+        if thumbnail_type.id in allowed_type_ids
+    ]
+
+
+def get_newly_allowed_type_ids(old_account_tier_id, new_account_tier_id):
+    """Getting ids of thumbnail types which are allowed by new account tier, but were not allowed by old one"""
+
+    new_policy = get_tier_policy(new_account_tier_id)
+    if not new_policy:
+        return []
+    old_policy = get_tier_policy(old_account_tier_id)
+    old_type_ids = set(old_policy['allowed_image_type_ids']) if old_policy else set()
+    return sorted(set(new_policy['allowed_image_type_ids']) - old_type_ids)
+
+
+def get_original_title(original_image):
+    """Getting title which was given by user to original image (UI adds suffix to it)"""
+
+    if original_image.title.endswith(ORIGINAL_TITLE_SUFFIX):
+        return original_image.title[:-len(ORIGINAL_TITLE_SUFFIX)]
+    return original_image.title
+
+
+def link_unlinked_thumbnails(original_image, types):
+    """
+    Linking thumbnails of given types which were made before thumbnails were linked to originals and were not linked
+    by migration: thumbnail '<title>(<h>px thumbnail)' of the same user made after original image.
+    Only types which original image has no thumbnails of are linked. It is not run for new uploads, only before
+    thumbnails of existing images are made (backfill, new types of account tier), so legacy ones are not duplicated
+    """
+
+    existing_type_ids = set(original_image.thumbnails.values_list('type_id', flat=True))
+    types = [thumbnail_type for thumbnail_type in types if thumbnail_type.id not in existing_type_ids]
+    if not types:
+        return
+    title = get_original_title(original_image)
+    thumbnails = Image.objects.filter(
+        user_id=original_image.user_id,
+        original__isnull=True,
+        type__in=types,
+        title__startswith=f'{title}(',
+        title__endswith='px thumbnail)',
+        upload_date__gte=original_image.upload_date
+    )
+    linked_type_ids = set()
+    for thumbnail_id, thumbnail_title, type_id in thumbnails.order_by('upload_date', 'id').values_list(
+        'id', 'title', 'type_id'
+    ):
+        match = THUMBNAIL_TITLE_RE.match(thumbnail_title)
+        if type_id in linked_type_ids or match is None or match.group(1) != title:
+            continue
+        Image.objects.filter(id=thumbnail_id).update(original=original_image)
+        linked_type_ids.add(type_id)
+
+
+def create_thumbnails(original_image, title, types=None):
+    """
+    Creating thumbnail images of uploaded original image in DB (of types allowed by account tier of user
+    or given ones), users never get thumbnails they can not see. Types which original image already has
+    thumbnails of are skipped, so it can be run again.
+    Thumbnails which were already made from the same content are taken from blob store without resizing.
+    Returns created thumbnail images
+    """
+
+    if types is None:
+        types = get_allowed_sized_types(original_image.user)
+    existing_type_ids = set(original_image.thumbnails.values_list('type_id', flat=True))
+    types = [thumbnail_type for thumbnail_type in types if thumbnail_type.id not in existing_type_ids]
+    if not types:
+        return []
+    source_blob = original_image.blob
+    blobs = get_derivative_blobs(source_blob) if source_blob is not None else {}
+    missing_types = [thumbnail_type for thumbnail_type in types if thumbnail_type.heigth_size_in_pixels not in blobs]
+    if missing_types:
+        blobs.update(save_thumbnail_blobs(source_blob, store_thumbnail_files(original_image.image, missing_types)))
+
+    thumbnail_images = build_thumbnail_images(original_image, title, types, blobs)
+    Image.objects.bulk_create(thumbnail_images)
+    add_image_blob_references(thumbnail_images)
+    bump_images_generations([original_image.user_id])
+    return thumbnail_images
+
+
+def get_originals_missing_type(thumbnail_type):
+    """Getting original images which have no thumbnail of given type, though account tier of their user allows it"""
+
+    return Image.objects.filter(
+        type__is_original=True,
+        user__account_tier__allowed_image_types=thumbnail_type
+    ).filter(
+        ~Exists(Image.objects.filter(original=OuterRef('pk'), type=thumbnail_type))
+    )
+
+
+def backfill_thumbnails(original_ids, thumbnail_type_id):
+    """
+    Creating thumbnails of given type for original images which do not have them yet (e.g. type was added later).
+    Every image is processed in its own transaction. Returns number of created thumbnails
+    """
+
+    thumbnail_type = ThumbnailType.objects.get(id=thumbnail_type_id)
+    created = 0
+    for original_image in Image.objects.select_related('user', 'blob').filter(id__in=original_ids).order_by('id'):
+        with transaction.atomic():
+            link_unlinked_thumbnails(original_image, [thumbnail_type])
+            created += len(create_thumbnails(original_image, get_original_title(original_image), [thumbnail_type]))
+    return created
+
+
+def create_missing_thumbnails(user, type_ids, batch_size=100):
+    """
+    Creating thumbnails of given types for all original images of user (e.g. types became allowed by new
+    account tier). Images are loaded by batches and every image is processed in its own transaction.
+    Returns number of created thumbnails
+    """
+
+    types = get_allowed_sized_types(user, type_ids)
+    if not types:
+        return 0
+    created = 0
+    last_id = 0
+    while True:
+        original_images = list(
+            Image.objects.select_related('user', 'blob').filter(
+                user=user,
+                type__is_original=True,
+                id__gt=last_id
+            ).order_by('id')[:batch_size]
+        )
+        if not original_images:
+            return created
+        for original_image in original_images:
+            with transaction.atomic():
+                link_unlinked_thumbnails(original_image, types)
+                created += len(create_thumbnails(original_image, get_original_title(original_image), types))
+        last_id = original_images[-1].id
+
+
+def prepare_batch_content(uploaded_file, sha256, blob, missing_types):
+    """
+    Writing new content of uploaded file and its missing thumbnails to blob store.
+    Does not touch DB, so runs in worker thread. Returns (original file data or None, thumbnails)
+    """
+
+    try:
+        original = None
+        if blob is None:
+            width, height = get_original_image_size(uploaded_file)
+        uploaded_file.seek(0)
+        thumbnails = store_thumbnail_files(uploaded_file, missing_types)
+        if blob is None:
+            original = (store_blob_file(uploaded_file, sha256), uploaded_file.size, width, height)
+    except (OSError, img.DecompressionBombError) as error:
+        raise ValidationError(f'File is not a valid image: {error}')
+    return original, thumbnails
+
+
+def create_images_batch(user, original_type, uploaded_files):
+    """
+    Creating original images and thumbnails (of types allowed by account tier of user) of many uploaded files.
+    Every new content is processed once in parallel threads (Pillow releases GIL while decoding and encoding),
+    content which is already in blob store is not processed at all. All rows are inserted in one transaction,
+    originals and thumbnails by two bulk_create (originals are saved one by one on DB backends which do not
+    return ids from bulk insert). Returns list of (uploaded_file, original_image or None, error or None)
+    in order of uploaded files
+    """
+
+    thumbnail_types = get_allowed_sized_types(user)
+    errors = {}
+    hashes = {}
+    for uploaded_file in uploaded_files:
+        try:
+            for validator in Image._meta.get_field('image').validators:
+                validator(uploaded_file)
+        except ValidationError as error:
+            errors[uploaded_file] = ' '.join(error.messages)
+            continue
+        hashes[uploaded_file] = get_file_sha256(uploaded_file)
+    contents = {}
+    for uploaded_file, sha256 in hashes.items():
+        contents.setdefault(sha256, uploaded_file)
+
+    blobs = {blob.sha256: blob for blob in Blob.objects.filter(sha256__in=contents)}
+    kept_blob_ids = keep_found_blobs([blob.id for blob in blobs.values()])
+    blobs = {sha256: blob for sha256, blob in blobs.items() if blob.id in kept_blob_ids}
+    derivative_blobs = {sha256: get_derivative_blobs(blob) for sha256, blob in blobs.items()}
+    prepared = {}
+    content_errors = {}
+    with ThreadPoolExecutor(max_workers=settings.BATCH_UPLOAD_MAX_WORKERS) as executor:
+        futures = {}
+        for sha256, uploaded_file in contents.items():
+            missing_types = [
+                thumbnail_type for thumbnail_type in thumbnail_types
+                if thumbnail_type.heigth_size_in_pixels not in derivative_blobs.get(sha256, {})
+            ]
+            if sha256 in blobs and not missing_types:
+                continue
+            futures[sha256] = executor.submit(
+                prepare_batch_content, uploaded_file, sha256, blobs.get(sha256), missing_types
+            )
+        for sha256, future in futures.items():
+            try:
+                prepared[sha256] = future.result()
+            except ValidationError as error:
+                content_errors[sha256] = ' '.join(error.messages)
+            except ImagePoolBusy as error:
+                content_errors[sha256] = str(error)
+    for uploaded_file, sha256 in hashes.items():
+        if sha256 in content_errors:
+            errors[uploaded_file] = content_errors[sha256]
+
+    original_images = {}
+    with transaction.atomic():
+        for sha256, (original, thumbnails) in prepared.items():
+            if original is not None:
+                blobs[sha256] = get_or_create_blob(sha256, *original)
+            derivative_blobs.setdefault(sha256, {}).update(save_thumbnail_blobs(blobs[sha256], thumbnails))
+
+        for uploaded_file, sha256 in hashes.items():
+            if uploaded_file in errors:
+                continue
+            title = os.path.splitext(uploaded_file.name)[0][:Image._meta.get_field('title').max_length]
+            original_image = Image(user=user, type=original_type, title=title)
+            attach_blob(original_image, blobs[sha256])
+            original_images[uploaded_file] = original_image
+        if connection.features.can_return_rows_from_bulk_insert:
+            Image.objects.bulk_create(original_images.values())
+            add_image_blob_references(original_images.values())
+        else:
+            # Originals must have ids for links of thumbnails and response (e.g. SQLite), blob references
+            # are added by post_save signal
+            for original_image in original_images.values():
+                original_image.save()
+
+        thumbnail_images = []
+        for uploaded_file, original_image in original_images.items():
+            thumbnail_images.extend(build_thumbnail_images(
+                original_image, original_image.title, thumbnail_types, derivative_blobs[hashes[uploaded_file]]
+            ))
+        Image.objects.bulk_create(thumbnail_images)
+        add_image_blob_references(thumbnail_images)
+    bump_images_generations([user.id])
+    return [
+        (uploaded_file, original_images.get(uploaded_file), errors.get(uploaded_file))
+        for uploaded_file in uploaded_files
+    ]
+
+
 def set_link_expiring_datetime(user_expiry_time_seconds):
     now = timezone.now()
     exp_datetime_seconds = timedelta(seconds=user_expiry_time_seconds)
@@ -61,14 +599,6 @@ def set_link_expiring_datetime(user_expiry_time_seconds):
     return link_exp_datetime
 
 
-def get_base64_encode_image(path):
-    """Converting image into base64 format for storing in DB"""
-    image = open(path[1:], 'rb')
-    image_64_encode = base64.b64encode(image.read())
-    image.close()
-    return image_64_encode
-
-
 def is_link_expired(link_expiring_date_time):
     """Checking if link is expired"""
 
@@ -76,59 +606,281 @@ def is_link_expired(link_expiring_date_time):
     return now > link_expiring_date_time
 
 
-def open_image_by_exp_link(expiring_link_obj):
-    if not os.path.isdir(f'media/temp'):
-        os.mkdir('media/temp')
-    if not os.path.isdir(f'media/temp/{expiring_link_obj.user.username}'):
-        os.mkdir(f'media/temp/{expiring_link_obj.user.username}')
-    if not os.path.isdir(f'media/temp/{expiring_link_obj.user.username}/{expiring_link_obj.uuid_link}'):
-        os.mkdir(f'media/temp/{expiring_link_obj.user.username}/{expiring_link_obj.uuid_link}')
-        img_base_64 = expiring_link_obj.image_base_64
-        image_64_decode = base64.b64decode(img_base_64)
-        img_file = BytesIO(image_64_decode)
-        decoded_image = img.open(img_file)
-        format = decoded_image.format.lower()
-        filename = f'file.{format}'
-        path = f'media/temp/{expiring_link_obj.user.username}/{expiring_link_obj.uuid_link}'
-        decoded_image.save(f'{path}/{filename}', format=format)
-        return HttpResponse(f'<img src="../../{path}/{filename}" width="50%">')
-    path = f'media/temp/{expiring_link_obj.user.username}/{expiring_link_obj.uuid_link}'
-    filename = os.listdir(path)[0]
-    return HttpResponse(f'<img src="../../{path}/{filename}" width="50%">')
-
-
-def delete_expired_link_image(link, username):
-    """Deleting image from server if link is expired """
-
-    path = f'media/temp/{username}/{link}'
+def sign_expiry_link(image, expiry_date_time):
+    """Signing image file and expiry timestamp with HMAC, so link can be validated without DB"""
+
+    return signing.Signer(salt=SIGNED_LINK_SALT).sign_object({
+        'id': image.id,
+        'type': image.type_id,
+        'file': image.image.name,
+        'exp': int(expiry_date_time.timestamp()),
+    })
+
+
+def unsign_expiry_link(token):
+    """Validating signed link and returning name of image file. Raises BadSignature or SignatureExpired"""
+
+    payload = signing.Signer(salt=SIGNED_LINK_SALT).unsign_object(token)
+    if time.time() > payload['exp']:
+        raise signing.SignatureExpired('Signed link is expired')
+    return payload['file']
+
+
+def get_expiry_link(image, expiry_date_time, uuid_link):
+    """Building URL of expiry link. If EXPIRY_LINKS_SIGNED setting is enabled link is signed"""
+
+    if settings.EXPIRY_LINKS_SIGNED:
+        return f'{domain_and_port_for_link}/signed/{sign_expiry_link(image, expiry_date_time)}/'
+    return f'{domain_and_port_for_link}/temp/{uuid_link}/'
+
+
+def is_expiry_link_recorded():
+    """Checking if created expiry link should be stored in DB (signed links are stored only for listing)"""
+
+    return not settings.EXPIRY_LINKS_SIGNED or settings.EXPIRY_LINKS_RECORD_SIGNED
+
+
+def resolve_signed_link(token):
+    """Getting name of image file by signed link. Returns (name, None) or (None, error message)"""
+
+    try:
+        return unsign_expiry_link(token), None
+    except signing.SignatureExpired:
+        return None, 'Your link is expired :('
+    except signing.BadSignature:
+        return None, 'Your link is incorrect :('
+
+
+def show_image_by_signed_link(request, token):
+    """Showing image by signed expiry link. Link is validated by signature only, DB is not used"""
+
+    image_name, error = resolve_signed_link(token)
+    if error is not None:
+        return HttpResponse(error)
     try:
-        shutil.rmtree(path, ignore_errors=True)
-    except:
-        return HttpResponse('Ooooops, it seems something went wrong :-{')
+        return serve_file(request, image_name)
+    except FileNotFoundError:
+        return HttpResponse('Your link is incorrect :(')
+
+
+async def ashow_image_by_signed_link(request, token):
+    """Async version of show_image_by_signed_link"""
+
+    image_name, error = resolve_signed_link(token)
+    if error is not None:
+        return HttpResponse(error)
+    try:
+        return await aserve_file(request, image_name)
+    except FileNotFoundError:
+        return HttpResponse('Your link is incorrect :(')
 
 
-def show_image_by_exp_link(link):
+def delete_expired_links(batch_size, deadline):
+    """
+    Deleting expired links from DB by batches selected via index on expiry date, until deadline (monotonic time).
+    Every batch is committed separately, so interrupted run is continued by the next one
+    """
+
+    deleted_links = 0
+    now = timezone.now()
+    while time.monotonic() < deadline:
+        batch = list(
+            ExpiredLink.objects.filter(expiry_date_time__lte=now)
+            .order_by('expiry_date_time')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not batch:
+            break
+        deleted, _ = ExpiredLink.objects.filter(id__in=batch).delete()
+        deleted_links += deleted
+    return deleted_links
+
+
+def delete_blob_derivatives(heigths, batch_size=1000):
+    """
+    Deleting derivatives of given heights in batches, so thumbnails are made again with current settings
+    of thumbnail types. Blobs of deleted derivatives are deleted by cleanup task if images do not use them
+    """
+
+    deleted_derivatives = 0
+    while True:
+        batch = list(BlobDerivative.objects.filter(heigth__in=heigths).values_list('id', flat=True)[:batch_size])
+        if not batch:
+            return deleted_derivatives
+        deleted, _ = BlobDerivative.objects.filter(id__in=batch).delete()
+        deleted_derivatives += deleted
+
+
+def delete_unreferenced_blobs(batch_size, deadline):
+    """
+    Deleting blobs which are not referenced by images and thumbnail derivatives for longer than BLOB_GRACE_SECONDS.
+    Upload which finds unreferenced blob restarts its grace period (see keep_found_blobs), rows are locked
+    while they are deleted, so upload waits for the end of deletion and does not reuse deleted blob.
+    Files are removed after rows are deleted
+    """
+
+    deleted_blobs = 0
+    unreferenced_before = timezone.now() - timedelta(seconds=settings.BLOB_GRACE_SECONDS)
+    while time.monotonic() < deadline:
+        with transaction.atomic():
+            batch = list(
+                Blob.objects.select_for_update()
+                .filter(ref_count=0, unreferenced_at__lt=unreferenced_before)
+                .filter(~Exists(BlobDerivative.objects.filter(blob=OuterRef('pk'))))
+                .filter(~Exists(Image.objects.filter(blob=OuterRef('pk'))))
+                .order_by('unreferenced_at')
+                .values_list('id', 'file')[:batch_size]
+            )
+            if not batch:
+                break
+            Blob.objects.filter(id__in=[blob_id for blob_id, _ in batch]).delete()
+        for _, name in batch:
+            default_storage.delete(name)
+            default_storage.delete(get_webp_variant_name(name))
+        deleted_blobs += len(batch)
+    return deleted_blobs
+
+
+def sweep_orphan_link_files(batch_size, deadline):
+    """
+    Removing directories in temp (temp/<username>/<uuid_link>) of media storage which do not belong to active links.
+    Sweep checks at most batch_size directories per run and saves last checked directory in cache as checkpoint,
+    so every next run continues from the place where previous one was stopped
+    """
+
+    try:
+        usernames, _ = default_storage.listdir(TEMP_DIR)
+    except FileNotFoundError:
+        return 0
+    checkpoint_username, checkpoint_link_dir = cache.get(TEMP_SWEEP_CHECKPOINT_KEY, ('', ''))
+    checked_dirs = 0
+    removed_dirs = 0
+    for username in sorted(username for username in usernames if username >= checkpoint_username):
+        if checked_dirs >= batch_size or time.monotonic() >= deadline:
+            cache.set(TEMP_SWEEP_CHECKPOINT_KEY, (username, ''), None)
+            return removed_dirs
+        user_dir = f'{TEMP_DIR}/{username}'
+        try:
+            link_dirs, _ = default_storage.listdir(user_dir)
+        except FileNotFoundError:
+            continue
+        link_dirs = sorted(
+            link_dir for link_dir in link_dirs
+            if username > checkpoint_username or link_dir > checkpoint_link_dir
+        )
+        checked_link_dirs = link_dirs[:batch_size - checked_dirs]
+        active_links = {
+            str(uuid_link) for uuid_link in ExpiredLink.objects.filter(
+                uuid_link__in=[link_dir for link_dir in checked_link_dirs if is_uuid(link_dir)],
+                expiry_date_time__gt=timezone.now()
+            ).values_list('uuid_link', flat=True)
+        }
+        for link_dir in checked_link_dirs:
+            if link_dir not in active_links:
+                delete_storage_dir(f'{user_dir}/{link_dir}')
+                removed_dirs += 1
+        checked_dirs += len(checked_link_dirs)
+        if len(checked_link_dirs) < len(link_dirs):
+            cache.set(TEMP_SWEEP_CHECKPOINT_KEY, (username, checked_link_dirs[-1]), None)
+            return removed_dirs
+        if not any(default_storage.listdir(user_dir)):
+            default_storage.delete(user_dir)
+    cache.set(TEMP_SWEEP_CHECKPOINT_KEY, ('', ''), None)
+    return removed_dirs
+
+
+def delete_storage_dir(path):
+    """Deleting directory of media storage with all its content"""
+
+    dirs, files = default_storage.listdir(path)
+    for file_name in files:
+        default_storage.delete(f'{path}/{file_name}')
+    for dir_name in dirs:
+        delete_storage_dir(f'{path}/{dir_name}')
+    default_storage.delete(path)
+
+
+def relocate_image_file(image, delete_old_file=True):
+    """
+    Moving file of image stored by old layout (<username>/<type>/<filename>) to blob store.
+    Returns False if file does not exist in storage
+    """
+
+    old_name = image.image.name
+    try:
+        with default_storage.open(old_name) as old_file:
+            sha256 = get_file_sha256(old_file)
+            blob = Blob.objects.filter(sha256=sha256).first()
+            if blob is None:
+                if image.width and image.height:
+                    width, height = image.width, image.height
+                else:
+                    width, height = get_original_image_size(old_file)
+                name = store_blob_file(old_file, sha256)
+                blob = get_or_create_blob(sha256, name, old_file.size, width, height)
+    except FileNotFoundError:
+        return False
+
+    with transaction.atomic():
+        relocated = Image.objects.filter(id=image.id, blob__isnull=True).update(blob=blob, image=blob.file.name)
+        if relocated:
+            change_blob_references(blob.id, 1)
+    if relocated:
+        bump_images_generations([image.user_id])
+    if relocated and delete_old_file and old_name != blob.file.name:
+        default_storage.delete(old_name)
+    return True
+
+
+def is_uuid(value):
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
+def resolve_exp_link(link):
+    """
+    Getting name of image file by expiry link. Returns (name, None) or (None, error message).
+    Expired link is deleted
+    """
+    try:
+        expiring_link_obj = ExpiredLink.objects.select_related('image').filter(uuid_link=link).first()
+    except ValidationError:
+        return None, 'Your link is incorrect :('
+    if expiring_link_obj is None:
+        return None, 'Your link is expired :('
+    if is_link_expired(expiring_link_obj.expiry_date_time):
+        expiring_link_obj.delete()
+        return None, 'Your link is expired :('
+    return expiring_link_obj.image.image.name, None
+
+
+def show_image_by_exp_link(request, link):
     """
     This function was created to make sure that expiry link works and
     user can get an image by this link.
     Also it demonstrate that link can be expired.
-    If you will try go for it after the time is up you get error message instead of image
+    If you will try go for it after the time is up you get error message instead of image.
+    Image is streamed directly from storage
     """
+    image_name, error = resolve_exp_link(link)
+    if error is not None:
+        return HttpResponse(error)
     try:
-        if ExpiredLink.objects.filter(uuid_link=link).exists():
-            expiring_link_obj = ExpiredLink.objects.filter(uuid_link=link).first()
-            username = expiring_link_obj.user.username
-            if is_link_expired(expiring_link_obj.expiry_date_time):
-                delete_expired_link_image(link, username)
-                expiring_link_obj.delete()
-                return HttpResponse('Your link is expired :(')
-            else:
-                return open_image_by_exp_link(expiring_link_obj)
-        return HttpResponse('Your link is expired :(')
-    except ValidationError:
+        return serve_file(request, image_name)
+    except FileNotFoundError:
         return HttpResponse('Your link is incorrect :(')
 
 
+async def ashow_image_by_exp_link(request, link):
+    """Async version of show_image_by_exp_link, link is resolved by ORM in thread"""
 
-
-
+    image_name, error = await sync_to_async(resolve_exp_link)(link)
+    if error is not None:
+        return HttpResponse(error)
+    try:
+        return await aserve_file(request, image_name)
+    except FileNotFoundError:
+        return HttpResponse('Your link is incorrect :(')
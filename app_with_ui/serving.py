@@ -0,0 +1,259 @@
+import mimetypes
+import re
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+WEBP_VARIANT_SUFFIX = '.webp'
+
+
+def get_webp_variant_name(name):
+    return f'{name}{WEBP_VARIANT_SUFFIX}'
+
+
+def accepts_webp(request):
+    """Checking if client lists image/webp in Accept header with non-zero quality"""
+
+    for media_range in request.headers.get('Accept', '').split(','):
+        media_type, _, params = media_range.partition(';')
+        if media_type.strip().lower() != 'image/webp':
+            continue
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def negotiate_file_name(request, name):
+    """
+    Choosing WebP variant of image file if client accepts it and variant exists, otherwise file itself is served.
+    Original format can be forced by ?format=original (used for downloads)
+    """
+
+    if request.GET.get('format') == 'original' or name.endswith(WEBP_VARIANT_SUFFIX) or not accepts_webp(request):
+        return name
+    variant_name = get_webp_variant_name(name)
+    if default_storage.exists(variant_name):
+        return variant_name
+    return name
+
+
+def get_file_etag(size, last_modified):
+    """Building ETag from file size and modification time, so file content is never read for it"""
+
+    return f'"{size:x}-{last_modified:x}"'
+
+
+def parse_range_header(range_header, size):
+    """
+    Parsing single byte range from Range header. Returns (start, end) with inclusive end,
+    None if header can not be parsed (whole file is sent) and raises ValueError if range is not satisfiable
+    """
+
+    match = RANGE_RE.match(range_header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        raise ValueError('Range is not satisfiable')
+    return start, end
+
+
+def read_file_range(file, start, length):
+    """Reading part of file by chunks"""
+
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+def get_offload_response(name, content_type):
+    """
+    Building empty response with X-Accel-Redirect (nginx) or X-Sendfile header according to MEDIA_OFFLOAD setting,
+    so file is sent by front proxy. Returns None if offloading is disabled
+    """
+
+    if settings.MEDIA_OFFLOAD == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(f'{settings.MEDIA_OFFLOAD_INTERNAL_URL}{name}')
+        return response
+    if settings.MEDIA_OFFLOAD == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = default_storage.path(name)
+        return response
+    return None
+
+
+def get_content_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def get_file_stat(name):
+    """Getting size and modification timestamp of file in storage. Raises FileNotFoundError if file does not exist"""
+
+    return default_storage.size(name), int(default_storage.get_modified_time(name).timestamp())
+
+
+def serve_file(request, name):
+    """
+    Streaming file from storage. Supports conditional requests (ETag, Last-Modified, 304 responses)
+    and single range requests (206 responses). Raises FileNotFoundError if file does not exist.
+    If MEDIA_OFFLOAD setting is enabled, file is not read at all and sending of it is left to front proxy.
+    WebP variant of file is served to clients which accept it
+    """
+
+    name = negotiate_file_name(request, name)
+    content_type = get_content_type(name)
+    response = get_offload_response(name, content_type)
+    if response is None:
+        size, last_modified = get_file_stat(name)
+        response = get_conditional_file_response(request, name, size, last_modified, content_type, get_file_response)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+async def aserve_file(request, name):
+    """
+    Async version of serve_file. Storage is accessed in thread pool and, if request came through
+    StreamingASGIHandler, file is streamed by AsyncStreamingHttpResponse, so slow client does not pin a thread
+    """
+
+    name = await sync_to_async(negotiate_file_name, thread_sensitive=False)(request, name)
+    content_type = get_content_type(name)
+    response = get_offload_response(name, content_type)
+    if response is None:
+        size, last_modified = await sync_to_async(get_file_stat, thread_sensitive=False)(name)
+        get_response = get_async_file_response if is_async_streaming_supported(request) else get_file_response
+        response = get_conditional_file_response(request, name, size, last_modified, content_type, get_response)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def get_conditional_file_response(request, name, size, last_modified, content_type, get_response):
+    etag = get_file_etag(size, last_modified)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = get_response(request, name, size, etag, content_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def get_requested_range(request, size, etag):
+    """Getting byte range of request, None if whole file is requested. Raises ValueError if range is not satisfiable"""
+
+    range_header = request.headers.get('Range')
+    if range_header and request.headers.get('If-Range', etag) == etag:
+        return parse_range_header(range_header, size)
+    return None
+
+
+def get_range_not_satisfiable_response(size):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f'bytes */{size}'
+    return response
+
+
+def get_file_response(request, name, size, etag, content_type):
+    try:
+        byte_range = get_requested_range(request, size, etag)
+    except ValueError:
+        return get_range_not_satisfiable_response(size)
+
+    if byte_range is None:
+        return FileResponse(default_storage.open(name), content_type=content_type)
+
+    start, end = byte_range
+    length = end - start + 1
+    response = StreamingHttpResponse(
+        read_file_range(default_storage.open(name), start, length),
+        status=206,
+        content_type=content_type
+    )
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    return response
+
+
+def get_async_file_response(request, name, size, etag, content_type):
+    try:
+        byte_range = get_requested_range(request, size, etag)
+    except ValueError:
+        return get_range_not_satisfiable_response(size)
+
+    start, end = byte_range if byte_range is not None else (0, size - 1)
+    length = end - start + 1
+    response = AsyncStreamingHttpResponse(
+        aread_file_range(name, start, length),
+        status=206 if byte_range is not None else 200,
+        content_type=content_type
+    )
+    if byte_range is not None:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    return response
+
+
+async def aread_file_range(name, start, length):
+    """Reading part of file from storage by chunks in thread pool, so event loop is never blocked by disk"""
+
+    file = await sync_to_async(default_storage.open, thread_sensitive=False)(name)
+    try:
+        await sync_to_async(file.seek, thread_sensitive=False)(start)
+        while length > 0:
+            chunk = await sync_to_async(file.read, thread_sensitive=False)(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await sync_to_async(file.close, thread_sensitive=False)()
+
+
+def is_async_streaming_supported(request):
+    return getattr(request, 'async_streaming', False)
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+    Streaming response with async iterator of content. Django 3.2 sends only sync iterators,
+    so it can be sent only by StreamingASGIHandler (see app_with_ui.asgi)
+    """
+
+    is_async = True
+
+    @property
+    def streaming_content(self):
+        return self._iterator
+
+    @streaming_content.setter
+    def streaming_content(self, value):
+        self._iterator = value
+
+    def __iter__(self):
+        raise TypeError('AsyncStreamingHttpResponse can be sent only by StreamingASGIHandler')
@@ -0,0 +1,117 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from app_with_ui.blobs import change_blob_references
+from app_with_ui.list_cache import bump_images_generations
+from app_with_ui.models import AccountTier, ThumbnailType, Image
+from app_with_ui.tasks import delete_thumbnail_derivatives
+from app_with_ui.tier_cache import invalidate_tier_policies
+from app_with_ui.type_registry import thumbnail_type_registry
+
+
+# Cached policies and thumbnail types are dropped after commit, otherwise concurrent request could cache
+# the ones which are being changed again
+
+def invalidate_all_tier_policies():
+    invalidate_tier_policies(AccountTier.objects.values_list('id', flat=True))
+
+
+@receiver([post_save, post_delete], sender=AccountTier)
+def invalidate_account_tier_policy(sender, instance, **kwargs):
+    account_tier_id = instance.id
+    transaction.on_commit(lambda: invalidate_tier_policies([account_tier_id]))
+
+
+@receiver(m2m_changed, sender=AccountTier.allowed_image_types.through)
+def invalidate_allowed_image_types(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        account_tier_ids = [instance.id]
+    elif pk_set is not None:
+        account_tier_ids = list(pk_set)
+    else:
+        transaction.on_commit(invalidate_all_tier_policies)
+        return
+    transaction.on_commit(lambda: invalidate_tier_policies(account_tier_ids))
+
+
+@receiver([post_save, post_delete], sender=ThumbnailType)
+def invalidate_thumbnail_type(sender, instance, **kwargs):
+    """Heights of thumbnail types are cached in policies of account tiers, so all of them are invalidated"""
+
+    transaction.on_commit(thumbnail_type_registry.invalidate)
+    transaction.on_commit(invalidate_all_tier_policies)
+
+
+# Fields of thumbnail type which change content of thumbnails
+THUMBNAIL_CONTENT_FIELDS = [
+    'heigth_size_in_pixels', 'generate_webp', 'quality', 'chroma_subsampling', 'progressive', 'optimize',
+    'strip_metadata', 'max_bytes',
+]
+
+
+@receiver(pre_save, sender=ThumbnailType)
+def remember_thumbnail_content_fields(sender, instance, **kwargs):
+    instance.stored_content_fields = None
+    if instance.pk is not None:
+        instance.stored_content_fields = ThumbnailType.objects.filter(
+            pk=instance.pk
+        ).values(*THUMBNAIL_CONTENT_FIELDS).first()
+
+
+@receiver(post_save, sender=ThumbnailType)
+def drop_changed_thumbnail_derivatives(sender, instance, created, **kwargs):
+    """
+    Thumbnails made from blobs with previous height or encoding profile are not reused for new uploads anymore.
+    If only encoding was changed, derivatives of the height are dropped. If height was changed, derivatives
+    of old and new height are dropped unless another type has that height (they are made for it)
+    """
+
+    stored = getattr(instance, 'stored_content_fields', None)
+    if created or stored is None:
+        return
+    if all(stored[field] == getattr(instance, field) for field in THUMBNAIL_CONTENT_FIELDS):
+        return
+    old_heigth, new_heigth = stored['heigth_size_in_pixels'], instance.heigth_size_in_pixels
+    if old_heigth == new_heigth:
+        drop_thumbnail_derivatives([new_heigth])
+    else:
+        drop_thumbnail_derivatives(get_unused_heigths([old_heigth, new_heigth], instance.id))
+
+
+@receiver(post_delete, sender=ThumbnailType)
+def drop_deleted_thumbnail_derivatives(sender, instance, **kwargs):
+    drop_thumbnail_derivatives(get_unused_heigths([instance.heigth_size_in_pixels], instance.id))
+
+
+def get_unused_heigths(heigths, thumbnail_type_id):
+    used_heigths = set(ThumbnailType.objects.exclude(id=thumbnail_type_id).filter(
+        heigth_size_in_pixels__in=[heigth for heigth in heigths if heigth]
+    ).values_list('heigth_size_in_pixels', flat=True))
+    return [heigth for heigth in heigths if heigth and heigth not in used_heigths]
+
+
+def drop_thumbnail_derivatives(heigths):
+    heigths = [heigth for heigth in heigths if heigth]
+    if heigths:
+        transaction.on_commit(lambda: delete_thumbnail_derivatives.delay(heigths))
+
+
+@receiver(post_save, sender=Image)
+def add_blob_reference(sender, instance, created, **kwargs):
+    if created and instance.blob_id is not None:
+        change_blob_references(instance.blob_id, 1)
+
+
+@receiver(post_delete, sender=Image)
+def remove_blob_reference(sender, instance, **kwargs):
+    if instance.blob_id is not None:
+        change_blob_references(instance.blob_id, -1)
+
+
+@receiver([post_save, post_delete], sender=Image)
+def bump_user_images_generation(sender, instance, **kwargs):
+    if instance.user_id is not None:
+        bump_images_generations([instance.user_id])
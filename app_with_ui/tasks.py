@@ -1,20 +1,61 @@
 from celery import shared_task
-import os
+from django.db import transaction
+import time
 
-from .models import ExpiredLink
-from .services import is_link_expired, delete_expired_link_image
+from .models import Image, User
+from .services import create_thumbnails, delete_expired_links, sweep_orphan_link_files, delete_unreferenced_blobs, \
+    backfill_thumbnails, create_missing_thumbnails, delete_blob_derivatives
 
 
 @shared_task
-def delete_expired_images():
-    print('I am here to destroy!')
-    for username in os.listdir('media/temp'):
-        for dir in os.listdir(f'media/temp/{username}'):
-            if ExpiredLink.objects.filter(uuid_link=dir).exists():
-                expiring_link_obj = ExpiredLink.objects.filter(uuid_link=dir).first()
-                if is_link_expired(expiring_link_obj.expiry_date_time):
-                    delete_expired_link_image(dir, username)
-                    expiring_link_obj.delete()
-            else:
-                delete_expired_link_image(dir, username)
+def generate_thumbnails(image_id, title):
+    """Generating thumbnails of uploaded original image outside of request-response cycle"""
 
+    original_image = Image.objects.select_related('user').filter(id=image_id).first()
+    if original_image is None:
+        return
+    try:
+        with transaction.atomic():
+            create_thumbnails(original_image, title)
+    except Exception:
+        Image.objects.filter(id=image_id).update(processing_status=Image.ProcessingStatus.FAILED)
+        raise
+    Image.objects.filter(id=image_id).update(processing_status=Image.ProcessingStatus.READY)
+
+
+@shared_task
+def generate_missing_thumbnails(user_id, type_ids):
+    """Generating thumbnails of types which became allowed for user (e.g. after upgrade of account tier)"""
+
+    user = User.objects.filter(id=user_id).first()
+    if user is None:
+        return 0
+    return create_missing_thumbnails(user, type_ids)
+
+
+@shared_task
+def delete_thumbnail_derivatives(heigths):
+    """Deleting derivatives of blobs after height or encoding of thumbnail type was changed in admin"""
+
+    return delete_blob_derivatives(heigths)
+
+
+@shared_task
+def backfill_thumbnails_chunk(original_ids, thumbnail_type_id):
+    """Creating thumbnails of type which was added later for chunk of original images (see backfill_thumbnails command)"""
+
+    return backfill_thumbnails(original_ids, thumbnail_type_id)
+
+
+@shared_task
+def delete_expired_images(batch_size=1000, time_budget_seconds=60):
+    """
+    Deleting expired links from DB and removing their orphan files, deleting blobs which are not used anymore.
+    Work is limited by time budget and is continued by the next run, so task can be scheduled often
+    """
+
+    deadline = time.monotonic() + time_budget_seconds
+    deleted_links = delete_expired_links(batch_size, deadline)
+    removed_dirs = sweep_orphan_link_files(batch_size, deadline)
+    deleted_blobs = delete_unreferenced_blobs(batch_size, deadline)
+    return {'deleted_links': deleted_links, 'removed_dirs': removed_dirs, 'deleted_blobs': deleted_blobs}
@@ -0,0 +1,42 @@
+from django.core.cache import cache
+
+from app_with_ui.models import AccountTier
+
+TIER_POLICY_KEY = 'app_with_ui.tier_policy.{}'
+TIER_POLICY_TIMEOUT = 24 * 60 * 60
+
+
+def get_tier_policy(account_tier_id):
+    """
+    Getting cached policy of account tier: ability to create expiry links, allowed thumbnail types
+    and limits of uploads and links (rates are per minute, None - no limit).
+    Returns None if user was not assigned an any account tier
+    """
+
+    if account_tier_id is None:
+        return None
+    key = TIER_POLICY_KEY.format(account_tier_id)
+    policy = cache.get(key)
+    if policy is None:
+        account_tier = AccountTier.objects.filter(id=account_tier_id).first()
+        if account_tier is None:
+            return None
+        allowed_image_types = list(account_tier.allowed_image_types.values_list('id', 'heigth_size_in_pixels'))
+        policy = {
+            'title': account_tier.title,
+            'has_ability_create_expiry_link': account_tier.has_ability_create_expiry_link,
+            'allowed_image_type_ids': [type_id for type_id, _ in allowed_image_types],
+            'allowed_heights': [heigth for _, heigth in allowed_image_types if heigth],
+            'rate_limits': {
+                'upload': (account_tier.upload_rate, account_tier.upload_burst or account_tier.upload_rate),
+                'link': (account_tier.link_rate, account_tier.link_burst or account_tier.link_rate),
+            },
+            'max_concurrent_uploads': account_tier.max_concurrent_uploads,
+            'bypass_load_shedding': account_tier.bypass_load_shedding,
+        }
+        cache.set(key, policy, TIER_POLICY_TIMEOUT)
+    return policy
+
+
+def invalidate_tier_policies(account_tier_ids):
+    cache.delete_many([TIER_POLICY_KEY.format(account_tier_id) for account_tier_id in account_tier_ids])
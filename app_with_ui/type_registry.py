@@ -0,0 +1,65 @@
+import threading
+import time
+
+from django.core.cache import cache
+
+from app_with_ui.models import ThumbnailType
+
+THUMBNAIL_TYPES_VERSION_KEY = 'app_with_ui.thumbnail_types_version'
+
+
+class ThumbnailTypeRegistry:
+    """
+    Process-local registry of thumbnail types, so upload paths and Celery workers resolve types without DB queries.
+    Types are loaded again when version key in cache is changed by another process (admin edited types)
+    or when they are older than max_age seconds (in case cache is unavailable)
+    """
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._types = None
+        self._version = None
+        self._loaded_at = 0
+
+    def get_types(self):
+        version = cache.get(THUMBNAIL_TYPES_VERSION_KEY)
+        with self._lock:
+            if self._types is None or version != self._version or time.monotonic() - self._loaded_at > self.max_age:
+                self._types = list(ThumbnailType.objects.order_by('id'))
+                self._version = version
+                self._loaded_at = time.monotonic()
+            return self._types
+
+    def get_original_type(self):
+        for thumbnail_type in self.get_types():
+            if thumbnail_type.is_original:
+                return thumbnail_type
+        return None
+
+    def get_sized_types(self):
+        """Getting thumbnail types which have height, from the biggest to the smallest one"""
+
+        sized_types = [thumbnail_type for thumbnail_type in self.get_types() if thumbnail_type.heigth_size_in_pixels]
+        return sorted(sized_types, key=lambda thumbnail_type: thumbnail_type.heigth_size_in_pixels, reverse=True)
+
+    def get_encoding_profile(self, heigth):
+        """Getting encoding profile of thumbnail type with given height (None if there is no such type)"""
+
+        for thumbnail_type in self.get_sized_types():
+            if thumbnail_type.heigth_size_in_pixels == heigth:
+                return thumbnail_type.get_encoding_profile()
+        return None
+
+    def invalidate(self):
+        """Dropping types loaded by this process and notifying other processes by changing version key"""
+
+        with self._lock:
+            self._types = None
+        try:
+            cache.incr(THUMBNAIL_TYPES_VERSION_KEY)
+        except ValueError:
+            cache.set(THUMBNAIL_TYPES_VERSION_KEY, 1, None)
+
+
+thumbnail_type_registry = ThumbnailTypeRegistry()
@@ -1,7 +1,8 @@
 from django.urls import path
 
 from app_with_ui.views import IndexView, UploadImageView, ImageListView, CreateExpiryLinkView, \
-    ExpiryLinksList, ShowImageByExpiryLink, LoginUser, RegisterUser, ProfileView, logout_user
+    ExpiryLinksList, ShowImageByExpiryLink, ShowImageBySignedLink, LoginUser, RegisterUser, ProfileView, \
+    logout_user
 
 urlpatterns = [
     path('', IndexView.as_view(), name='index'),
@@ -11,6 +12,7 @@ urlpatterns = [
     path('create-expiry-link/<int:pk>/', CreateExpiryLinkView.as_view(), name='create_expiry_link'),
     path('all-expired-links/', ExpiryLinksList.as_view(), name='all_expired_links'),
     path('temp/<str:link>/', ShowImageByExpiryLink.as_view(), name='show_image_by_exp_link'),
+    path('signed/<str:token>/', ShowImageBySignedLink.as_view(), name='show_image_by_signed_link'),
     path('login/', LoginUser.as_view(), name='login'),
     path('register/', RegisterUser.as_view(), name='register'),
     path('logout/', logout_user, name='logout'),
@@ -1,23 +1,69 @@
 import clipboard
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import logout
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.contrib.auth.views import LoginView
+from django.contrib.auth.views import LoginView, redirect_to_login
 
-from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponseRedirect
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render, redirect
 from django.urls import reverse_lazy
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views import View
 from django.views.generic import TemplateView, CreateView, ListView
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
 
 from app_with_ui.forms import UploadImageForm, ExpiryLinkCreateForm, LoginUserForm, \
     RegisterUserForm, ProfileForm
-from app_with_ui.models import ThumbnailType, Image, ExpiredLink
-from app_with_ui.services import get_original_image_size, resize_image, get_base64_encode_image, \
-    set_link_expiring_datetime, is_link_expired, show_image_by_exp_link
+from app_with_ui.blobs import BLOB_DIR
+from app_with_ui.list_cache import get_image_list_version, get_image_list_etag, get_cached_page, store_cached_page, \
+    patch_image_list_response
+from app_with_ui.models import Image, ExpiredLink
+from app_with_ui.pagination import get_keyset_page
+from app_with_ui.rate_limit import admit_request, RequestIsNotAdmitted
+from app_with_ui.serving import serve_file, aserve_file
+from app_with_ui.services import attach_blob, get_or_create_original_blob, set_link_expiring_datetime, is_link_expired, \
+    show_image_by_exp_link, show_image_by_signed_link, ashow_image_by_exp_link, ashow_image_by_signed_link, \
+    get_expiry_link, is_expiry_link_recorded, get_newly_allowed_type_ids, ORIGINAL_TITLE_SUFFIX
+from app_with_ui.tasks import generate_thumbnails, generate_missing_thumbnails
+from app_with_ui.tier_cache import get_tier_policy
+from app_with_ui.type_registry import thumbnail_type_registry
 from api_app.exceptions import OriginalImageTypeDoesNotExist
 
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
+
+class AdmissionControlMixin:
+    """
+    Same admission control for POST requests of UI views as APIAdmissionControlMixin of API: rejected request
+    gets 429 or 503 response with Retry-After
+    """
+
+    admission_scope = None
+    limit_concurrency = False
+    shed_load = False
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method != 'POST':
+            return super().dispatch(request, *args, **kwargs)
+        try:
+            with admit_request(
+                request.user,
+                self.admission_scope,
+                limit_concurrency=self.limit_concurrency,
+                shed_load=self.shed_load
+            ):
+                return super().dispatch(request, *args, **kwargs)
+        except RequestIsNotAdmitted as exc:
+            response = HttpResponse(exc.message, status=exc.status_code)
+            if exc.wait is not None:
+                response['Retry-After'] = str(exc.wait)
+            return response
+
 
 class IndexView(LoginRequiredMixin, TemplateView):
     template_name = 'app_with_ui/index.html'
@@ -25,9 +71,11 @@ class IndexView(LoginRequiredMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        tier_policy = get_tier_policy(self.request.user.account_tier_id)
+        context['tier_policy'] = tier_policy
         context['images_count'] = Image.objects.filter(
             user=self.request.user,
-            type__in=self.request.user.account_tier.allowed_image_types.all()
+            type__in=tier_policy['allowed_image_type_ids'] if tier_policy else []
         ).count()
         context['expiry_links_count'] = ExpiredLink.objects.filter(
             user=self.request.user,
@@ -43,7 +91,7 @@ class ProfileView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         form = ProfileForm(
             initial={
-                'account_tier': request.user.account_tier,
+                'account_tier': request.user.account_tier_id,
                 'first_name': request.user.first_name,
                 'last_name': request.user.last_name
             }
@@ -57,17 +105,25 @@ class ProfileView(LoginRequiredMixin, View):
             account_tier = form.cleaned_data['account_tier']
             first_name = form.cleaned_data['first_name']
             last_name = form.cleaned_data['last_name']
+            old_account_tier_id = user.account_tier_id
             user.account_tier = account_tier
             user.first_name = first_name
             user.last_name = last_name
             user.save()
+            # Thumbnails are made only for allowed types, so ones allowed by new tier are made in background
+            new_type_ids = get_newly_allowed_type_ids(old_account_tier_id, user.account_tier_id)
+            if new_type_ids:
+                transaction.on_commit(lambda: generate_missing_thumbnails.delay(user.id, new_type_ids))
             return HttpResponseRedirect('/')
         return render(request, 'app_with_ui/profile.html', {'form': form})
 
 
-class UploadImageView(LoginRequiredMixin, CreateView):
+class UploadImageView(LoginRequiredMixin, AdmissionControlMixin, CreateView):
 
     login_url = '/login/'
+    admission_scope = 'upload'
+    limit_concurrency = True
+    shed_load = True
     form_class = UploadImageForm
     model = Image
     template_name = 'app_with_ui/upload_image.html'
@@ -75,26 +131,19 @@ class UploadImageView(LoginRequiredMixin, CreateView):
     def post(self, request, *args, **kwargs):
         form = UploadImageForm(request.POST or None, request.FILES or None)
         if form.is_valid():
-            try:
-                image_type = ThumbnailType.objects.get(is_original=True)
-            except ObjectDoesNotExist:
+            image_type = thumbnail_type_registry.get_original_type()
+            if image_type is None:
                 raise OriginalImageTypeDoesNotExist
             original_image = form.save(commit=False)
             original_image.user = request.user
             original_image.type = image_type
-            original_image.title = f'{original_image.title}(original image)'
-            original_image.width, original_image.height = get_original_image_size(original_image.image)
+            original_image.title = f'{original_image.title}{ORIGINAL_TITLE_SUFFIX}'
+            original_image.processing_status = Image.ProcessingStatus.PENDING
+            attach_blob(original_image, get_or_create_original_blob(original_image.image.file))
             original_image.save()
-            thumbnails_height_sizes_and_types = resize_image(original_image.image)
-            for size_and_type in thumbnails_height_sizes_and_types:
-                new_thumbnail_image, new_thumbnail_type, width, height = size_and_type
-                Image.objects.create(
-                    image=new_thumbnail_image,
-                    type=new_thumbnail_type,
-                    user=self.request.user,
-                    title=f'{form.cleaned_data["title"]}({height}px thumbnail)',
-                    width=width,
-                    height=height)
+            transaction.on_commit(
+                lambda: generate_thumbnails.delay(original_image.id, form.cleaned_data['title'])
+            )
             return HttpResponseRedirect('/')
         return render(request, 'app_with_ui/upload_image.html', {'form': form})
 
@@ -107,17 +156,58 @@ class ImageListView(LoginRequiredMixin, ListView):
     context_object_name = 'images'
     paginate_by = 6
 
+    def get(self, request, *args, **kwargs):
+        """
+        Page is not built at all if client has its current version (ETag from generation of user's images).
+        Images of page are cached by version of page
+        """
+
+        self.version = get_image_list_version(request, self.get_tier_policy())
+        etag = get_image_list_etag(self.version)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        patch_image_list_response(response, etag)
+        return response
+
     def get_queryset(self):
         images = Image.objects.filter(
             user=self.request.user,
-            type__in=self.request.user.account_tier.allowed_image_types.all()
-        ).order_by('-upload_date')
+            type__in=self.get_tier_policy()['allowed_image_type_ids']
+        ).order_by('-upload_date', '-id')
         return images
 
+    def paginate_queryset(self, queryset, page_size):
+        """Keyset pagination by (upload_date, id) instead of OFFSET pages, see get_keyset_page"""
 
-class CreateExpiryLinkView(LoginRequiredMixin, CreateView):
+        page = get_cached_page(self.version)
+        if page is None:
+            try:
+                images, next_cursor = get_keyset_page(queryset, self.request.GET.get('cursor'), page_size)
+            except ValueError:
+                raise Http404('Invalid cursor')
+            page = (list(images), next_cursor)
+            store_cached_page(self.version, page)
+        images, self.next_cursor = page
+        return None, None, images, self.next_cursor is not None
+
+    def get_tier_policy(self):
+        return get_tier_policy(self.request.user.account_tier_id) or {
+            'has_ability_create_expiry_link': False,
+            'allowed_image_type_ids': [],
+        }
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['tier_policy'] = self.get_tier_policy()
+        context['next_cursor'] = self.next_cursor
+        return context
+
+
+class CreateExpiryLinkView(LoginRequiredMixin, AdmissionControlMixin, CreateView):
 
     login_url = '/login/'
+    admission_scope = 'link'
     form_class = ExpiryLinkCreateForm
     template_name = 'app_with_ui/create_expiry_link.html'
 
@@ -140,20 +230,24 @@ class CreateExpiryLinkView(LoginRequiredMixin, CreateView):
         form = ExpiryLinkCreateForm(request.POST or None)
         if form.is_valid():
             image = Image.objects.get(user=request.user, id=self.kwargs['pk'])
-            base64_encode_image = get_base64_encode_image(image.image.url)
             user_exp_time_seconds = form.cleaned_data['user_exp_time_seconds']
             expiry_date_time = set_link_expiring_datetime(user_exp_time_seconds)
-            new_exp_link = ExpiredLink.objects.create(
+            new_exp_link = ExpiredLink(
                 user=request.user,
                 image=image,
                 width=image.width,
                 height=image.height,
-                image_base_64=base64_encode_image,
                 user_exp_time_seconds=user_exp_time_seconds,
                 expiry_date_time=expiry_date_time,
                 title=image.title
             )
-            new_exp_link.expiry_link = f'http://127.0.0.1:8000/temp/{new_exp_link.uuid_link}/'
+            new_exp_link.expiry_link = get_expiry_link(image, expiry_date_time, new_exp_link.uuid_link)
+            if not is_expiry_link_recorded():
+                return render(
+                    request,
+                    'app_with_ui/create_expiry_link.html',
+                    {'expiring_link_obj': new_exp_link}
+                )
             new_exp_link.save()
             return redirect('create_expiry_link', self.kwargs['pk'])
         return render(request, 'app_with_ui/create_expiry_link.html', {'form': form})
@@ -175,7 +269,107 @@ class ExpiryLinksList(LoginRequiredMixin, ListView):
 class ShowImageByExpiryLink(View):
 
     def get(self, request, *args, **kwargs):
-        return show_image_by_exp_link(self.kwargs['link'])
+        return show_image_by_exp_link(request, self.kwargs['link'])
+
+
+class ShowImageBySignedLink(View):
+
+    def get(self, request, *args, **kwargs):
+        return show_image_by_signed_link(request, self.kwargs['token'])
+
+
+async def show_image_by_exp_link_async(request, link):
+    """Async version of ShowImageByExpiryLink for ASGI, see ASGI_URLCONF"""
+
+    return await ashow_image_by_exp_link(request, link)
+
+
+async def show_image_by_signed_link_async(request, token):
+    """Async version of ShowImageBySignedLink for ASGI, see ASGI_URLCONF"""
+
+    return await ashow_image_by_signed_link(request, token)
+
+
+def get_media_access(request, path):
+    """
+    Checking if media file is available for request: (is_authenticated, is_available).
+    With MEDIA_OWNER_ONLY files are available only for their owners (and staff), otherwise for everyone
+    """
+
+    if not settings.MEDIA_OWNER_ONLY:
+        return True, True
+    user = authenticate_media_request(request)
+    if not user.is_authenticated:
+        return False, False
+    return True, user.is_staff or Image.objects.filter(user=user, image=path).exists()
+
+
+def authenticate_media_request(request):
+    """Getting user of request by session or by authenticators of API, so API clients can fetch URLs of their images"""
+
+    if request.user.is_authenticated:
+        return request.user
+    api_request = Request(request, authenticators=[
+        authenticator() for authenticator in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    ])
+    try:
+        return api_request.user
+    except APIException:
+        return request.user
+
+
+def get_media_login_response(request):
+    # API clients which sent credentials are not redirected to login page of UI
+    if 'HTTP_AUTHORIZATION' in request.META:
+        return HttpResponse('Authentication credentials are not correct', status=401)
+    return redirect_to_login(request.get_full_path(), MediaView.login_url)
+
+
+def patch_media_cache_control(response, path):
+    if path.startswith(f'{BLOB_DIR}/'):
+        # Content of blob never changes, because its name is hash of content
+        patch_cache_control(response, private=True, max_age=MEDIA_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+
+
+class MediaView(View):
+    """
+    Serving of media files (see MEDIA_OWNER_ONLY about access to them).
+    Files of blob store are cached by browsers for a year, other files are revalidated by ETag
+    """
+
+    login_url = '/login/'
+
+    def get(self, request, *args, **kwargs):
+        path = self.kwargs['path']
+        is_authenticated, is_available = get_media_access(request, path)
+        if not is_authenticated:
+            return get_media_login_response(request)
+        if not is_available:
+            raise Http404
+        try:
+            response = serve_file(request, path)
+        except FileNotFoundError:
+            raise Http404
+        patch_media_cache_control(response, path)
+        return response
+
+
+async def media_async(request, path):
+    """Async version of MediaView for ASGI, see ASGI_URLCONF"""
+
+    is_authenticated, is_available = await sync_to_async(get_media_access)(request, path)
+    if not is_authenticated:
+        return get_media_login_response(request)
+    if not is_available:
+        raise Http404
+    try:
+        response = await aserve_file(request, path)
+    except FileNotFoundError:
+        raise Http404
+    patch_media_cache_control(response, path)
+    return response
 
 
 class RegisterUser(CreateView):
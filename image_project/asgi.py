@@ -2,6 +2,8 @@
 ASGI config for image_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Links and media files are streamed by async views (ASGI_URLCONF), e.g.
+gunicorn image_project.asgi:application -k uvicorn.workers.UvicornWorker
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
@@ -9,7 +11,7 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+from app_with_ui.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'image_project.settings')
 
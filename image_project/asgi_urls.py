@@ -0,0 +1,14 @@
+import re
+
+from django.conf import settings
+from django.urls import include, path, re_path
+
+from app_with_ui.views import show_image_by_exp_link_async, show_image_by_signed_link_async, media_async
+
+# Used by ASGI application: file streaming views are replaced with async ones, other views are served as is
+urlpatterns = [
+    path('temp/<str:link>/', show_image_by_exp_link_async, name='show_image_by_exp_link'),
+    path('signed/<str:token>/', show_image_by_signed_link_async, name='show_image_by_signed_link'),
+    re_path(rf'^{re.escape(settings.MEDIA_URL.lstrip("/"))}(?P<path>.*)$', media_async, name='media'),
+    path('', include('image_project.urls')),
+]
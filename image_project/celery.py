@@ -22,7 +22,7 @@ app.autodiscover_tasks()
 app.conf.beat_schedule = {
     'deleting_expired_links': {
         'task': 'app_with_ui.tasks.delete_expired_images',
-        'schedule': crontab(minute='0', hour='23', day_of_week='*', day_of_month='*', month_of_year='*')
+        'schedule': crontab(minute='*/5', hour='*', day_of_week='*', day_of_month='*', month_of_year='*')
     }
 }
 
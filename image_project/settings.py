@@ -27,6 +27,12 @@ DEBUG = True
 
 ALLOWED_HOSTS = ['*']
 
+INTERNAL_IPS = ['127.0.0.1']
+
+# Timings of requests in Server-Timing header and histograms per view, shared in cache, on /metrics
+# (see app_with_ui.instrumentation)
+INSTRUMENTATION_ENABLED = False
+
 
 # Application definition
 
@@ -47,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app_with_ui.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,6 +65,9 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'image_project.urls'
 
+# Used by ASGI application, where links and media files are streamed by async views
+ASGI_URLCONF = 'image_project.asgi_urls'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -88,6 +98,19 @@ DATABASES = {
 }
 
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+            # If Redis is unavailable cache works as always empty one, so data is read from DB
+            'IGNORE_EXCEPTIONS': True,
+        },
+    }
+}
+DJANGO_REDIS_LOG_IGNORED_EXCEPTIONS = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -125,6 +148,9 @@ USE_TZ = True
 CELERY_TIMEZONE = "Europe/Warsaw"
 CELERY_TASK_TRACK_STARTED = True
 CELERY_TASK_TIME_LIMIT = 30 * 60
+# Tasks run in threads of worker process, so thumbnails are rendered by image pool on all cores
+# (daemonic processes of prefork pool can not start processes). Threads pool does not enforce time limits
+CELERY_WORKER_POOL = 'threads'
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 # CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 
@@ -139,6 +165,49 @@ STATICFILES_DIRS = (
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+DEFAULT_FILE_STORAGE = 'app_with_ui.instrumentation.TimedFileSystemStorage'
+
+# Process pool for CPU-bound image work: number of processes (None is number of cores, 0 disables pool),
+# max number of queued and running tasks and seconds to wait for free place in queue.
+# Every process which uses pool (web server worker, Celery worker) starts its own processes by forkserver,
+# so lower it if many web server workers render thumbnails
+IMAGE_POOL_WORKERS = None
+IMAGE_POOL_MAX_PENDING = 256
+IMAGE_POOL_SUBMIT_TIMEOUT = 30
+
+# Uploads are hashed while they are received and stored once per content in blob store (see app_with_ui.blobs).
+# Blobs without references are deleted by cleanup task after grace period
+FILE_UPLOAD_HANDLERS = [
+    'app_with_ui.upload_handlers.HashingMemoryFileUploadHandler',
+    'app_with_ui.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+BLOB_GRACE_SECONDS = 60 * 60
+
+# Batch upload: max number of files in one request and number of threads processing them
+BATCH_UPLOAD_MAX_FILES = 100
+BATCH_UPLOAD_MAX_WORKERS = 4
+
+# Admission control of uploads and expiry links. Rates and concurrency limits are set per account tier.
+# Uploads are rejected with 503 when more images are waiting for thumbnails than threshold (None - disabled)
+THUMBNAIL_BACKLOG_SHED_THRESHOLD = None
+LOAD_SHEDDING_RETRY_AFTER = 30
+CONCURRENT_UPLOADS_RETRY_AFTER = 1
+
+# Sending of media files can be offloaded to front proxy: None (files are streamed by Django),
+# 'x-accel-redirect' (nginx, MEDIA_OFFLOAD_INTERNAL_URL is internal location with alias to MEDIA_ROOT) or 'x-sendfile'
+MEDIA_OFFLOAD = None
+MEDIA_OFFLOAD_INTERNAL_URL = '/protected-media/'
+
+# Media files are available only for their owners (and staff). Users are authenticated by session or by authenticators
+# of API (e.g. Basic auth), so API clients can fetch URLs of their images. By default any media file is available
+# by its URL, as when front proxy serves MEDIA_ROOT itself
+MEDIA_OWNER_ONLY = False
+
+# On-demand rendered thumbnails, least recently used ones are evicted down to low water size when cache
+# exceeds max size
+RENDER_CACHE_DIR = os.path.join(BASE_DIR, 'render_cache')
+RENDER_CACHE_MAX_SIZE = 512 * 1024 * 1024
+RENDER_CACHE_LOW_WATER_SIZE = 384 * 1024 * 1024
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -149,4 +218,9 @@ AUTH_USER_MODEL = 'app_with_ui.User'
 
 domain_and_port_for_link = 'http://127.0.0.1:8000'
 
+# Signed expiry links carry image file and expiry time signed with HMAC, so they are served without DB queries.
+# Signed links can still be stored in DB to be shown in list of user's expiry links
+EXPIRY_LINKS_SIGNED = False
+EXPIRY_LINKS_RECORD_SIGNED = True
+
 
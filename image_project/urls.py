@@ -1,14 +1,17 @@
+import re
+
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
+
+from app_with_ui.instrumentation import metrics_view
+from app_with_ui.views import MediaView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('', include('app_with_ui.urls')),
     path('api-auth/', include('rest_framework.urls')),
     path('api/v1/', include('api_app.urls')),
-]
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    path('metrics', metrics_view, name='metrics'),
+    re_path(rf'^{re.escape(settings.MEDIA_URL.lstrip("/"))}(?P<path>.*)$', MediaView.as_view(), name='media'),
+]
\ No newline at end of file